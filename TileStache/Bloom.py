@@ -0,0 +1,262 @@
+""" Skips cache reads for tiles that are known not to exist.
+
+For sparse layers most tiles are never rendered, and every miss costs a
+network round trip to a remote cache such as S3 or Redis before rendering
+even starts. This cache wraps another cache and keeps a Bloom filter of the
+tiles saved to it, one per layer and zoom level. If the filter says a tile
+was never saved, the wrapped cache isn't asked for it at all.
+
+Filters are persisted to a local directory, and are built by saving tiles
+through this cache, e.g. with tilestache-seed.py. Tiles saved to the wrapped
+cache some other way look like misses and are rendered again, after which
+they're known to the filter. Bloom filters can't forget, so removed tiles
+just cost one extra read.
+
+Example configuration:
+
+  "cache": {
+    "name": "Bloom",
+    "path": "/var/lib/tilestache/bloom",
+    "cache": {
+      "name": "S3",
+      "bucket": "<bucket name>"
+    }
+  }
+
+Bloom cache parameters:
+
+  path
+    Required local directory path where filter files should be stored.
+
+  cache
+    Required configuration of the wrapped cache.
+
+  capacity
+    Optional number of tiles expected per layer and zoom level; filters
+    for low zoom levels are sized for the number of tiles that exist there.
+    Defaults to 1,000,000.
+
+  error rate
+    Optional fraction of unknown tiles that will still be read from the
+    wrapped cache. Defaults to 0.01.
+
+  save interval
+    Optional number of seconds between writes of changed filters to disk.
+    Filters are also written when Python exits. Defaults to 10.
+
+  umask
+    Optional string representation of octal permission mask for filter
+    files, as for the Disk cache. Defaults to "0022".
+
+Filters saved by several processes are merged on disk under a lock on a
+".lock" file next to each filter, and a process checks for newer filter
+files before trusting a miss, so other processes' tiles are found within
+one save interval.
+"""
+import os
+import fcntl
+import atexit
+import threading
+
+from math import ceil, log
+from struct import unpack
+from hashlib import md5
+from binascii import hexlify, unhexlify
+from tempfile import mkstemp
+from time import time as _time
+from os.path import exists, dirname, join as pathjoin
+
+class BloomFilter:
+    """ Simple Bloom filter on a bytearray, with double hashing of MD5 digests.
+    """
+    def __init__(self, capacity, error_rate):
+        bits = -capacity * log(error_rate) / (log(2) ** 2)
+
+        self.size = int(ceil(bits / 8)) * 8
+        self.hashes = max(1, int(round(self.size / float(capacity) * log(2))))
+        self.bits = bytearray(self.size / 8)
+
+    def _offsets(self, key):
+        """ Generate bit offsets for a key.
+        """
+        h1, h2 = unpack('<QQ', md5(key).digest())
+
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        for offset in self._offsets(key):
+            self.bits[offset >> 3] |= 1 << (offset & 7)
+
+    def __contains__(self, key):
+        for offset in self._offsets(key):
+            if not self.bits[offset >> 3] & (1 << (offset & 7)):
+                return False
+
+        return True
+
+    def merge(self, bits):
+        """ Add all the keys from another filter's bits of the same size.
+        
+            Bits are OR'ed together as two long integers, which is
+            far quicker than a loop over every byte.
+        """
+        if len(bits) == len(self.bits):
+            merged = long(hexlify(self.bits), 16) | long(hexlify(bits), 16)
+            self.bits = bytearray(unhexlify('%0*x' % (len(bits) * 2, merged)))
+
+def tile_key(coord, format):
+    """ Return a tile key string, unique within a layer and zoom level.
+    """
+    return '%d/%d.%s' % (coord.column, coord.row, format.lower())
+
+class Cache:
+    """
+    """
+    def __init__(self, cache, path, capacity=1000000, error_rate=0.01, save_interval=10, umask=0022):
+        self.cache = cache
+        self.cachepath = path
+        self.umask = int(umask)
+        self.capacity = int(capacity)
+        self.error_rate = float(error_rate)
+        self.save_interval = float(save_interval)
+
+        # filters and their changed state, keyed by (layer name, zoom).
+        self.filters, self.changed, self.mtimes = {}, set(), {}
+        self.saved = _time()
+        self.filters_lock = threading.RLock()
+
+        atexit.register(self.saveFilters)
+
+    def _filepath(self, key):
+        """ Return the local filename of a filter.
+        """
+        name, zoom = key
+        return pathjoin(self.cachepath, name, '%d.bloom' % zoom)
+
+    def _filter(self, layer, coord):
+        """ Return the filter for a tile's layer and zoom, loading it if needed.
+        """
+        key = layer.name(), coord.zoom
+
+        with self.filters_lock:
+            if key not in self.filters:
+                capacity = min(self.capacity, 4 ** coord.zoom)
+                self.filters[key] = BloomFilter(capacity, self.error_rate)
+                self.mtimes[key] = None
+                self._reload(key)
+
+            return self.filters[key]
+
+    def _reload(self, key):
+        """ Merge a filter file into its filter if it changed, return true if so.
+        """
+        filepath = self._filepath(key)
+
+        with self.filters_lock:
+            if not exists(filepath):
+                return False
+
+            mtime = os.stat(filepath).st_mtime
+
+            if mtime == self.mtimes[key]:
+                return False
+
+            self.filters[key].merge(open(filepath, 'rb').read())
+            self.mtimes[key] = mtime
+
+            return True
+
+    def saveFilters(self):
+        """ Write changed filters to disk, merged with any already there.
+        """
+        with self.filters_lock:
+            for key in self.changed:
+                bloom, filepath = self.filters[key], self._filepath(key)
+
+                try:
+                    os.makedirs(dirname(filepath))
+                except OSError, e:
+                    if e.errno != 17:
+                        raise
+
+                # other processes merge into the same file, one at a time.
+                lockfile = open(filepath + '.lock', 'a')
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+
+                try:
+                    if exists(filepath):
+                        bloom.merge(open(filepath, 'rb').read())
+
+                    fh, tmp_path = mkstemp(dir=dirname(filepath), suffix='.bloom')
+                    os.write(fh, bloom.bits)
+                    os.close(fh)
+                    os.chmod(tmp_path, 0666&~self.umask)
+                    os.rename(tmp_path, filepath)
+
+                    self.mtimes[key] = os.stat(filepath).st_mtime
+
+                finally:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+                    lockfile.close()
+
+            self.changed, self.saved = set(), _time()
+
+    def flush(self):
+        """ Write changed filters to disk, and flush the wrapped cache.
+        """
+        self.saveFilters()
+
+        if hasattr(self.cache, 'flush'):
+            self.cache.flush()
+
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile in the wrapped cache.
+        """
+        return self.cache.lock(layer, coord, format)
+
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile in the wrapped cache.
+        """
+        return self.cache.unlock(layer, coord, format)
+
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile from the wrapped cache.
+
+            It stays in the filter, which can't forget.
+        """
+        return self.cache.remove(layer, coord, format)
+
+    def remove_many(self, layer, coords, format):
+        """ Remove many cached tiles from the wrapped cache.
+        """
+        from .Caches import removeMany
+
+        return removeMany(self.cache, layer, coords, format)
+
+    def read(self, layer, coord, format):
+        """ Read a cached tile from the wrapped cache, if it might be there.
+        """
+        key = tile_key(coord, format)
+
+        if key not in self._filter(layer, coord):
+            # another process might have saved it since we last looked.
+            if not self._reload((layer.name(), coord.zoom)):
+                return None
+
+            if key not in self._filter(layer, coord):
+                return None
+
+        return self.cache.read(layer, coord, format)
+
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile to the wrapped cache and note it in the filter.
+        """
+        self.cache.save(body, layer, coord, format)
+
+        with self.filters_lock:
+            self._filter(layer, coord).add(tile_key(coord, format))
+            self.changed.add((layer.name(), coord.zoom))
+
+            if _time() - self.saved > self.save_interval:
+                self.saveFilters()
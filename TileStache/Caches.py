@@ -10,6 +10,9 @@ Built-in providers:
 - multi
 - memcache
 - s3
+- sqlite
+- mbtiles
+- bloom
 
 Example built-in cache, for JSON configuration file:
 
@@ -44,12 +47,17 @@ The save() method accepts an additional argument before the others:
 
 - body: raw content to save to the cache.
 
+A cache may also provide a remove_many() method to remove many tiles at once,
+with a list of coordinates in place of the single coord argument. Use the
+removeMany() function to call it, falling back to remove() if it's missing.
+
 TODO: add stale_lock_timeout and cache_lifespan to cache API in v2.
 """
 
 import os
 import sys
 import time
+import errno
 import gzip
 
 from tempfile import mkstemp
@@ -59,6 +67,24 @@ from .Core import KnownUnknown
 from . import Memcache
 from . import Redis
 from . import S3
+from . import SQLite
+from . import MBTiles
+from . import Bloom
+
+def removeMany(cache, layer, coords, format):
+    """ Remove a list of cached tiles, with remove_many() if the cache has it.
+    """
+    if hasattr(cache, 'remove_many'):
+        return cache.remove_many(layer, coords, format)
+    
+    for coord in coords:
+        cache.remove(layer, coord, format)
+
+def flush(cache):
+    """ Write out any batched cache writes, with flush() if the cache has it.
+    """
+    if hasattr(cache, 'flush'):
+        cache.flush()
 
 def getCacheByName(name):
     """ Retrieve a cache object by name.
@@ -83,6 +109,15 @@ def getCacheByName(name):
     elif name.lower() == 's3':
         return S3.Cache
 
+    elif name.lower() == 'sqlite':
+        return SQLite.Cache
+
+    elif name.lower() == 'mbtiles':
+        return MBTiles.Cache
+
+    elif name.lower() == 'bloom':
+        return Bloom.Cache
+
     raise Exception('Unknown cache name: "%s"' % name)
 
 class Test:
@@ -305,6 +340,53 @@ class Disk:
             if e.errno != 2:
                 raise
         
+    def remove_many(self, layer, coords, format):
+        """ Remove many cached tiles, one directory at a time.
+        
+            Each directory is listed just once, so tiles that were never
+            cached cost nothing, and directories left empty are removed.
+        """
+        directories = {}
+        
+        for coord in coords:
+            fullpath = self._fullpath(layer, coord, format)
+            directories.setdefault(dirname(fullpath), set()).add(basename(fullpath))
+        
+        for (dirpath, filenames) in directories.items():
+            try:
+                existing = os.listdir(dirpath)
+            except OSError, e:
+                # errno=2 means that the directory does not exist, which is fine
+                if e.errno != 2:
+                    raise
+                continue
+            
+            for filename in filenames.intersection(existing):
+                try:
+                    os.remove(pathjoin(dirpath, filename))
+                except OSError, e:
+                    if e.errno != 2:
+                        raise
+            
+            if filenames.issuperset(existing):
+                self._prune(layer, dirpath)
+        
+    def _prune(self, layer, dirpath):
+        """ Remove an empty directory and any empty parents, up to the layer's.
+        """
+        layerpath = pathjoin(self.cachepath, layer.name())
+        
+        while dirpath.startswith(layerpath + os.sep):
+            try:
+                os.rmdir(dirpath)
+            except OSError, e:
+                # not empty after all, or someone else removed it.
+                if e.errno in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                    return
+                raise
+            
+            dirpath = dirname(dirpath)
+        
     def read(self, layer, coord, format):
         """ Read a cached tile.
         """
@@ -329,15 +411,7 @@ class Disk:
         """ Save a cached tile.
         """
         fullpath = self._fullpath(layer, coord, format)
-        
-        try:
-            umask_old = os.umask(self.umask)
-            os.makedirs(dirname(fullpath), 0777&~self.umask)
-        except OSError, e:
-            if e.errno != 17:
-                raise
-        finally:
-            os.umask(umask_old)
+        self._makedirs(dirname(fullpath))
 
         suffix = '.' + format.lower()
         suffix += self._is_compressed(format) and '.gz' or ''
@@ -355,11 +429,28 @@ class Disk:
         
         try:
             os.rename(tmp_path, fullpath)
-        except OSError:
-            os.unlink(fullpath)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                # remove_many() pruned the directory since it was made.
+                self._makedirs(dirname(fullpath))
+            else:
+                os.unlink(fullpath)
+            
             os.rename(tmp_path, fullpath)
 
         os.chmod(fullpath, 0666&~self.umask)
+    
+    def _makedirs(self, dirpath):
+        """ Make a directory and any missing parents, if it's not there already.
+        """
+        try:
+            umask_old = os.umask(self.umask)
+            os.makedirs(dirpath, 0777&~self.umask)
+        except OSError, e:
+            if e.errno != 17:
+                raise
+        finally:
+            os.umask(umask_old)
 
 class Multi:
     """ Caches tiles to multiple, ordered caches.
@@ -416,6 +507,18 @@ class Multi:
         for (index, cache) in enumerate(self.tiers):
             cache.remove(layer, coord, format)
         
+    def remove_many(self, layer, coords, format):
+        """ Remove many cached tiles from every tier.
+        """
+        for (index, cache) in enumerate(self.tiers):
+            removeMany(cache, layer, coords, format)
+        
+    def flush(self):
+        """ Write out batched writes in every tier.
+        """
+        for cache in self.tiers:
+            flush(cache)
+        
     def read(self, layer, coord, format):
         """ Read a cached tile.
         
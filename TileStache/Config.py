@@ -316,6 +316,43 @@ def _parseConfigfileCache(cache_dict, dirpath):
         elif _class is Caches.S3.Cache:
             add_kwargs('bucket', 'access', 'secret', 'use_locks', 'path', 'reduced_redundancy')
     
+        elif _class is Caches.SQLite.Cache:
+            kwargs['path'] = enforcedLocalPath(cache_dict['path'], dirpath, 'SQLite cache path')
+            
+            if 'umask' in cache_dict:
+                kwargs['umask'] = int(cache_dict['umask'], 8)
+            
+            if 'mmap size' in cache_dict:
+                kwargs['mmap_size'] = int(cache_dict['mmap size'])
+            
+            add_kwargs('synchronous')
+    
+        elif _class is Caches.MBTiles.Cache:
+            kwargs['filename'] = enforcedLocalPath(cache_dict['filename'], dirpath, 'MBTiles cache filename')
+            
+            if 'batch size' in cache_dict:
+                kwargs['batch_size'] = int(cache_dict['batch size'])
+            
+            if 'commit interval' in cache_dict:
+                kwargs['commit_interval'] = float(cache_dict['commit interval'])
+            
+            add_kwargs('format', 'name', 'deduplicate')
+    
+        elif _class is Caches.Bloom.Cache:
+            kwargs['cache'] = _parseConfigfileCache(cache_dict['cache'], dirpath)
+            kwargs['path'] = enforcedLocalPath(cache_dict['path'], dirpath, 'Bloom cache path')
+            
+            if 'error rate' in cache_dict:
+                kwargs['error_rate'] = float(cache_dict['error rate'])
+            
+            if 'save interval' in cache_dict:
+                kwargs['save_interval'] = float(cache_dict['save interval'])
+            
+            if 'umask' in cache_dict:
+                kwargs['umask'] = int(cache_dict['umask'], 8)
+            
+            add_kwargs('capacity')
+    
         else:
             raise Exception('Unknown cache: %s' % cache_dict['name'])
         
@@ -376,6 +413,9 @@ def _parseConfigfileLayer(layer_dict, config, dirpath):
     if 'redirects' in layer_dict:
         layer_kwargs['redirects'] = dict(layer_dict['redirects'])
     
+    if 'variants' in layer_dict:
+        layer_kwargs['variants'] = dict([(k.lower(), str(v)) for (k, v) in layer_dict['variants'].items()])
+    
     if 'tile height' in layer_dict:
         layer_kwargs['tile_height'] = int(layer_dict['tile height'])
     
@@ -420,6 +460,7 @@ def _parseConfigfileLayer(layer_dict, config, dirpath):
     
     jpeg_kwargs = {}
     png_kwargs = {}
+    webp_kwargs = {}
 
     if 'jpeg options' in layer_dict:
         jpeg_kwargs = dict([(str(k), v) for (k, v) in layer_dict['jpeg options'].items()])
@@ -427,6 +468,9 @@ def _parseConfigfileLayer(layer_dict, config, dirpath):
     if 'png options' in layer_dict:
         png_kwargs = dict([(str(k), v) for (k, v) in layer_dict['png options'].items()])
 
+    if 'webp options' in layer_dict:
+        webp_kwargs = dict([(str(k), v) for (k, v) in layer_dict['webp options'].items()])
+
     #
     # Do the provider
     #
@@ -453,6 +497,7 @@ def _parseConfigfileLayer(layer_dict, config, dirpath):
     layer.provider = _class(layer, **provider_kwargs)
     layer.setSaveOptionsJPEG(**jpeg_kwargs)
     layer.setSaveOptionsPNG(**png_kwargs)
+    layer.setSaveOptionsWEBP(**webp_kwargs)
     
     return layer
 
@@ -24,9 +24,11 @@ configuration file as a dictionary:
           "allowed origin": ...,
           "maximum cache age": ...,
           "redirects": ...,
+          "variants": ...,
           "tile height": ...,
           "jpeg options": ...,
-          "png options": ...
+          "png options": ...,
+          "webp options": ...
         }
       }
     }
@@ -66,6 +68,12 @@ configuration file as a dictionary:
   If a request is made for a tile with an extension in the dictionary keys,
   a response can be generated that redirects the client to the same tile
   with another extension.
+- "variants" is an optional dictionary of per-extension alternate formats,
+  treated as lowercase. If a request is made for a tile with an extension in
+  the dictionary keys from a client whose HTTP Accept header names the other
+  format's mime-type, the tile is answered in that format instead, e.g.
+  {"png": "webp"} sends WebP tiles to browsers that ask for them. Variants
+  are cached under their own extension, and responses get a Vary header.
 - "tile height" gives the height of the image tile in pixels. You almost always
   want to leave this at the default value of 256, but you can use a value of 512
   to create double-size, double-resolution tiles for high-density phone screens.
@@ -73,6 +81,9 @@ configuration file as a dictionary:
   through to PIL: http://effbot.org/imagingbook/format-jpeg.htm.
 - "png options" is an optional dictionary of PNG creation options, passed
   through to PIL: http://effbot.org/imagingbook/format-png.htm.
+- "webp options" is an optional dictionary of WebP creation options, passed
+  through to PIL: quality (0-100), lossless (boolean), and method (0-6, higher
+  is slower and smaller).
 
 The public-facing URL of a single tile for this layer might look like this:
 
@@ -93,6 +104,16 @@ Sample PNG creation options:
       "palette": "filename.act"
     }
 
+Sample PNG creation options trading CPU time for size, with zlib compression
+level 9, a zlib strategy, and an external optimizer command that's given the
+path of each encoded tile as its last argument:
+
+    {
+      "compress_level": 9,
+      "strategy": "filtered",
+      "optimizer": "optipng -quiet -o2"
+    }
+
 Sample bounds:
 
     {
@@ -133,13 +154,17 @@ The preview can be accessed through a URL like /<layer name>/preview.html:
 - "ext" is the filename extension, e.g. "png".
 """
 
+import os
+import shlex
 import logging
 from wsgiref.headers import Headers
 from StringIO import StringIO
 from urlparse import urljoin
+from tempfile import mkstemp
+from subprocess import Popen, PIPE
 from time import time
 
-from Pixels import load_palette, apply_palette, apply_palette256
+from Pixels import load_palette, apply_palette, SharedPalettes
 
 try:
     from PIL import Image
@@ -150,6 +175,9 @@ from ModestMaps.Core import Coordinate
 
 _recent_tiles = dict(hash={}, list=[])
 
+# zlib compression strategies for PNG output, by name.
+png_strategies = dict(default=0, filtered=1, huffman=2, rle=3, fixed=4)
+
 def _addRecentTile(layer, coord, format, body, age=300):
     """ Add the body of a tile to _recent_tiles with a timeout.
     """
@@ -179,6 +207,30 @@ def _addRecentTile(layer, coord, format, body, age=300):
         except KeyError:
             pass
 
+def _optimizePNG(body, command):
+    """ Run an external optimizer command on an encoded PNG, return its new body.
+    
+        The command is given the path of a temporary file with the PNG
+        as its last argument, and should rewrite that file in place.
+        The original body is returned if the command fails.
+    """
+    handle, filename = mkstemp(suffix='.png')
+    os.write(handle, body)
+    os.close(handle)
+    
+    try:
+        optimizer = Popen(shlex.split(str(command)) + [filename], stdout=PIPE, stderr=PIPE)
+        output = optimizer.communicate()[1]
+        
+        if optimizer.returncode != 0:
+            logging.warning('TileStache.Core._optimizePNG() "%s" failed with code %d: %s', command, optimizer.returncode, output.strip())
+            return body
+        
+        return open(filename, 'rb').read()
+    
+    finally:
+        os.unlink(filename)
+
 def _getRecentTile(layer, coord, format):
     """ Return the body of a recent tile, or None if it's not there.
     """
@@ -310,7 +362,7 @@ class Layer:
             assumed to be square, and Layer.render() will respond with an error
             if the rendered image is not this height.
     """
-    def __init__(self, config, projection, metatile, stale_lock_timeout=15, cache_lifespan=None, write_cache=True, allowed_origin=None, max_cache_age=None, redirects=None, preview_lat=37.80, preview_lon=-122.26, preview_zoom=10, preview_ext='png', bounds=None, tile_height=256):
+    def __init__(self, config, projection, metatile, stale_lock_timeout=15, cache_lifespan=None, write_cache=True, allowed_origin=None, max_cache_age=None, redirects=None, preview_lat=37.80, preview_lon=-122.26, preview_zoom=10, preview_ext='png', bounds=None, tile_height=256, variants=None):
         self.provider = None
         self.config = config
         self.projection = projection
@@ -322,6 +374,7 @@ class Layer:
         self.allowed_origin = allowed_origin
         self.max_cache_age = max_cache_age
         self.redirects = redirects or dict()
+        self.variants = variants or dict()
         
         self.preview_lat = preview_lat
         self.preview_lon = preview_lon
@@ -334,6 +387,8 @@ class Layer:
         self.bitmap_palette = None
         self.jpeg_options = {}
         self.png_options = {}
+        self.png_optimizer = None
+        self.webp_options = {}
 
     def name(self):
         """ Figure out what I'm called, return a name if there is one.
@@ -409,8 +464,6 @@ class Layer:
         
                 if body is None:
                     # No one else wrote the tile, do it here.
-                    buff = StringIO()
-
                     try:
                         tile = self.render(coord, format)
                         save = True
@@ -421,15 +474,7 @@ class Layer:
                     if suppress_cache_write or (not self.write_cache):
                         save = False
 
-                    if format.lower() == 'jpeg':
-                        save_kwargs = self.jpeg_options
-                    elif format.lower() == 'png':
-                        save_kwargs = self.png_options
-                    else:
-                        save_kwargs = {}
-                    
-                    tile.save(buff, format, **save_kwargs)
-                    body = buff.getvalue()
+                    body = self.encodeTile(tile, format)
                     
                     if save:
                         cache.save(body, self, coord, format)
@@ -523,16 +568,15 @@ class Layer:
             # tile will be set again later
             tile, surtile = None, tile
             
+            if self.palette256 and format.lower() == 'png':
+                # this is where we have PIL optimally palette our image,
+                # all at once so that every subtile gets the same colors.
+                surtile = self.shared_palettes.apply(surtile, coord.zoom)
+            
             for (other, x, y) in subtiles:
-                buff = StringIO()
                 bbox = (x, y, x + self.dim, y + self.dim)
                 subtile = surtile.crop(bbox)
-                if self.palette256:
-                    # this is where we have PIL optimally palette our image
-                    subtile = apply_palette256(subtile)
-                
-                subtile.save(buff, format)
-                body = buff.getvalue()
+                body = self.encodeTile(subtile, format)
 
                 if self.write_cache:
                     self.config.cache.save(body, self, other, format)
@@ -545,6 +589,41 @@ class Layer:
         
         return tile
     
+    def encodeTile(self, tile, format):
+        """ Encode a rendered tile in a format, return its body.
+        
+            JPEG, PNG and WebP tiles get the layer's save options, unless
+            the tile's save() takes none, and PNG tiles are run through the
+            layer's optimizer if any.
+        """
+        if format.lower() == 'jpeg':
+            save_kwargs = self.jpeg_options
+        elif format.lower() == 'png':
+            save_kwargs = self.png_options
+        elif format.lower() == 'webp':
+            save_kwargs = self.webp_options
+        else:
+            save_kwargs = {}
+        
+        buff = StringIO()
+        
+        try:
+            tile.save(buff, format, **save_kwargs)
+        except TypeError:
+            if not save_kwargs:
+                raise
+            
+            # providers' own image classes may have a plain save(out, format).
+            buff = StringIO()
+            tile.save(buff, format)
+        
+        body = buff.getvalue()
+        
+        if format.lower() == 'png' and self.png_optimizer:
+            body = _optimizePNG(body, self.png_optimizer)
+        
+        return body
+    
     def envelope(self, coord):
         """ Projected rendering envelope (xmin, ymin, xmax, ymax) for a Coordinate.
         """
@@ -615,6 +694,9 @@ class Layer:
         elif extension.lower() == 'jpg':
             return 'image/jpeg', 'JPEG'
     
+        elif extension.lower() == 'webp':
+            return 'image/webp', 'WEBP'
+    
         else:
             raise KnownUnknown('Unknown extension in configuration: "%s"' % extension)
 
@@ -633,12 +715,43 @@ class Layer:
         if progressive is not None:
             self.jpeg_options['progressive'] = bool(progressive)
 
-    def setSaveOptionsPNG(self, optimize=None, palette=None, palette256=None):
+    def setSaveOptionsWEBP(self, quality=None, lossless=None, method=None):
+        """ Optional arguments are added to self.webp_options for pickup when saving.
+        
+            Quality is 0-100, for lossy compression or for the effort
+            spent on lossless compression. Method is 0-6, trading speed
+            for size.
+        
+            More information about options:
+                http://pillow.readthedocs.io/en/latest/handbook/image-file-formats.html#webp
+        """
+        if quality is not None:
+            self.webp_options['quality'] = int(quality)
+
+        if lossless is not None:
+            self.webp_options['lossless'] = bool(lossless)
+
+        if method is not None:
+            if int(method) not in range(7):
+                raise KnownUnknown('WebP method must be a number from 0 to 6, not "%s"' % method)
+            
+            self.webp_options['method'] = int(method)
+
+    def setSaveOptionsPNG(self, optimize=None, palette=None, palette256=None, palette256_error=None, compress_level=None, strategy=None, optimizer=None):
         """ Optional arguments are added to self.png_options for pickup when saving.
         
             Palette argument is a URL relative to the configuration file,
             and it implies bits and optional transparency options.
         
+            Palette256 argument makes an optimum 256 color palette for each
+            metatile. Palette256_error argument is the greatest root-mean-
+            square color error allowed for reusing a metatile palette on
+            following metatiles at the same zoom level; see TileStache.Pixels.
+        
+            Compress_level argument is a zlib compression level from 0 to 9,
+            and strategy is one of the zlib strategies in png_strategies.
+            Optimizer argument is a command for _optimizePNG().
+        
             More information about options:
                 http://effbot.org/imagingbook/format-png.htm
         """
@@ -658,6 +771,31 @@ class Layer:
             self.palette256 = bool(palette256)
         else:
             self.palette256 = None
+        
+        if palette256_error is not None:
+            palette256_error = float(palette256_error)
+        
+        self.shared_palettes = SharedPalettes(palette256_error)
+        
+        if compress_level is not None:
+            try:
+                level = int(compress_level)
+            except (TypeError, ValueError):
+                level = None
+            
+            if level not in range(10):
+                raise KnownUnknown('PNG compress_level must be a number from 0 to 9, not "%s"' % compress_level)
+            
+            self.png_options['compress_level'] = level
+        
+        if strategy is not None:
+            if strategy not in png_strategies:
+                raise KnownUnknown('PNG strategy must be one of %s, not "%s"' % (', '.join(sorted(png_strategies)), strategy))
+            
+            self.png_options['compress_type'] = png_strategies[strategy]
+        
+        if optimizer is not None:
+            self.png_optimizer = optimizer
 
 class KnownUnknown(Exception):
     """ There are known unknowns. That is to say, there are things that we now know we don't know.
@@ -28,7 +28,7 @@ cache parameters:
 
 """
 from time import time
-from mimetypes import guess_type
+from mimetypes import guess_type, add_type
 
 
 # URI scheme for Google Cloud Storage.
@@ -42,6 +42,9 @@ except ImportError:
     # at least we can build the documentation
     pass
 
+# older mime.types files don't know WebP, which needs a Content-Type to display.
+add_type('image/webp', '.webp')
+
 def tile_key(layer, coord, format):
     """ Return a tile key string.
     """
@@ -14,16 +14,27 @@ Example TileStache cache configuration, with a 16MB limit:
         "limit": 16777216
     }
 }
+
+Reads don't write to the database: last-read times are kept in memory and
+flushed in one transaction every few seconds, by a background thread that
+also removes least-recently-used tiles after saves push the cache over its
+limit. The optional "flush_interval" keyword argument sets the number of
+seconds between flushes, default 5. The limit is therefore a soft limit,
+and may be exceeded briefly between flushes.
+
+Activity is logged via Python's logging module at debug level.
 """
 
 import os
-import sys
 import time
+import atexit
+import logging
+import threading
 
 from math import ceil as _ceil
 from tempfile import mkstemp
 from os.path import isdir, exists, dirname, basename, join as pathjoin
-from sqlite3 import connect, OperationalError, IntegrityError
+from sqlite3 import connect, IntegrityError
 
 _create_tables = """
     CREATE TABLE IF NOT EXISTS locks (
@@ -46,19 +57,156 @@ _create_tables = """
 
 class Cache:
 
-    def __init__(self, path, limit, umask=0022):
+    def __init__(self, path, limit, umask=0022, flush_interval=5):
         self.cachepath = path
         self.dbpath = pathjoin(self.cachepath, 'stache.db')
         self.umask = umask
         self.limit = limit
+        self.flush_interval = flush_interval
 
         db = connect(self.dbpath).cursor()
+        db.execute('PRAGMA journal_mode=WAL')
         
         for create_table in _create_tables:
             db.execute(create_table)
 
         db.connection.close()
 
+        # last-read times waiting to be flushed, keyed by path.
+        self._used, self._used_lock = {}, threading.Lock()
+
+        # set by save() to ask the janitor thread for an eviction pass.
+        self._saved = threading.Event()
+
+        self._local = threading.local()
+        self._janitor_pid = None
+        self._janitor_lock = threading.Lock()
+        self._stopping = False
+
+    def _db(self):
+        """ Return a persistent autocommit connection for this thread and process.
+        """
+        local = self._local
+
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.db = connect(self.dbpath, timeout=30, isolation_level=None)
+
+        return local.db
+
+    def _start_janitor(self):
+        """ Start the background flush and eviction thread, once per process.
+        """
+        if self._janitor_pid == os.getpid():
+            return
+
+        with self._janitor_lock:
+            if self._janitor_pid == os.getpid():
+                return
+
+            janitor = threading.Thread(target=self._janitor, name='LimitedDisk janitor')
+            janitor.daemon = True
+            janitor.start()
+
+            self._janitor_pid = os.getpid()
+
+            atexit.register(self._stop_janitor, janitor)
+
+    def _stop_janitor(self, janitor):
+        """ Ask the background thread for one last flush, and wait for it.
+        """
+        self._stopping = True
+        self._saved.set()
+        janitor.join(self.flush_interval)
+
+    def _janitor(self):
+        """ Flush last-read times and evict tiles, until Python exits.
+        """
+        db = connect(self.dbpath, timeout=30)
+
+        while not self._stopping:
+            self._saved.wait(self.flush_interval)
+
+            try:
+                self._flush(db)
+
+                if self._saved.is_set():
+                    self._saved.clear()
+                    self._evict(db)
+
+            except Exception, e:
+                # keep going, or last-read times would pile up unflushed.
+                logging.error('TileStache.Goodies.Caches.LimitedDisk janitor failed, will retry: %s', e)
+                db.rollback()
+
+    def flush(self):
+        """ Write pending last-read times, and evict tiles if saves asked for it.
+        
+            The background thread does this too, but it's a daemon thread
+            that doesn't get to finish in processes that skip exit handlers.
+        """
+        db = self._db()
+
+        try:
+            # this thread's connection autocommits, so each step gets a transaction.
+            db.execute('BEGIN')
+            self._flush(db)
+            db.commit()
+
+            if self._saved.is_set():
+                self._saved.clear()
+                db.execute('BEGIN')
+                self._evict(db)
+                db.commit()
+
+        except:
+            db.rollback()
+            raise
+
+    def _flush(self, db):
+        """ Write pending last-read times to the tiles table in one transaction.
+        """
+        with self._used_lock:
+            used, self._used = self._used, {}
+
+        if not used:
+            return
+
+        db.executemany('UPDATE tiles SET used=? WHERE path=?',
+                       [(when, path) for (path, when) in used.items()])
+        db.commit()
+
+        logging.debug('TileStache.Goodies.Caches.LimitedDisk flushed %d last-read times', len(used))
+
+    def _evict(self, db):
+        """ Remove least-recently-used tiles until the cache is within its limit.
+        """
+        row = db.execute('SELECT SUM(size) FROM tiles').fetchone()
+
+        if not row or row[0] <= self.limit:
+            return
+
+        over = row[0] - self.limit
+
+        while over > 0:
+            # evicted rows are deleted, so each page starts from the top again.
+            page = db.execute('SELECT path, size FROM tiles ORDER BY used ASC LIMIT 100').fetchall()
+
+            if not page:
+                break
+
+            for (path, size) in page:
+                if over <= 0:
+                    break
+
+                db.execute('DELETE FROM tiles WHERE path=?', (path, ))
+                self._remove(path)
+                over -= size
+
+                logging.debug('TileStache.Goodies.Caches.LimitedDisk evicted %s', path)
+
+        db.commit()
+
     def _filepath(self, layer, coord, format):
         """
         """
@@ -79,34 +227,30 @@ class Cache:
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
         
-            Returns nothing, but (TODO) blocks until the lock has been acquired.
+            Returns nothing, but blocks until the lock has been acquired.
             Lock is implemented as a row in the "locks" table.
         """
-        sys.stderr.write('lock %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
+        logging.debug('TileStache.Goodies.Caches.LimitedDisk lock %d/%d/%d, %s', coord.zoom, coord.column, coord.row, format)
 
         due = time.time() + layer.stale_lock_timeout
+        db = self._db()
         
         while True:
             if time.time() > due:
                 # someone left the door locked.
-                sys.stderr.write('...force %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
+                logging.debug('TileStache.Goodies.Caches.LimitedDisk force %d/%d/%d, %s', coord.zoom, coord.column, coord.row, format)
                 self.unlock(layer, coord, format)
             
             # try to acquire a lock, repeating if necessary.
-            db = connect(self.dbpath, isolation_level='EXCLUSIVE').cursor()
-
             try:
                 db.execute("""INSERT INTO locks
                               (row, column, zoom, format)
                               VALUES (?, ?, ?, ?)""",
                            (coord.row, coord.column, coord.zoom, format))
             except IntegrityError:
-                db.connection.close()
                 time.sleep(.2)
                 continue
             else:
-                db.connection.commit()
-                db.connection.close()
                 break
 
     def unlock(self, layer, coord, format):
@@ -114,46 +258,46 @@ class Cache:
 
             Lock is implemented as a row in the "locks" table.
         """
-        sys.stderr.write('unlock %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
+        logging.debug('TileStache.Goodies.Caches.LimitedDisk unlock %d/%d/%d, %s', coord.zoom, coord.column, coord.row, format)
 
-        db = connect(self.dbpath, isolation_level='EXCLUSIVE').cursor()
-        db.execute("""DELETE FROM locks
-                      WHERE row=? AND column=? AND zoom=? AND format=?""",
-                   (coord.row, coord.column, coord.zoom, format))
-        db.connection.commit()
-        db.connection.close()
+        self._db().execute("""DELETE FROM locks
+                              WHERE row=? AND column=? AND zoom=? AND format=?""",
+                           (coord.row, coord.column, coord.zoom, format))
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        # TODO: write me
-        raise NotImplementedError('LimitedDisk Cache does not yet implement the .remove() method.')
+        path = self._filepath(layer, coord, format)
+
+        logging.debug('TileStache.Goodies.Caches.LimitedDisk remove %s', path)
+
+        with self._used_lock:
+            self._used.pop(path, None)
+
+        self._db().execute('DELETE FROM tiles WHERE path=?', (path, ))
+        self._remove(path)
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
         
-            If found, update the used column in the tiles table with current time.
+            If found, note the current time as its last-read time,
+            to be flushed to the tiles table later.
         """
-        sys.stderr.write('read %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
-
         path = self._filepath(layer, coord, format)
         fullpath = pathjoin(self.cachepath, path)
         
         if exists(fullpath):
             body = open(fullpath, 'r').read()
 
-            sys.stderr.write('...hit %s, set used=%d' % (path, time.time()))
+            logging.debug('TileStache.Goodies.Caches.LimitedDisk read hit %s', path)
 
-            db = connect(self.dbpath).cursor()
-            db.execute("""UPDATE tiles
-                          SET used=?
-                          WHERE path=?""",
-                       (int(time.time()), path))
-            db.connection.commit()
-            db.connection.close()
+            with self._used_lock:
+                self._used[path] = time.time()
+
+            self._start_janitor()
         
         else:
-            sys.stderr.write('...miss')
+            logging.debug('TileStache.Goodies.Caches.LimitedDisk read miss %s', path)
             body = None
 
         return body
@@ -196,49 +340,36 @@ class Cache:
         return size
 
     def _remove(self, path):
-        """
+        """ Actually remove the file from the cache directory.
+        
+            Files that are already gone are fine, e.g. after a remove()
+            by another process between an eviction's select and delete.
         """
         fullpath = pathjoin(self.cachepath, path)
 
-        os.unlink(fullpath)
+        try:
+            os.unlink(fullpath)
+        except OSError, e:
+            # errno=2 means that the file does not exist, which is fine
+            if e.errno != 2:
+                raise
     
     def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+
+            Eviction of least-recently-used tiles happens later,
+            in the background thread.
         """
-        """
-        sys.stderr.write('save %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
-        
         path = self._filepath(layer, coord, format)
         size = self._write(body, path, format)
 
-        db = connect(self.dbpath).cursor()
+        logging.debug('TileStache.Goodies.Caches.LimitedDisk save %s, %d bytes', path, size)
         
-        try:
-            db.execute("""INSERT INTO tiles
-                          (size, used, path)
-                          VALUES (?, ?, ?)""",
-                       (size, int(time.time()), path))
-        except IntegrityError:
-            db.execute("""UPDATE tiles
-                          SET size=?, used=?
-                          WHERE path=?""",
-                       (size, int(time.time()), path))
+        self._db().execute("""REPLACE INTO tiles
+                              (size, used, path)
+                              VALUES (?, ?, ?)""",
+                           (size, time.time(), path))
         
-        row = db.execute('SELECT SUM(size) FROM tiles').fetchone()
+        self._saved.set()
+        self._start_janitor()
         
-        if row and (row[0] > self.limit):
-            over = row[0] - self.limit
-            
-            while over > 0:
-                row = db.execute('SELECT path, size FROM tiles ORDER BY used ASC LIMIT 1').fetchone()
-                
-                if row is None:
-                    break
-
-                path, size = row
-                db.execute('DELETE FROM tiles WHERE path=?', (path, ))
-                self._remove(path)
-                over -= size
-                sys.stderr.write('delete ' + path)
-        
-        db.connection.commit()
-        db.connection.close()
@@ -35,15 +35,37 @@ class Provider (ImageProvider):
         """ Initialize Cascadenik provider with layer and mapfile.
         """
         self.workdir = workdir or gettempdir()
-        self.mapnik = None
 
         ImageProvider.__init__(self, layer, mapfile, fonts)
-
-    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
-        """ Mostly hand off functionality to Mapnik.ImageProvider.renderArea()
-        """
-        if self.mapnik is None:
-            self.mapnik = mapnik.Map(0, 0)
-            load_map(self.mapnik, str(self.mapfile), self.workdir, cache_dir=self.workdir)
         
-        return ImageProvider.renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom)
+        # Mapnik.ImageProvider.renderArea() loads maps with this.
+        self.map_loader = MMLLoader(self.workdir)
+
+class MMLLoader:
+    """ Loader of Cascadenik maps for a Mapnik map pool.
+    
+        Map pools are shared by loader, so loaders for the same working
+        directory are equal and a reloaded configuration gets the same pool.
+    """
+    def __init__(self, workdir):
+        self.workdir = workdir
+    
+    def __call__(self, mapfile):
+        return get_mmlMap(mapfile, self.workdir)
+    
+    def __eq__(self, other):
+        return isinstance(other, MMLLoader) and other.workdir == self.workdir
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash((MMLLoader, self.workdir))
+
+def get_mmlMap(mapfile, workdir):
+    """ Get a new mapnik.Map instance for a Cascadenik MML file.
+    """
+    mmap = mapnik.Map(0, 0)
+    load_map(mmap, str(mapfile), workdir, cache_dir=workdir)
+    
+    return mmap
@@ -34,26 +34,30 @@ if layer_id is not set in the layer or the provider config then it will not be s
 import json
 import TileStache
 from TileStache.Core import KnownUnknown
+from TileStache.Mapnik import decode_grid, encode_grid
+
+try:
+	import numpy
+except ImportError:
+	# can still build documentation
+	pass
 
 class Provider:
 	
 	def __init__(self, layer, stack, layer_id=None, wrapper=None):
-
-		#Set up result storage
-		self.resultGrid = []
-		self.gridKeys = []
-		self.gridData = {}
-		
 		self.layer = layer
 		self.stack = stack
 		self.layer_id = layer_id
 		self.wrapper = wrapper
 	
 	def renderTile(self, width, height, srs, coord):
-	
+		
+		#Set up result storage, local to each request
+		result = Result()
+		
 		for l in self.stack:
-			self.addLayer(l, coord)
-		return SaveableResponse(self.writeResult())
+			self.addLayer(result, l, coord)
+		return SaveableResponse(self.writeResult(result))
 
 	def getTypeByExtension(self, extension):
 		""" Get mime-type and format by file extension.
@@ -64,137 +68,128 @@ class Provider:
 		
 		return 'text/json', 'JSON'
 
-	def addLayer( self, layerDef, coord ):
+	def addLayer( self, result, layerDef, coord ):
 		
-		mime, layer = TileStache.getTile(self.layer.config.layers[layerDef['src']], coord, 'JSON')[1]
-#		raise KnownUnknown(layer)
+		mime, layer = TileStache.getTile(self.layer.config.layers[layerDef['src']], coord, 'JSON')
 		if layerDef['wrapper'] == None:
 			layer = json.loads(layer)
 		else:
 			layer = json.loads(layer[(len(layerDef['wrapper'])+1):-1]) #Strip "Wrapper(...)"
 		
-		gridSize = len(layer['grid'])
+		result.addLayer(layer, layerDef['layer_id'], self.layer_id)
 
-		#init resultGrid based on given layers (if required)
-		if len(self.resultGrid) == 0:
-			for i in xrange(gridSize):
-				self.resultGrid.append([])
-				for j in xrange(gridSize):
-					self.resultGrid[i].append(-1)
+	def writeResult( self, result ):
+		finalKeys, finalGrid = result.finalGrid()
 	
-		keys = layer['keys']
-		
-		keyRemap = {}
-		for k in keys:
-			if k in self.gridKeys:
-				for ext in xrange(ord('a'), ord('z')+1):
-					if not k+chr(ext) in self.gridKeys:
-						keyRemap[k] = (k+chr(ext))
-						break
-				if not k in keyRemap:
-					raise Error("Couldn't remap")
-		
-		addedKeys = [] #FIXME: HashSet<string>?
-		
-		for y in xrange(gridSize):
-			line = layer['grid'][y]
-			for x in xrange(gridSize):
-				idNo = self.decodeId(line[x])
-				
-				if keys[idNo] == "":
-					continue
-				
-				key = keys[idNo]
-				if keys[idNo] in keyRemap:
-					key = keyRemap[keys[idNo]]
-				
-				if not key in addedKeys:
-					self.gridKeys.append(key)
-					addedKeys.append(key)
-					if layerDef['layer_id'] != None and self.layer_id != None: #Add layer name attribute
-						layer['data'][keys[idNo]][self.layer_id] = layerDef['layer_id']
-					self.gridData[key] = layer['data'][keys[idNo]]
-						
-						
-				newId = self.gridKeys.index(key)
-				
-				self.resultGrid[x][y] = newId
-
-	def writeResult( self ):
-		gridSize = len(self.resultGrid)
-	
-		finalKeys = []
-		finalData = {}
-		finalGrid = []
-		for i in xrange(gridSize):
-			finalGrid.append("")
-		
-		finalIdCounter = 0
-		idToFinalId = {}
-		
-		for y in xrange(gridSize):
-			for x in xrange(gridSize):
-				id = self.resultGrid[x][y]
-				
-				if not id in idToFinalId:
-					idToFinalId[id] = finalIdCounter
-					finalIdCounter = finalIdCounter + 1
-					
-					if id == -1:
-						finalKeys.append("")
-					else:
-						finalKeys.append(self.gridKeys[id])
-						finalData[self.gridKeys[id]] = self.gridData[self.gridKeys[id]]
-				
-				finalId = idToFinalId[id]
-				finalGrid[y] = finalGrid[y] + self.encodeId(finalId)
-	
-		result = "{\"keys\": ["
+		output = "{\"keys\": ["
 		for i in xrange(len(finalKeys)):
 			if i > 0:
-				result += ","
-			result += "\"" + finalKeys[i] + "\""
+				output += ","
+			output += "\"" + finalKeys[i] + "\""
 	
-		result += "], \"data\": { "
+		output += "], \"data\": { "
 		
 		first = True
-		for entry in self.gridData:
+		for entry in result.gridData:
 			if not first:
-				result += ","
+				output += ","
 			first = False
-			result += "\"" + entry + "\": " + json.dumps(self.gridData[entry]) + ""
+			output += "\"" + entry + "\": " + json.dumps(result.gridData[entry]) + ""
 		
-		result += "}, \"grid\": ["
+		output += "}, \"grid\": ["
 		
-		for i in xrange(gridSize):
+		for i in xrange(len(finalGrid)):
 			line = finalGrid[i]
-			result += json.dumps(line)
-			if i < gridSize - 1:
-				result += ","
+			output += json.dumps(line)
+			if i < len(finalGrid) - 1:
+				output += ","
 		
 		if self.wrapper == None:
-			return result + "]}"
+			return output + "]}"
 		else:
-			return self.wrapper + "(" + result + "]})"
-
-	def encodeId ( self, id ):
-		id += 32
-		if id >= 34:
-			id = id + 1
-		if id >= 92:
-			id = id + 1
-		if id > 127:
-			return unichr(id)
-		return chr(id)
+			return self.wrapper + "(" + output + "]})"
 
-	def decodeId( self, id ):
-		id = ord(id)
-		
-		if id >= 93:
-			id = id - 1
-		if id >= 35:
-			id = id - 1
-		return id - 32
+class Result:
+	""" Composited grid of one request, built up one layer at a time.
+	
+		Pixels are kept in a NumPy array of indexes into gridKeys, or -1 for
+		empty pixels. Keys from later layers that are already taken by earlier
+		ones are renamed with a letter suffix, "a" through "z".
+	"""
+	def __init__(self):
+		self.resultGrid = None
+		self.gridKeys = []
+		self.gridIndexes = {}
+		self.gridData = {}
+	
+	def addLayer( self, layer, layerName=None, layerKey=None ):
+		""" Add a decoded UTFGrid layer on top of the grid so far.
+		
+			If layerName and layerKey are both given, layerName is added
+			to each data object of the layer, keyed by layerKey.
+		"""
+		keys = layer['keys']
+		ids = decode_grid(layer['grid'])
+		
+		#init resultGrid based on given layers (if required)
+		if self.resultGrid is None:
+			self.resultGrid = numpy.zeros(ids.shape, dtype=numpy.int32) - 1
+		
+		keyRemap = {}
+		for k in keys:
+			if k in self.gridIndexes:
+				for ext in xrange(ord('a'), ord('z')+1):
+					if not k+chr(ext) in self.gridIndexes:
+						keyRemap[k] = (k+chr(ext))
+						break
+				if not k in keyRemap:
+					raise KnownUnknown("UtfGridComposite couldn't remap key %s" % json.dumps(k))
+		
+		#keys are added in order of their first pixel, row by row
+		present, firstPixels = numpy.unique(ids, return_index=True)
+		present = present[numpy.argsort(firstPixels)]
+		
+		idToIndex = numpy.zeros(len(keys), dtype=numpy.int32) - 1
+		addedKeys = set()
+		
+		for idNo in present.tolist():
+			if keys[idNo] == "":
+				continue
+			
+			key = keyRemap.get(keys[idNo], keys[idNo])
+			
+			if not key in addedKeys:
+				self.gridIndexes[key] = len(self.gridKeys)
+				self.gridKeys.append(key)
+				addedKeys.add(key)
+				if layerName != None and layerKey != None: #Add layer name attribute
+					layer['data'][keys[idNo]][layerKey] = layerName
+				self.gridData[key] = layer['data'][keys[idNo]]
+			
+			idToIndex[idNo] = self.gridIndexes[key]
+		
+		newIds = idToIndex[ids]
+		self.resultGrid = numpy.where(newIds == -1, self.resultGrid, newIds)
+	
+	def finalGrid( self ):
+		""" Return a list of keys and a list of encoded grid rows.
+		
+			Keys are numbered in order of their first pixel, row by row,
+			with "" for empty pixels.
+		"""
+		if self.resultGrid is None:
+			return [], []
+		
+		present, firstPixels, inverse = numpy.unique(self.resultGrid, return_index=True, return_inverse=True)
+		order = numpy.argsort(firstPixels)
+		
+		finalIds = numpy.zeros(len(present), dtype=numpy.int32)
+		finalIds[order] = numpy.arange(len(present))
+		
+		finalKeys = ["" if id == -1 else self.gridKeys[id] for id in present[order].tolist()]
+		finalGrid = encode_grid(finalIds[inverse].reshape(self.resultGrid.shape))
+		
+		return finalKeys, finalGrid
 
 
 class SaveableResponse:
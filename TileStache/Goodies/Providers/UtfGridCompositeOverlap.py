@@ -1,25 +1,29 @@
 import json
 import TileStache
 from TileStache.Core import KnownUnknown
+from TileStache.Mapnik import decode_grid, encode_grid
+
+try:
+  import numpy
+except ImportError:
+  # can still build documentation
+  pass
 
 class Provider:
   
   def __init__(self, layer, stack, layer_id=None, wrapper=None):
-    #Set up result storage
-    self.resultGrid = []
-    self.gridKeys = []
-    self.gridData = {}
-    
     self.layer = layer
     self.stack = stack
     self.layer_id = layer_id
     self.wrapper = wrapper
-    self.curId = 0
 
   def renderTile(self, width, height, srs, coord):
+    # Result storage is local to each request.
+    result = dict(grid=None, keys=[], data={})
+
     for l in self.stack:
-      self.addLayer(l, coord)
-    return SaveableResponse(self.writeResult())
+      self.addLayer(result, l, coord)
+    return SaveableResponse(self.writeResult(result))
 
   def getTypeByExtension(self, extension):
     """ Get mime-type and format by file extension.
@@ -30,7 +34,7 @@ class Provider:
     
     return 'text/json', 'JSON'
 
-  def addLayer( self, layerDef, coord ):
+  def addLayer( self, result, layerDef, coord ):
     layer = TileStache.getTile(self.layer.config.layers[layerDef['src']], coord, 'JSON')[1]
 
     if layerDef['wrapper'] == None:
@@ -39,78 +43,61 @@ class Provider:
       # Strip "Wrapper(...)"
       layer = json.loads(layer[(len(layerDef['wrapper'])+1):-1])
 
-    grid_size = len(layer['grid'])
-
-    # Init resultGrid based on given layers (if required)
-    if len(self.resultGrid) == 0:
-      for i in xrange(grid_size):
-        self.resultGrid.append([])
-        for j in xrange(grid_size):
-          self.resultGrid[i].append(-1)
-
     layer_keys = layer['keys']
+    src_ids = decode_grid(layer['grid'])
 
-    for y in xrange(grid_size):
-      line = layer['grid'][y]
-      for x in xrange(grid_size):
-        src_id = self.decodeId(line[x])
-        
-        if layer_keys[src_id] == "":
-          continue
-
-        src_key = layer_keys[src_id]
+    # Init result grid based on given layers (if required)
+    if result['grid'] is None:
+      result['grid'] = numpy.zeros(src_ids.shape, dtype=numpy.int32) - 1
 
-        # Add layer name attribute
-        if layerDef['layer_id'] != None and self.layer_id != None:
-          layer['data'][src_key][self.layer_id] = layerDef['layer_id']
+    grid = result['grid']
+    opaque = numpy.array([key != "" for key in layer_keys], dtype=bool)[src_ids]
 
-        if self.resultGrid[x][y] == -1:
-          cur_id = self.curId
-          self.curId += 1
-          cur_key = json.dumps(cur_id)
+    # Add layer name attribute
+    if layerDef['layer_id'] != None and self.layer_id != None:
+      for src_id in numpy.unique(src_ids[opaque]):
+        layer['data'][layer_keys[src_id]][self.layer_id] = layerDef['layer_id']
 
-          # Set key for current point.
-          self.resultGrid[x][y] = self.encodeId(cur_id)
-          self.gridKeys.insert(cur_id + 1, cur_key)
+    # Set keys for new points in row order, and initialize data buckets.
+    new = opaque & (grid == -1)
+    first_id, new_count = len(result['keys']), int(new.sum())
+    grid[new] = numpy.arange(first_id, first_id + new_count)
 
-          # Initialize data bucket.
-          self.gridData[cur_key] = []
+    for cur_id in xrange(first_id, first_id + new_count):
+      cur_key = json.dumps(cur_id)
+      result['keys'].append(cur_key)
+      result['data'][cur_key] = []
 
-        else:
-          cur_id = self.decodeId(self.resultGrid[x][y])
-          cur_key = json.dumps(cur_id)
+    for (cur_id, src_id) in zip(grid[opaque].tolist(), src_ids[opaque].tolist()):
+      result['data'][json.dumps(cur_id)].append(layer['data'][layer_keys[src_id]])
 
-        self.gridData[cur_key].append(layer['data'][src_key])
+  def writeResult( self, result ):
+    grid_keys, grid_data, result_grid = result['keys'], result['data'], result['grid']
 
-  def writeResult( self ):
     result = "{\"keys\": ["
-    for i in xrange(len(self.gridKeys)):
+    for i in xrange(len(grid_keys)):
       if i > 0:
         result += ","
-      result += "\"" + self.gridKeys[i] + "\""
+      result += "\"" + grid_keys[i] + "\""
   
     result += "], \"data\": { "
     
     first = True
-    for key in self.gridData:
+    for key in grid_data:
       if not first:
         result += ","
       first = False
-      result += "\"" + key + "\": " + json.dumps(self.gridData[key]) + ""
+      result += "\"" + key + "\": " + json.dumps(grid_data[key]) + ""
     
     result += "}, \"grid\": ["
     
-    grid_size = len(self.resultGrid)
-    first = True
-    for y in xrange(grid_size):
-      line = ""
-
-      for x in xrange(grid_size):
-        if self.resultGrid[x][y] == -1:
-          self.resultGrid[x][y] = ' '
-
-        line = line + self.resultGrid[x][y]
+    # Empty points are written as ' ', the character for the first key.
+    lines = []
+    if result_grid is not None:
+      lines = encode_grid(numpy.maximum(result_grid, 0))
 
+    first = True
+    for line in lines:
       if not first:
         result += ","
       first = False
@@ -122,25 +109,6 @@ class Provider:
     else:
       return self.wrapper + "(" + result + "]})"
 
-  def encodeId ( self, id ):
-    id += 32
-    if id >= 34:
-      id = id + 1
-    if id >= 92:
-      id = id + 1
-    if id > 127:
-      return unichr(id)
-    return chr(id)
-
-  def decodeId( self, id ):
-    id = ord(id)
-    
-    if id >= 93:
-      id = id - 1
-    if id >= 35:
-      id = id - 1
-    return id - 32
-
 
 class SaveableResponse:
   """ Wrapper class for JSON response that makes it behave like a PIL.Image object.
@@ -34,16 +34,175 @@ MBTiles provider parameters:
 
   tileset:
     Required local file path to MBTiles tileset file, a SQLite 3 database file.
+
+MBTiles can also be used as a normal read/write cache, for single-layer
+configurations or seeding. Only tiles in the tileset format are stored,
+other formats are quietly skipped.
+
+Example configuration:
+
+  {
+    "cache":
+    {
+      "name": "MBTiles",
+      "filename": "collection.mbtiles",
+      "format": "png"
+    },
+    "layers": { ... }
+  }
+
+MBTiles cache parameters:
+
+  filename:
+    Required local file path to MBTiles tileset file. If it doesn't exist,
+    it will be created.
+
+  format:
+    Optional tile format for a newly-created tileset, one of "png", "jpg",
+    "webp" or "json". Defaults to "png".
+
+  name:
+    Optional plain-english name for a newly-created tileset.
+
+  batch size:
+    Optional number of saved tiles to group into a single transaction.
+    Other processes can't write to the tileset while a batch is open, so
+    this is most useful for a single seeding process. Defaults to 1.
+
+  commit interval:
+    Optional number of seconds after which a partial batch is committed
+    anyway, so other readers can see it. Defaults to 1.
+
+  deduplicate:
+    Optional boolean flag to create a new tileset with separate "map" and
+    "images" tables, so identical tiles are stored just once. Existing
+    tilesets keep their layout. Defaults to false.
+
+Connections to tileset files are held open per thread and per process,
+and the tileset format is read from metadata once. Cache tilesets are
+switched to write-ahead log (WAL) mode so readers can proceed alongside
+the writer.
 """
+import os
+import atexit
+import logging
+import threading
+
 from urlparse import urlparse, urljoin
 from os.path import exists
+from time import time
+from hashlib import md5
 
 # Heroku is missing standard python's sqlite3 package, so this will ImportError.
 from sqlite3 import connect as _connect
 
 from ModestMaps.Core import Coordinate
 
-def create_tileset(filename, name, type, version, description, format, bounds=None):
+from .Core import KnownUnknown
+
+_local = threading.local()
+_connections, _connections_lock = {}, threading.Lock()
+_formats, _layouts = {}, {}
+
+def _connection(filename):
+    """ Return a persistent connection to a tileset file.
+    
+        Connections are held open per thread and per process; a forked
+        child process will open its own instead of sharing its parent's.
+        A tileset file replaced by a new file gets a new connection, and
+        connections left by finished threads are committed and closed.
+    """
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid, _local.connections = os.getpid(), {}
+    
+    inode = _file_key(filename)[1]
+    
+    if filename in _local.connections and _local.connections[filename][0] != inode:
+        _close(_local.connections.pop(filename)[1])
+    
+    if filename not in _local.connections:
+        # check_same_thread is off so _commit_all() can flush at exit.
+        db = _connect(filename, timeout=30, check_same_thread=False)
+        db.text_factory = bytes
+        
+        with _connections_lock:
+            _reap_connections()
+            _connections[id(db)] = os.getpid(), threading.current_thread(), db
+        
+        _local.connections[filename] = inode or _file_key(filename)[1], db
+    
+    return _local.connections[filename][1]
+
+def _close(db):
+    """ Commit and close a connection that won't be used again.
+    """
+    with _connections_lock:
+        _connections.pop(id(db), None)
+    
+    db.commit()
+    db.close()
+
+def _reap_connections():
+    """ Commit and close connections whose threads have finished.
+    
+        Call with _connections_lock held.
+    """
+    for (key, (pid, thread, db)) in _connections.items():
+        if pid == os.getpid() and not thread.is_alive():
+            del _connections[key]
+            
+            try:
+                db.commit()
+                db.close()
+            except Exception, e:
+                logging.warning('TileStache.MBTiles connection failed to commit: %s', e)
+
+@atexit.register
+def _commit_all():
+    """ Commit any transactions left open by batched cache writes.
+    """
+    with _connections_lock:
+        _reap_connections()
+        
+        for (pid, thread, db) in _connections.values():
+            if pid == os.getpid():
+                db.commit()
+
+def _file_key(filename):
+    """ Return a (filename, inode, mtime) tuple that changes if the file does.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return filename, None, None
+    
+    return filename, stat.st_ino, stat.st_mtime
+
+def _tileset_format(filename):
+    """ Return the format value from tileset metadata, read once per file version.
+    """
+    key = _file_key(filename)
+    
+    if _formats.get(filename, (None, None))[0] != key:
+        db = _connection(filename)
+        format = db.execute("SELECT value FROM metadata WHERE name='format'").fetchone()
+        _formats[filename] = key, format and format[0] or None
+    
+    return _formats[filename][1]
+
+def _tileset_deduplicated(filename):
+    """ Return true if the tileset has the deduplicated map and images layout.
+    """
+    key = _file_key(filename)
+    
+    if _layouts.get(filename, (None, None))[0] != key:
+        db = _connection(filename)
+        q = "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ('map', 'images')"
+        _layouts[filename] = key, db.execute(q).fetchone()[0] == 2
+    
+    return _layouts[filename][1]
+
+def create_tileset(filename, name, type, version, description, format, bounds=None, deduplicate=False):
     """ Create a tileset 1.1 with the given filename and metadata.
     
         From the specification:
@@ -64,7 +223,7 @@ def create_tileset(filename, name, type, version, description, format, bounds=No
             A description of the layer as plain text.
           
           format:
-            The image file format of the tile data: png or jpg or json
+            The image file format of the tile data: png or jpg or webp or json
         
         One row in metadata is suggested and, if provided, may enhance performance:
 
@@ -74,15 +233,31 @@ def create_tileset(filename, name, type, version, description, format, bounds=No
             WGS:84 - latitude and longitude values, in the OpenLayers Bounds
             format - left, bottom, right, top. Example of the full earth:
             -180.0,-85,180,85.
+        
+        If deduplicate is true, tiles are stored in a "map" table from z/x/y
+        to tile_id and an "images" table of unique tile content keyed by
+        tile_id, with a "tiles" view on top for readers. Identical tiles,
+        such as empty ocean, are then stored just once.
     """
-    if format not in ('png', 'jpg',' json'):
-        raise Exception('Format must be one of "png" or "jpg" or "json", not "%s"' % format)
+    if format not in ('png', 'jpg', 'webp', 'json'):
+        raise Exception('Format must be one of "png" or "jpg" or "webp" or "json", not "%s"' % format)
     
     db = _connect(filename)
     
     db.execute('CREATE TABLE metadata (name TEXT, value TEXT, PRIMARY KEY (name))')
-    db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
-    db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
+    
+    if deduplicate:
+        db.execute('CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)')
+        db.execute('CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row)')
+        db.execute('CREATE INDEX map_tile_id ON map (tile_id)')
+        db.execute('CREATE TABLE images (tile_id TEXT, tile_data BLOB, PRIMARY KEY (tile_id))')
+        db.execute("""CREATE VIEW tiles AS
+                      SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                             map.tile_row AS tile_row, images.tile_data AS tile_data
+                      FROM map JOIN images ON images.tile_id = map.tile_id""")
+    else:
+        db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+        db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
     
     db.execute('INSERT INTO metadata VALUES (?, ?)', ('name', name))
     db.execute('INSERT INTO metadata VALUES (?, ?)', ('type', type))
@@ -103,8 +278,7 @@ def tileset_exists(filename):
         return False
     
     # this always works
-    db = _connect(filename)
-    db.text_factory = bytes
+    db = _connection(filename)
     
     try:
         db.execute('SELECT name, value FROM metadata LIMIT 1')
@@ -122,8 +296,7 @@ def tileset_info(filename):
     if not tileset_exists(filename):
         return None
     
-    db = _connect(filename)
-    db.text_factory = bytes
+    db = _connection(filename)
     
     info = []
     
@@ -135,58 +308,126 @@ def tileset_info(filename):
 
 def list_tiles(filename):
     """ Get a list of tile coordinates.
+    
+        See iter_tiles() for large tilesets.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    return list(iter_tiles(filename))
+
+def iter_tiles(filename):
+    """ Generate a stream of tile coordinates, without holding them all in memory.
+    
+        Rows are fetched from a cursor in batches as they're needed, in the
+        same zoom, column, row order every time so that a stream's offsets can
+        be checkpointed and resumed.
+    """
+    db = _connection(filename)
+    tiles = db.execute('SELECT tile_row, tile_column, zoom_level FROM tiles ORDER BY zoom_level, tile_column, tile_row')
     
-    tiles = db.execute('SELECT tile_row, tile_column, zoom_level FROM tiles')
-    tiles = (((2**z - 1) - y, x, z) for (y, x, z) in tiles) # Hello, Paul Ramsey.
-    tiles = [Coordinate(row, column, zoom) for (row, column, zoom) in tiles]
+    while True:
+        rows = tiles.fetchmany(1000)
+        
+        if not rows:
+            break
+        
+        for (y, x, z) in rows:
+            yield Coordinate((2**z - 1) - y, x, z) # Hello, Paul Ramsey.
+
+def count_tiles(filename):
+    """ Get the number of tiles in a tileset.
+    """
+    db = _connection(filename)
     
-    return tiles
+    return db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
 
 def get_tile(filename, coord):
     """ Retrieve the mime-type and raw content of a tile by coordinate.
     
         If the tile does not exist, None is returned for the content.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    db = _connection(filename)
     
-    formats = {'png': 'image/png', 'jpg': 'image/jpeg', 'json': 'application/json', None: None}
-    format = db.execute("SELECT value FROM metadata WHERE name='format'").fetchone()
-    format = format and format[0] or None
-    mime_type = formats[format]
+    formats = {'png': 'image/png', 'jpg': 'image/jpeg', 'webp': 'image/webp', 'json': 'application/json', None: None}
+    mime_type = formats[_tileset_format(filename)]
     
     tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
     q = 'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
     content = db.execute(q, (coord.zoom, coord.column, tile_row)).fetchone()
-    content = content and content[0] or None
+    content = content and str(content[0]) or None
 
     return mime_type, content
 
 def delete_tile(filename, coord):
     """ Delete a tile by coordinate.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    db = _connection(filename)
+    _delete_tile(db, coord, _tileset_deduplicated(filename))
+    db.commit()
+
+def _delete_tile(db, coord, deduplicated):
+    """ Delete a tile by coordinate in an open tileset, without committing.
     
+        In a deduplicated tileset the map entry is deleted, and the image
+        too unless it's still in use by other tiles.
+    """
     tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
-    db.execute(q, (coord.zoom, coord.column, tile_row))
+    
+    if deduplicated:
+        tile_id = _map_tile_id(db, coord.zoom, coord.column, tile_row)
+        q = 'DELETE FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+        db.execute(q, (coord.zoom, coord.column, tile_row))
+        _delete_image(db, tile_id)
+    
+    else:
+        q = 'DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+        db.execute(q, (coord.zoom, coord.column, tile_row))
 
-def put_tile(filename, coord, content):
+def _map_tile_id(db, zoom, column, tile_row):
+    """ Return the tile_id of a map entry in a deduplicated tileset, or None.
     """
+    q = 'SELECT tile_id FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+    row = db.execute(q, (zoom, column, tile_row)).fetchone()
+    
+    return row and row[0] or None
+
+def _delete_image(db, tile_id):
+    """ Delete an image from a deduplicated tileset if no map entry uses it.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    if tile_id is None:
+        return
     
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
-    db.execute(q, (coord.zoom, coord.column, tile_row, buffer(content)))
+    q = 'DELETE FROM images WHERE tile_id=? AND NOT EXISTS (SELECT 1 FROM map WHERE tile_id=?)'
+    db.execute(q, (tile_id, tile_id))
 
+def put_tile(filename, coord, content):
+    """ Write the raw content of a tile by coordinate.
+    """
+    db = _connection(filename)
+    _put_tile(db, coord, content, _tileset_deduplicated(filename))
     db.commit()
-    db.close()
+
+def _put_tile(db, coord, content, deduplicated):
+    """ Write a tile by coordinate to an open tileset, without committing.
+    
+        In a deduplicated tileset the content is stored by its MD5 hash,
+        and only written if no other tile has the same content. An image
+        replaced by different content is deleted if no other tile uses it.
+    """
+    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+    
+    if deduplicated:
+        tile_id = md5(content).hexdigest()
+        old_tile_id = _map_tile_id(db, coord.zoom, coord.column, tile_row)
+        
+        db.execute('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)', (tile_id, buffer(content)))
+        q = 'REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)'
+        db.execute(q, (coord.zoom, coord.column, tile_row, tile_id))
+        
+        if old_tile_id != tile_id:
+            _delete_image(db, old_tile_id)
+    
+    else:
+        q = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
+        db.execute(q, (coord.zoom, coord.column, tile_row, buffer(content)))
 
 class Provider:
     """ MBTiles provider.
@@ -215,13 +456,13 @@ class Provider:
         """ Retrieve a single tile, return a TileResponse instance.
         """
         mime_type, content = get_tile(self.tileset, coord)
-        formats = {'image/png': 'PNG', 'image/jpeg': 'JPEG', 'application/json': 'JSON', None: None}
+        formats = {'image/png': 'PNG', 'image/jpeg': 'JPEG', 'image/webp': 'WEBP', 'application/json': 'JSON', None: None}
         return TileResponse(formats[mime_type], content)
 
     def getTypeByExtension(self, extension):
         """ Get mime-type and format by file extension.
         
-            This only accepts "png" or "jpg" or "json".
+            This only accepts "png" or "jpg" or "webp" or "json".
         """
         if extension.lower() == 'json':
             return 'application/json', 'JSON'
@@ -231,9 +472,12 @@ class Provider:
 
         elif extension.lower() == 'jpg':
             return 'image/jpg', 'JPEG'
+
+        elif extension.lower() == 'webp':
+            return 'image/webp', 'WEBP'
         
         else:
-            raise KnownUnknown('MBTiles only makes .png and .jpg and .json tiles, not "%s"' % extension)
+            raise KnownUnknown('MBTiles only makes .png and .jpg and .webp and .json tiles, not "%s"' % extension)
 
 class TileResponse:
     """ Wrapper class for tile response that makes it behave like a PIL.Image object.
@@ -241,7 +485,7 @@ class TileResponse:
         TileStache.getTile() expects to be able to save one of these to a buffer.
         
         Constructor arguments:
-        - format: 'PNG' or 'JPEG'.
+        - format: 'PNG', 'JPEG' or 'WEBP'.
         - content: Raw response bytes.
     """
     def __init__(self, format, content):
@@ -255,40 +499,132 @@ class TileResponse:
         out.write(self.content)
 
 class Cache:
-    """ Cache provider for writing to MBTiles files.
+    """ Cache provider for reading and writing MBTiles files.
     
-        This class is not exposed as a normal cache provider for TileStache,
-        because MBTiles has restrictions on file formats that aren't quite
-        compatible with some of the looser assumptions made by TileStache.
-        Instead, this cache provider is provided for use with the script
+        Available as the "MBTiles" cache; see module documentation for
+        explanation of constructor arguments. Also used by the script
         tilestache-seed.py, which can be called with --to-mbtiles option
         to write cached tiles to a new tileset.
+        
+        MBTiles has restrictions on file formats that aren't quite compatible
+        with some of the looser assumptions made by TileStache, so tiles in
+        formats other than the tileset's own are not stored.
+        
+        Saved tiles can be batched into transactions, committed after every
+        batch_size tiles or commit_interval seconds, on flush(), and when
+        Python exits. Batches hold the tileset's write lock, so other processes
+        wait for them; the default batch_size of 1 commits every tile right away.
     """
-    def __init__(self, filename, format, name):
+    def __init__(self, filename, format='png', name='', batch_size=1, commit_interval=1, deduplicate=False):
         """
         """
         self.filename = filename
+        self.batch_size = int(batch_size)
+        self.commit_interval = float(commit_interval)
         
         if not tileset_exists(filename):
-            create_tileset(filename, name, 'baselayer', '0', '', format.lower())
+            create_tileset(filename, name, 'baselayer', '0', '', format.lower(), deduplicate=deduplicate)
+        
+        self.deduplicated = _tileset_deduplicated(filename)
+        
+        db = _connection(filename)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        
+        if self.deduplicated:
+            # finds images still in use when tiles are deleted or replaced.
+            db.execute('CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id)')
+            db.commit()
+        
+        self.format = {'png': 'PNG', 'jpg': 'JPEG', 'webp': 'WEBP', 'json': 'JSON'}.get(_tileset_format(filename))
+        
+        # pending writes are counted per thread, like connections.
+        self._local = threading.local()
+    
+    def _is_stored(self, format):
+        """ Return true if tiles in this format belong in the tileset.
+        """
+        if self.format == 'JSON':
+            # GeoJSON, TopoJSON and friends all go in a json tileset.
+            return 'JSON' in format.upper()
+        
+        return self.format is None or format.upper() == self.format
+    
+    def _commit(self, db, pending=0):
+        """ Add to the count of pending writes, and commit if a batch is due.
+        """
+        local = self._local
+        
+        if getattr(local, 'pending', None) is None:
+            local.pending, local.since = 0, time()
+        
+        local.pending += pending
+        
+        if local.pending == 0:
+            local.since = time()
+        
+        elif local.pending >= self.batch_size or time() - local.since > self.commit_interval:
+            db.commit()
+            local.pending, local.since = 0, time()
+    
+    def flush(self):
+        """ Commit this thread's batch of writes now, and any left by finished threads.
+        """
+        _connection(self.filename).commit()
+        
+        with _connections_lock:
+            _reap_connections()
+        
+        self._local.pending, self._local.since = 0, time()
     
     def lock(self, layer, coord, format):
         return
     
     def unlock(self, layer, coord, format):
-        return
+        """ Commit a partial batch if it's been waiting too long.
+        """
+        self._commit(_connection(self.filename))
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        delete_tile(self.filename, coord)
+        if not self._is_stored(format):
+            return
+        
+        db = _connection(self.filename)
+        _delete_tile(db, coord, self.deduplicated)
+        self._commit(db, 1)
+        
+    def remove_many(self, layer, coords, format):
+        """ Remove many tiles from the tileset, in one transaction.
+        """
+        if not self._is_stored(format):
+            return
+        
+        db = _connection(self.filename)
+        
+        for coord in coords:
+            _delete_tile(db, coord, self.deduplicated)
+        
+        # commits any pending batch of writes along with it.
+        db.commit()
+        self._local.pending, self._local.since = 0, time()
         
     def read(self, layer, coord, format):
         """ Return raw tile content from tileset.
         """
+        if not self._is_stored(format):
+            return None
+        
         return get_tile(self.filename, coord)[1]
     
     def save(self, body, layer, coord, format):
         """ Write raw tile content to tileset.
         """
-        put_tile(self.filename, coord, body)
+        if not self._is_stored(format):
+            logging.debug('TileStache.MBTiles.Cache.save() skipped %s tile for %s tileset', format, self.format)
+            return
+        
+        db = _connection(self.filename)
+        _put_tile(db, coord, body, self.deduplicated)
+        self._commit(db, 1)
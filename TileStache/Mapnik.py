@@ -3,11 +3,33 @@
 ImageProvider is known as "mapnik" in TileStache config, GridProvider is
 known as "mapnik grid". Both require Mapnik to be installed; Grid requires
 Mapnik 2.0.0 and above.
+
+Each process keeps a pool of loaded mapnik.Map instances for each mapfile,
+shared by every layer using it. A render checks out a Map of its own and
+returns it afterwards, so threads can render concurrently. Renders can
+still be serialized behind a single process-wide lock with the "global
+lock" provider parameter, for Mapnik builds that misbehave in threads.
+
+ImageProvider can also render in a pool of long-lived worker processes,
+with the "render workers" provider parameter. A crashed, hung or leaking
+render then takes down a worker instead of the web server, and is replaced
+by a new worker on the next render. Rendered pixels come back through
+memory shared with each worker, rather than being pickled over a pipe.
+
+Rendered images are handed to PIL without copying Mapnik's pixels again.
+With the "mapnik format" provider parameter, Mapnik can instead encode
+tiles itself, and metatiles are sliced into views of the same pixels.
 """
 from __future__ import absolute_import
 from time import time
 from os.path import exists
 from thread import allocate_lock
+from threading import Condition
+from contextlib import contextmanager
+from multiprocessing import Process, Pipe
+from multiprocessing.sharedctypes import RawArray
+from traceback import format_exc
+from ctypes import c_char, memmove
 from urlparse import urlparse, urljoin
 from itertools import count
 from glob import glob
@@ -29,6 +51,12 @@ except ImportError:
     # can still build documentation
     pass
 
+try:
+    import numpy
+except ImportError:
+    # can still build documentation
+    pass
+
 from TileStache.Core import KnownUnknown
 from TileStache.Geography import getProjectionByName
 
@@ -48,6 +76,267 @@ if 'mapnik' in locals():
 
 global_mapnik_lock = allocate_lock()
 
+class MapPool:
+    """ Pool of loaded mapnik.Map instances for a single mapfile.
+    
+        Maps are checked out for the length of one render and then checked
+        back in. New maps are loaded on demand up to the pool size, after
+        which renders wait for a map to be checked in. Maps are loaded with
+        get_mapnikMap(), or another function of a mapfile passed as loader.
+    """
+    def __init__(self, mapfile, size, loader=None):
+        self.mapfile = mapfile
+        self.size = size
+        self.loader = loader or get_mapnikMap
+        self.maps = []
+        self.loaded = 0
+        self.condition = Condition()
+    
+    def checkout(self):
+        """ Return an idle map, loading a new one if the pool isn't full.
+        """
+        with self.condition:
+            while not self.maps and self.loaded >= self.size:
+                self.condition.wait()
+            
+            if self.maps:
+                return self.maps.pop()
+            
+            self.loaded += 1
+        
+        start_time = time()
+        
+        try:
+            mmap = self.load()
+        except:
+            self.discard(None)
+            raise
+        
+        logging.debug('TileStache.Mapnik.MapPool.checkout() %.3f to load %s', time() - start_time, self.mapfile)
+        
+        return mmap
+    
+    def load(self):
+        """ Return a new map for the pool.
+        """
+        return self.loader(self.mapfile)
+    
+    def checkin(self, mmap):
+        """ Return a map to the pool for another render.
+        """
+        with self.condition:
+            self.maps.append(mmap)
+            self.condition.notify()
+    
+    def discard(self, mmap):
+        """ Forget a checked-out map, e.g. after a failed render.
+        """
+        with self.condition:
+            self.loaded -= 1
+            self.condition.notify()
+    
+    @contextmanager
+    def render_map(self, global_lock=False):
+        """ Check out a map for the length of a with block.
+        
+            Maps are discarded if the block raises an exception, in
+            case they're left in a bad state, and checked in otherwise.
+            With global_lock, the block also holds global_mapnik_lock.
+        """
+        if global_lock:
+            global_mapnik_lock.acquire()
+        
+        try:
+            mmap = self.checkout()
+            
+            try:
+                yield mmap
+            except:
+                self.discard(mmap)
+                raise
+            else:
+                self.checkin(mmap)
+        finally:
+            if global_lock:
+                global_mapnik_lock.release()
+
+class RenderWorker:
+    """ One long-lived process rendering a single mapfile.
+    
+        Jobs are sent over a pipe, and pixels come back in a buffer shared
+        with the process, big enough for one metatile. Larger renders come
+        back over the pipe instead.
+    """
+    def __init__(self, mapfile, buffer_size, loader):
+        self.shared = RawArray(c_char, buffer_size)
+        self.conn, child_conn = Pipe()
+        self.renders = 0
+        
+        self.process = Process(target=_render_worker, args=(mapfile, loader, child_conn, self.shared))
+        self.process.daemon = True
+        self.process.start()
+        
+        child_conn.close()
+    
+    def render(self, width, height, bbox, timeout):
+        """ Render an area, return a PIL image.
+        
+            Raise an exception if the worker fails, dies, or
+            takes longer than timeout seconds to respond.
+        """
+        self.renders += 1
+        self.conn.send((width, height, bbox))
+        
+        if not self.conn.poll(timeout):
+            raise Exception('Mapnik render worker %d timed out after %d seconds' % (self.process.pid, timeout))
+        
+        try:
+            kind, result = self.conn.recv()
+        except EOFError:
+            self.process.join(1)
+            raise Exception('Mapnik render worker %d died with exit code %s' % (self.process.pid, self.process.exitcode))
+        
+        if kind == 'error':
+            raise Exception('Mapnik render worker %d failed:\n%s' % (self.process.pid, result))
+        
+        elif kind == 'bytes':
+            return Image.frombuffer('RGBA', (width, height), result, 'raw', 'RGBA', 0, 1)
+        
+        # copy out of the shared buffer before it's used for another render.
+        shared = buffer(self.shared, 0, result)
+        return Image.frombuffer('RGBA', (width, height), shared, 'raw', 'RGBA', 0, 1).copy()
+    
+    def is_alive(self):
+        return self.process.is_alive()
+    
+    def stop(self):
+        """ Stop the worker process, forcibly if it doesn't stop itself.
+        """
+        try:
+            self.conn.send(None)
+        except IOError:
+            pass
+        
+        self.process.join(1)
+        
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        
+        self.conn.close()
+
+def _render_worker(mapfile, loader, conn, shared):
+    """ Render jobs from a connection until told to stop, in a worker process.
+    
+        Jobs are (width, height, bbox) tuples, and each is answered with
+        ('shared', length) for pixels in the shared buffer, ('bytes', pixels),
+        or ('error', traceback).
+    """
+    mmap = loader(mapfile)
+    
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        
+        if job is None:
+            break
+        
+        try:
+            width, height, bbox = job
+            
+            mmap.width = width
+            mmap.height = height
+            mmap.zoom_to_box(Box2d(*bbox))
+        
+            img = mapnik.Image(width, height)
+            mapnik.render(mmap, img)
+            pixels = img.tostring()
+            
+            if len(pixels) <= len(shared):
+                memmove(shared, pixels, len(pixels))
+                conn.send(('shared', len(pixels)))
+            else:
+                conn.send(('bytes', pixels))
+
+        except:
+            conn.send(('error', format_exc()))
+
+class WorkerPool (MapPool):
+    """ Pool of render worker processes for a single mapfile.
+    
+        Workers are checked out like maps from a MapPool. Dead workers
+        are replaced when they're next checked out, and so are workers
+        that have done lifetime renders, in case they're leaking memory.
+    """
+    def __init__(self, mapfile, size, loader, buffer_size, lifetime=None):
+        MapPool.__init__(self, mapfile, size, loader)
+        self.buffer_size = buffer_size
+        self.lifetime = lifetime
+    
+    def checkout(self):
+        """ Return a healthy idle worker, starting a new one if needed.
+        """
+        while True:
+            worker = MapPool.checkout(self)
+            
+            if not worker.is_alive():
+                logging.warning('TileStache.Mapnik.WorkerPool.checkout() replacing dead worker %d for %s', worker.process.pid, self.mapfile)
+            
+            elif self.lifetime and worker.renders >= self.lifetime:
+                logging.debug('TileStache.Mapnik.WorkerPool.checkout() replacing worker %d after %d renders for %s', worker.process.pid, worker.renders, self.mapfile)
+            
+            else:
+                return worker
+            
+            self.discard(worker)
+    
+    def load(self):
+        """ Return a new worker for the pool.
+        """
+        return RenderWorker(self.mapfile, self.buffer_size, self.loader)
+    
+    def discard(self, worker):
+        """ Stop and forget a checked-out worker.
+        """
+        if worker is not None:
+            worker.stop()
+        
+        MapPool.discard(self, worker)
+
+_pools, _pools_lock, _pools_pid = {}, allocate_lock(), None
+
+def _get_pool(pool_class, *args):
+    """ Get a shared pool for a class and arguments in this process.
+    
+        Loaded maps can hold database connections and workers belong
+        to the process that started them, so pools are not shared with
+        a parent process and are started again after a fork.
+    """
+    global _pools, _pools_pid
+    
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools, _pools_pid = {}, os.getpid()
+        
+        key = (pool_class, ) + args
+        
+        if key not in _pools:
+            _pools[key] = pool_class(*args)
+        
+        return _pools[key]
+
+def get_mapPool(mapfile, size, loader=None):
+    """ Get the shared MapPool for a mapfile and pool size in this process.
+    """
+    return _get_pool(MapPool, mapfile, size, loader)
+
+def get_workerPool(mapfile, size, loader, buffer_size, lifetime):
+    """ Get the shared WorkerPool for a mapfile and pool settings in this process.
+    """
+    return _get_pool(WorkerPool, mapfile, size, loader, buffer_size, lifetime)
+
 class ImageProvider:
     """ Built-in Mapnik provider. Renders map images from Mapnik XML files.
     
@@ -61,13 +350,39 @@ class ImageProvider:
         - fonts (optional)
             Local directory path to *.ttf font files.
     
+        - map pool size (optional)
+            Number of loaded maps to keep for concurrent renders of the
+            mapfile, defaults to 4.
+    
+        - global lock (optional)
+            If true, render only one map at a time in the whole process,
+            across all layers. Defaults to false.
+    
+        - render workers (optional)
+            Number of worker processes to render the mapfile in. Defaults
+            to 0, for rendering in this process.
+    
+        - render timeout (optional)
+            Number of seconds to wait for a render worker before replacing
+            it. Defaults to 60.
+    
+        - render worker lifetime (optional)
+            Number of renders after which a render worker is replaced, to
+            limit leaks. Defaults to null, for no limit.
+    
+        - mapnik format (optional)
+            Mapnik image format such as "png256" or "jpeg85" for Mapnik to
+            encode tiles in, instead of PIL. Tiles requested in another
+            format, and layers with a bitmap palette or palette256, are
+            still encoded by PIL. Defaults to null, for always PIL.
+    
         More information on Mapnik and Mapnik XML:
         - http://mapnik.org
         - http://trac.mapnik.org/wiki/XMLGettingStarted
         - http://trac.mapnik.org/wiki/XMLConfigReference
     """
     
-    def __init__(self, layer, mapfile, fonts=None):
+    def __init__(self, layer, mapfile, fonts=None, map_pool_size=4, global_lock=False, render_workers=0, render_timeout=60, render_worker_lifetime=None, mapnik_format=None):
         """ Initialize Mapnik provider with layer and mapfile.
             
             XML mapfile keyword arg comes from TileStache config,
@@ -82,7 +397,18 @@ class ImageProvider:
             self.mapfile = maphref
         
         self.layer = layer
-        self.mapnik = None
+        self.map_pool_size = int(map_pool_size)
+        self.map_loader = None
+        self.global_lock = bool(global_lock)
+        self.mapnik_format = mapnik_format
+        
+        self.render_workers = int(render_workers)
+        self.render_timeout = float(render_timeout)
+        self.render_worker_lifetime = render_worker_lifetime and int(render_worker_lifetime)
+        
+        # shared buffer size for one whole metatile of RGBA pixels.
+        width, height = layer.metaSize(None)
+        self.render_buffer_size = width * height * 4
         
         engine = mapnik.FontEngine.instance()
         
@@ -105,6 +431,24 @@ class ImageProvider:
         if 'fonts' in config_dict:
             kwargs['fonts'] = config_dict['fonts']
         
+        if 'map pool size' in config_dict:
+            kwargs['map_pool_size'] = config_dict['map pool size']
+        
+        if 'global lock' in config_dict:
+            kwargs['global_lock'] = config_dict['global lock']
+        
+        if 'render workers' in config_dict:
+            kwargs['render_workers'] = config_dict['render workers']
+        
+        if 'render timeout' in config_dict:
+            kwargs['render_timeout'] = config_dict['render timeout']
+        
+        if 'render worker lifetime' in config_dict:
+            kwargs['render_worker_lifetime'] = config_dict['render worker lifetime']
+        
+        if 'mapnik format' in config_dict:
+            kwargs['mapnik_format'] = config_dict['mapnik format']
+        
         return kwargs
     
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
@@ -112,34 +456,77 @@ class ImageProvider:
         """
         start_time = time()
         
-        #
-        # Mapnik can behave strangely when run in threads, so place a lock on the instance.
-        #
-        if global_mapnik_lock.acquire():
-            try:
-                if self.mapnik is None:
-                    self.mapnik = get_mapnikMap(self.mapfile)
-                    logging.debug('TileStache.Mapnik.ImageProvider.renderArea() %.3f to load %s', time() - start_time, self.mapfile)
-
-                self.mapnik.width = width
-                self.mapnik.height = height
-                self.mapnik.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
+        if self.render_workers:
+            pool = get_workerPool(self.mapfile, self.render_workers, self.map_loader, self.render_buffer_size, self.render_worker_lifetime)
             
-                img = mapnik.Image(width, height)
-                mapnik.render(self.mapnik, img) 
-            except:
-                self.mapnik = None
-                raise
-            finally:
-                # always release the lock
-                global_mapnik_lock.release()
+            with pool.render_map(self.global_lock) as worker:
+                img = worker.render(width, height, (xmin, ymin, xmax, ymax), self.render_timeout)
+        
+            logging.debug('TileStache.Mapnik.ImageProvider.renderArea() %dx%d in %.3f from %s in worker %d', width, height, time() - start_time, self.mapfile, worker.process.pid)
+            
+            return img
+        
+        pool = get_mapPool(self.mapfile, self.map_pool_size, self.map_loader)
+        
+        with pool.render_map(self.global_lock) as mmap:
+            mmap.width = width
+            mmap.height = height
+            mmap.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
+        
+            img = mapnik.Image(width, height)
+            mapnik.render(mmap, img) 
 
-        img = Image.fromstring('RGBA', (width, height), img.tostring())
+        palettes = self.layer.bitmap_palette or getattr(self.layer, 'palette256', None)
+        
+        if self.mapnik_format and not palettes and _version >= 20000:
+            img = MapnikImage(img, (width, height), self.mapnik_format)
+        
+        else:
+            # PIL uses the string's memory as-is, without another copy.
+            img = Image.frombuffer('RGBA', (width, height), img.tostring(), 'raw', 'RGBA', 0, 1)
         
         logging.debug('TileStache.Mapnik.ImageProvider.renderArea() %dx%d in %.3f from %s', width, height, time() - start_time, self.mapfile)
     
         return img
 
+class MapnikImage:
+    """ Wrapper for a Mapnik image that makes it behave like a PIL.Image object.
+    
+        Tiles are encoded by Mapnik in a Mapnik image format such as "png256",
+        if it matches the requested format, and by PIL otherwise. Crops are
+        views of the same pixels, so metatiles are sliced without copies.
+    """
+    def __init__(self, image, size, mapnik_format):
+        self.image = image
+        self.size = size
+        self.mapnik_format = mapnik_format
+    
+    def save(self, out, format, **kwargs):
+        """ Write the image to a file-like object in a PIL format.
+        
+            Keyword arguments are PIL save options, ignored by Mapnik.
+        """
+        prefix = {'PNG': 'png', 'JPEG': 'jpeg'}.get(format.upper(), None)
+        
+        if prefix and self.mapnik_format.lower().startswith(prefix):
+            out.write(self.image.tostring(str(self.mapnik_format)))
+        else:
+            self.image_pil().save(out, format, **kwargs)
+    
+    def crop(self, bbox):
+        """ Return a cropped view of the image.
+        """
+        xmin, ymin, xmax, ymax = bbox
+        size = xmax - xmin, ymax - ymin
+        
+        view = self.image.view(xmin, ymin, size[0], size[1])
+        return MapnikImage(view, size, self.mapnik_format)
+    
+    def image_pil(self):
+        """ Return the image as a PIL.Image object.
+        """
+        return Image.frombuffer('RGBA', self.size, self.image.tostring(), 'raw', 'RGBA', 0, 1)
+
 class GridProvider:
     """ Built-in UTF Grid provider. Renders JSON raster objects from Mapnik.
     
@@ -198,17 +585,24 @@ class GridProvider:
           layer name added, keyed by this value. Useful for distingushing
           between data items.
         
+        - map pool size (optional)
+          Number of loaded maps to keep for concurrent renders of the
+          mapfile, defaults to 4.
+        
+        - global lock (optional)
+          If true, render only one map at a time in the whole process,
+          across all layers. Defaults to false.
+        
         Information and examples for UTF Grid:
         - https://github.com/mapbox/utfgrid-spec/blob/master/1.2/utfgrid.md
         - http://mapbox.github.com/wax/interaction-leaf.html
     """
-    def __init__(self, layer, mapfile, fields=None, layers=None, layer_index=0, scale=4, layer_id_key=None):
+    def __init__(self, layer, mapfile, fields=None, layers=None, layer_index=0, scale=4, layer_id_key=None, map_pool_size=4, global_lock=False):
         """ Initialize Mapnik grid provider with layer and mapfile.
             
             XML mapfile keyword arg comes from TileStache config,
             and is an absolute path by the time it gets here.
         """
-        self.mapnik = None
         self.layer = layer
 
         maphref = urljoin(layer.config.dirpath, mapfile)
@@ -221,6 +615,8 @@ class GridProvider:
 
         self.scale = scale
         self.layer_id_key = layer_id_key
+        self.map_pool_size = int(map_pool_size)
+        self.global_lock = bool(global_lock)
         
         if layers:
             self.layers = layers
@@ -237,6 +633,12 @@ class GridProvider:
             if key in config_dict:
                 kwargs[key] = config_dict[key]
         
+        if 'map pool size' in config_dict:
+            kwargs['map_pool_size'] = config_dict['map pool size']
+        
+        if 'global lock' in config_dict:
+            kwargs['global_lock'] = config_dict['global lock']
+        
         return kwargs
     
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
@@ -244,52 +646,41 @@ class GridProvider:
         """
         start_time = time()
         
-        #
-        # Mapnik can behave strangely when run in threads, so place a lock on the instance.
-        #
-        if global_mapnik_lock.acquire():
-            try:
-                if self.mapnik is None:
-                    self.mapnik = get_mapnikMap(self.mapfile)
-                    logging.debug('TileStache.Mapnik.GridProvider.renderArea() %.3f to load %s', time() - start_time, self.mapfile)
+        pool = get_mapPool(self.mapfile, self.map_pool_size)
+        
+        with pool.render_map(self.global_lock) as mmap:
+            mmap.width = width
+            mmap.height = height
+            mmap.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
+        
+            if self.layer_id_key is not None:
+                grids = []
 
-                self.mapnik.width = width
-                self.mapnik.height = height
-                self.mapnik.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
-            
-                if self.layer_id_key is not None:
-                    grids = []
-    
-                    for (index, fields) in self.layers:
-                        datasource = self.mapnik.layers[index].datasource
-                        fields = (type(fields) is list) and map(str, fields) or datasource.fields()
-                    
-                        grid = mapnik.render_grid(self.mapnik, index, resolution=self.scale, fields=fields)
-    
-                        for key in grid['data']:
-                            grid['data'][key][self.layer_id_key] = self.mapnik.layers[index].name
+                for (index, fields) in self.layers:
+                    datasource = mmap.layers[index].datasource
+                    fields = (type(fields) is list) and map(str, fields) or datasource.fields()
+                
+                    grid = mapnik.render_grid(mmap, index, resolution=self.scale, fields=fields)
+
+                    for key in grid['data']:
+                        grid['data'][key][self.layer_id_key] = mmap.layers[index].name
+
+                    grids.append(grid)
     
-                        grids.append(grid)
+            else:
+                grid = mapnik.Grid(width, height)
+
+                for (index, fields) in self.layers:
+                    datasource = mmap.layers[index].datasource
+                    fields = (type(fields) is list) and map(str, fields) or datasource.fields()
+
+                    mapnik.render_layer(mmap, grid, layer=index, fields=fields)
         
-                    # global_mapnik_lock.release()
-                    outgrid = reduce(merge_grids, grids)
-           
-                else:
-                    grid = mapnik.Grid(width, height)
-    
-                    for (index, fields) in self.layers:
-                        datasource = self.mapnik.layers[index].datasource
-                        fields = (type(fields) is list) and map(str, fields) or datasource.fields()
-    
-                        mapnik.render_layer(self.mapnik, grid, layer=index, fields=fields)
-    
-                    # global_mapnik_lock.release()
-                    outgrid = grid.encode('utf', resolution=self.scale, features=True)
-            except:
-                self.mapnik = None
-                raise
-            finally:
-                global_mapnik_lock.release()
+        # merging and encoding grids needs no map.
+        if self.layer_id_key is not None:
+            outgrid = merge_grids(*grids)
+        else:
+            outgrid = grid.encode('utf', resolution=self.scale, features=True)
 
         logging.debug('TileStache.Mapnik.GridProvider.renderArea() %dx%d at %d in %.3f from %s', width, height, self.scale, time() - start_time, self.mapfile)
 
@@ -332,16 +723,22 @@ class SaveableResponse:
         cropped = dict(keys=keys, data=data, grid=grid)
         return SaveableResponse(cropped, self.scale)
 
-def merge_grids(grid1, grid2):
-    """ Merge two UTF Grid objects.
+def merge_grids(*grids):
+    """ Merge UTF Grid objects, each one on top of the ones before.
+    
+        Grid rows are decoded to NumPy arrays of key indexes just once,
+        merged, and encoded back to rows at the end.
     """
+    if len(grids) == 1:
+        return grids[0]
+    
     #
     # Concatenate keys and data, assigning new indexes along the way.
     #
 
     keygen, outkeys, outdata = count(1), [], dict()
     
-    for ingrid in [grid1, grid2]:
+    for ingrid in grids:
         for (index, key) in enumerate(ingrid['keys']):
             if key not in ingrid['data']:
                 outkeys.append('')
@@ -354,29 +751,46 @@ def merge_grids(grid1, grid2):
             outdata[outkey] = datum
     
     #
-    # Merge the two grids, one on top of the other.
+    # Merge the grids, each one on top of the others.
     #
     
-    offset, outgrid = len(grid1['keys']), []
+    offset, outids = len(grids[0]['keys']), decode_grid(grids[0]['grid'])
     
-    def newchar(char1, char2):
-        """ Return a new encoded character based on two inputs.
-        """
-        id1, id2 = decode_char(char1), decode_char(char2)
+    for ingrid in grids[1:]:
+        ids = decode_grid(ingrid['grid'])
         
-        if grid2['keys'][id2] == '':
-            # transparent pixel, use the bottom character
-            return encode_id(id1)
+        # transparent pixels use the character below.
+        transparent = numpy.array([key == '' for key in ingrid['keys']], dtype=bool)
+        outids = numpy.where(transparent[ids], outids, ids + offset)
         
-        else:
-            # opaque pixel, use the top character
-            return encode_id(id2 + offset)
+        offset += len(ingrid['keys'])
+    
+    return dict(keys=outkeys, data=outdata, grid=encode_grid(outids))
+
+def decode_grid(rows):
+    """ Decode a list of UTF Grid rows to a 2D NumPy array of key indexes.
+    """
+    if not rows:
+        return numpy.zeros((0, 0), dtype=numpy.int32)
+
+    text = u''.join(rows).encode('utf-32-le')
+    ids = numpy.fromstring(text, dtype='<u4').astype(numpy.int32).reshape(len(rows), -1)
+    
+    # the same steps as decode_char(), for every character at once.
+    return ids - (ids >= 93) - (ids >= 35) - 32
+
+def encode_grid(ids):
+    """ Encode a 2D NumPy array of key indexes to a list of UTF Grid rows.
+    """
+    # the same steps as encode_id(), for every index at once.
+    ids = ids.astype(numpy.int32) + 32
+    ids += (ids >= 34)
+    ids += (ids >= 92)
     
-    for (row1, row2) in zip(grid1['grid'], grid2['grid']):
-        outrow = [newchar(c1, c2) for (c1, c2) in zip(row1, row2)]
-        outgrid.append(''.join(outrow))
+    height, width = ids.shape
+    text = ids.astype('<u4').tostring().decode('utf-32-le')
     
-    return dict(keys=outkeys, data=outdata, grid=outgrid)
+    return [text[row*width:(row+1)*width] for row in range(height)]
 
 def encode_id(id):
     id += 32
@@ -100,6 +100,15 @@ class Cache:
         mem.delete(key)
         mem.disconnect_all()
         
+    def remove_many(self, layer, coords, format):
+        """ Remove many cached tiles, with one request per server.
+        """
+        mem = Client(self.servers)
+        keys = [tile_key(layer, coord, format, self.revision, self.key_prefix) for coord in coords]
+        
+        mem.delete_multi(keys)
+        mem.disconnect_all()
+        
     def read(self, layer, coord, format):
         """ Read a cached tile.
         """
@@ -0,0 +1,206 @@
+""" Synthesizes tiles beyond a layer's highest zoom from their ancestors.
+
+The Overzoom Provider wraps another configured raster layer. At zoom levels
+up to a source zoom it simply returns the other layer's tiles; above it,
+each tile is cut from the quadrant of its ancestor at the source zoom and
+scaled up. A layer seeded to zoom 16 can then be shown at zoom 19 without
+rendering or storing anything more than it already has.
+
+Ancestor tiles are requested with TileStache.getTile(), so caches are read
+and written as normal for the source layer. Tiles at or below the source zoom
+are passed through as they came from the source layer, without decoding and
+encoding them again, unless they need resizing or a bitmap palette or are
+requested in another format.
+
+Many tiles share one ancestor, so the most recently used decoded ancestors
+can also be kept in memory with the "memo size" parameter. Memorized ancestors
+aren't seen to change in the source layer's cache, so they're forgotten after
+"memo ttl" seconds.
+
+Example configuration:
+
+    "layers":
+    {
+      "base":
+      {
+        "provider": {"name": "mapnik", "mapfile": "style.xml"}
+      },
+      "base-overzoom":
+      {
+        "provider":
+        {
+          "name": "Overzoom",
+          "layer": "base",
+          "source zoom": 16
+        }
+      }
+    }
+
+Overzoom provider parameters:
+
+  layer
+    Required name of another layer in the configuration.
+
+  source zoom
+    Required highest zoom level to request from the other layer.
+
+  extension
+    Optional filename extension of tiles to request from the other layer.
+    Defaults to "png".
+
+  resample
+    Optional filter for scaling up, one of "nearest", "bilinear" or
+    "bicubic". Defaults to "bicubic".
+
+  memo size
+    Optional number of decoded ancestor tiles to keep in memory.
+    Defaults to 0, for none.
+
+  memo ttl
+    Optional number of seconds to keep a decoded ancestor tile in memory.
+    Defaults to 60.
+"""
+import threading
+
+from time import time
+
+from StringIO import StringIO
+from collections import OrderedDict
+
+from .Core import KnownUnknown
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+filters = ('nearest', 'bilinear', 'bicubic')
+
+class Provider:
+    """ Overzoom Provider.
+
+        See module documentation for explanation of constructor arguments.
+    """
+    def __init__(self, layer, source_layer, source_zoom, extension='png', resample='bicubic', memo_size=0, memo_ttl=60):
+        if resample not in filters:
+            raise KnownUnknown('Resampling filter must be one of %s, not "%s"' % (', '.join(filters), resample))
+
+        self.layer = layer
+        self.source_name = source_layer
+        self.source_zoom = int(source_zoom)
+        self.extension = extension
+        self.resample = getattr(Image, resample.upper())
+
+        # decoded ancestor images and their expiry times, least recently used first.
+        self.memo, self.memo_size, self.memo_ttl = OrderedDict(), int(memo_size), float(memo_ttl)
+        self.memo_lock = threading.Lock()
+
+    @staticmethod
+    def prepareKeywordArgs(config_dict):
+        """ Convert configured parameters to keyword args for __init__().
+        """
+        kwargs = {'source_layer': config_dict['layer'], 'source_zoom': config_dict['source zoom']}
+
+        if 'extension' in config_dict:
+            kwargs['extension'] = config_dict['extension']
+
+        if 'resample' in config_dict:
+            kwargs['resample'] = config_dict['resample']
+
+        if 'memo size' in config_dict:
+            kwargs['memo_size'] = config_dict['memo size']
+
+        if 'memo ttl' in config_dict:
+            kwargs['memo_ttl'] = config_dict['memo ttl']
+
+        return kwargs
+
+    def source_tile(self, coord):
+        """ Return the raw content and format of a tile from the source layer.
+        """
+        from . import getTile
+
+        if self.source_name not in self.layer.config.layers:
+            raise KnownUnknown('"%s" is not a layer I know about for Overzoom.' % self.source_name)
+
+        source = self.layer.config.layers[self.source_name]
+        mime, format = source.getTypeByExtension(self.extension)
+        mime, body = getTile(source, coord, self.extension)
+
+        return body, format
+
+    def source_image(self, coord):
+        """ Return a decoded tile from the source layer, from memory if possible.
+        """
+        key = coord.zoom, coord.column, coord.row
+
+        with self.memo_lock:
+            if key in self.memo:
+                image, expires = self.memo.pop(key)
+
+                if time() < expires:
+                    self.memo[key] = image, expires
+                    return image
+
+        body, format = self.source_tile(coord)
+        image = Image.open(StringIO(body)).convert('RGBA')
+
+        with self.memo_lock:
+            if self.memo_size > 0:
+                self.memo[key] = image, time() + self.memo_ttl
+
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+
+        return image
+
+    def renderTile(self, width, height, srs, coord):
+        """ Return a source layer tile, or part of its ancestor scaled up.
+        """
+        if coord.zoom <= self.source_zoom:
+            body, format = self.source_tile(coord)
+            tile = SourceTile(body, format)
+
+            if tile.size == (width, height) and not self.layer.bitmap_palette:
+                return tile
+
+            image = tile.image.convert('RGBA')
+
+            if image.size == (width, height):
+                return image
+
+            return image.resize((width, height), self.resample)
+
+        ancestor = coord.zoomTo(self.source_zoom).container()
+        image = self.source_image(ancestor)
+
+        # extent of this tile within its ancestor, in pixels.
+        scale = 2 ** (coord.zoom - self.source_zoom)
+        w, h = image.size[0] / float(scale), image.size[1] / float(scale)
+        x = (coord.column - ancestor.column * scale) * w
+        y = (coord.row - ancestor.row * scale) * h
+
+        return image.transform((width, height), Image.EXTENT, (x, y, x + w, y + h), self.resample)
+
+class SourceTile:
+    """ Wrapper for a source layer tile that makes it behave like a PIL.Image object.
+
+        Tiles are passed through as-is in their own format, and only
+        decoded if they're requested in another. PIL reads just the size
+        until then.
+    """
+    def __init__(self, body, format):
+        self.body = body
+        self.format = format
+        self.image = Image.open(StringIO(body))
+        self.size = self.image.size
+
+    def save(self, out, format, **kwargs):
+        """ Write the tile to a file-like object in a PIL format.
+
+            Keyword arguments are PIL save options, ignored for tiles in their own format.
+        """
+        if format.upper() == self.format.upper():
+            out.write(self.body)
+        else:
+            self.image.save(out, format, **kwargs)
@@ -20,11 +20,30 @@ fixed-size 772-byte table with 256 3-byte RGB triplets, followed by a two-byte
 unsigned int with the number of defined colors (may be less than 256) and a
 finaly two-byte unsigned int with the optional index of a transparent color
 in the lookup table. If the final byte is 0xFFFF, there is no transparency.
+
+Palettes are applied with NumPy. Each palette has a lookup table of palette
+indexes for every 24-bit color, filled in as colors are first seen, so that
+most images are mapped with a single array indexing operation. Layers with the
+same palette share a table. Tables reserve 32MB each, of which only the pages
+for colors actually seen are used, and the eight most recently used are kept.
+
+Layers with the "palette256" PNG option get an optimum palette from PIL for
+each whole metatile, shared by all its tiles so that neighbors match. With
+the "palette256_error" option, a palette can also be reused for following
+metatiles at the same zoom level, while it still fits their colors.
 """
 from struct import unpack, pack
 from math import sqrt, ceil, log
 from urllib import urlopen
 from operator import add
+from threading import Lock
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    # can still build documentation
+    pass
 
 try:
     from PIL import Image
@@ -71,39 +90,104 @@ def palette_color(r, g, b, palette, t_index):
     
     return distances.index(min(distances))
 
-def apply_palette(image, palette, t_index):
-    """ Apply a palette array to an image, return a new image.
+def palette_matches(colors, palette):
+    """ Return best palette match indexes and squared distances for 24-bit colors.
+    
+        Colors are an array of 0xRRGGBB integers, and palette an array of
+        (r, g, b) rows. Matches are found as palette_color() does, but for
+        many colors at once.
     """
-    image = image.convert('RGBA')
-    pixels = image.tostring()
-    t_value = (t_index in range(256)) and pack('!B', t_index) or None
-    mapping = {}
-    indexes = []
-    
-    for offset in range(0, len(pixels), 4):
-        r, g, b, a = unpack('!BBBB', pixels[offset:offset+4])
+    rgb = numpy.column_stack(((colors >> 16) & 0xff, (colors >> 8) & 0xff, colors & 0xff)).astype(numpy.int32)
+    
+    matches = numpy.empty(len(colors), dtype=numpy.uint8)
+    distances = numpy.empty(len(colors), dtype=numpy.int32)
+    
+    # a few thousand colors at a time keeps the distances array small.
+    for start in range(0, len(colors), 4096):
+        diffs = rgb[start:start+4096, None, :] - palette[None, :, :]
+        squares = (diffs * diffs).sum(axis=2)
+        matches[start:start+4096] = squares.argmin(axis=1)
+        distances[start:start+4096] = squares.min(axis=1)
+    
+    return matches, distances
+
+def image_colors(image):
+    """ Return an RGBA image's pixels as a NumPy array, and its 24-bit colors.
+    """
+    pixels = numpy.asarray(image.convert('RGBA')).reshape(-1, 4)
+    colors = (pixels[:,0].astype(numpy.int32) << 16) | (pixels[:,1].astype(numpy.int32) << 8) | pixels[:,2]
+    
+    return pixels, colors
+
+class PaletteLookup:
+    """ Lookup table of palette indexes for 24-bit colors.
+    
+        Colors are matched as palette_color() does, but many at a time.
+        Indexes are kept for all 2^24 colors in two 16MB arrays, only the
+        parts of which for colors actually seen are ever written.
+    """
+    def __init__(self, palette, t_index):
+        self.palette = numpy.array(palette, dtype=numpy.int32).reshape(-1, 3)
+        self.t_index = t_index
         
-        if a < 0x80 and t_value is not None:
-            # Sufficiently transparent
-            indexes.append(t_value)
-            continue
+        self.indexes = numpy.empty(1 << 24, dtype=numpy.uint8)
+        self.known = numpy.zeros(1 << 24, dtype=bool)
+        self.lock = Lock()
+    
+    def lookup(self, colors):
+        """ Return palette indexes for an array of 24-bit colors.
+        """
+        unknown = ~self.known[colors]
         
-        try:
-            indexes.append(mapping[(r, g, b)])
-
-        except KeyError:
-            # Never seen this color
-            mapping[(r, g, b)] = pack('!B', palette_color(r, g, b, palette, t_index))
+        if unknown.any():
+            with self.lock:
+                new_colors = numpy.unique(colors[unknown])
+                palette = self.palette
+                
+                if self.t_index is not None:
+                    palette = numpy.delete(palette, self.t_index, 0)
+                
+                self.indexes[new_colors] = palette_matches(new_colors, palette)[0]
+                self.known[new_colors] = True
         
+        return self.indexes[colors]
+
+# shared lookup tables, least recently used first.
+_lookups, _lookups_lock, _lookups_size = OrderedDict(), Lock(), 8
+
+def get_palette_lookup(palette, t_index):
+    """ Get the shared PaletteLookup for a palette and transparency index.
+    
+        Only the most recently used are kept, since each one is big.
+    """
+    key = tuple(map(tuple, palette)), t_index
+    
+    with _lookups_lock:
+        if key in _lookups:
+            lookup = _lookups.pop(key)
         else:
-            continue
+            lookup = PaletteLookup(palette, t_index)
+        
+        _lookups[key] = lookup
+        
+        while len(_lookups) > _lookups_size:
+            _lookups.popitem(last=False)
         
-        indexes.append(mapping[(r, g, b)])
+        return lookup
 
-    output = Image.fromstring('P', image.size, ''.join(indexes))
-    bits = int(ceil(log(len(palette)) / log(2)))
+def apply_palette(image, palette, t_index):
+    """ Apply a palette array to an image, return a new image.
+    """
+    pixels, colors = image_colors(image)
+    indexes = get_palette_lookup(palette, t_index).lookup(colors)
+    
+    if t_index in range(256):
+        # Sufficiently transparent
+        indexes[pixels[:,3] < 0x80] = t_index
     
-    palette += [(0, 0, 0)] * (256 - len(palette))
+    output = Image.frombuffer('P', image.size, indexes.tostring(), 'raw', 'P', 0, 1)
+    
+    palette = palette + [(0, 0, 0)] * (256 - len(palette))
     palette = reduce(add, palette)
     output.putpalette(palette)
     
@@ -113,3 +197,43 @@ def apply_palette256(image):
     """ Get PIL to generate and apply an optimum 256 color palette to the given image and return it
     """
     return image.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=256, dither=Image.NONE)
+
+class SharedPalettes:
+    """ Optimum 256 color palettes for a layer, reused while they fit well enough.
+    
+        Each image gets the last palette made at its zoom level, if the root-
+        mean-square distance of its pixels from their palette colors is no
+        more than max_error, and a new palette from apply_palette256() if not.
+        With no max_error, every image gets a new palette.
+    """
+    def __init__(self, max_error=None):
+        self.max_error = max_error
+        self.palettes = {}
+        self.lock = Lock()
+    
+    def apply(self, image, zoom):
+        """ Apply a shared 256 color palette to an image, return a new image.
+        """
+        with self.lock:
+            palette = self.palettes.get(zoom, None)
+        
+        if palette is not None and self.max_error is not None:
+            pixels, colors = image_colors(image)
+            unique_colors, inverse = numpy.unique(colors, return_inverse=True)
+            matches, distances = palette_matches(unique_colors, palette)
+            
+            if sqrt(distances[inverse].mean()) <= self.max_error:
+                output = Image.frombuffer('P', image.size, matches[inverse].tostring(), 'raw', 'P', 0, 1)
+                output.putpalette(palette.flatten().tolist())
+                return output
+        
+        output = apply_palette256(image)
+        
+        # trim unused colors, which PIL leaves black.
+        used = numpy.asarray(output).max() + 1
+        palette = numpy.array(output.getpalette()[:used*3], dtype=numpy.int32).reshape(-1, 3)
+        
+        with self.lock:
+            self.palettes[zoom] = palette
+        
+        return output
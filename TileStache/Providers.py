@@ -11,6 +11,8 @@ Built-in providers:
 - url template (UrlTemplate)
 - mbtiles (TileStache.MBTiles.Provider)
 - mapnik grid (Mapnik.GridProvider)
+- sandwich (TileStache.Sandwich.Provider)
+- overzoom (TileStache.Overzoom.Provider)
 
 Example built-in provider, for JSON configuration file:
 
@@ -134,6 +136,10 @@ def getProviderByName(name):
         from . import Sandwich
         return Sandwich.Provider
 
+    elif name.lower() == 'overzoom':
+        from . import Overzoom
+        return Overzoom.Provider
+
     raise Exception('Unknown provider name: "%s"' % name)
 
 class Verbatim:
@@ -0,0 +1,106 @@
+""" Builds low-zoom raster tiles by downsampling their children.
+
+Rendering the lowest zoom levels of a large layer can take far longer than
+all the rest, because each tile covers so much data. For many layers a tile
+made by shrinking its four children, already in the cache, looks much the
+same and costs next to nothing. This is what tilestache-seed.py does for
+zoom levels below its --downsample-below option, from the highest down.
+
+Children are read with TileStache.getTile(), so any missing from the cache
+are rendered first. Tiles are built a whole metatile at a time under the
+same cache lock that TileStache.Core.Layer.getTileResponse() would take,
+and saved with the layer's usual PNG or JPEG options and palettes.
+
+Resampling filters are named as in PIL: "nearest", "bilinear", "bicubic"
+or "antialias", the default.
+"""
+import logging
+
+from StringIO import StringIO
+from time import time
+
+from .Pixels import apply_palette, apply_palette256
+from .Core import KnownUnknown
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+filters = ('nearest', 'bilinear', 'bicubic', 'antialias')
+
+def buildTile(layer, coord, extension, resample='antialias', reuse_identical=False):
+    """ Build a tile from its four children at the next zoom, return its body.
+
+        If reuse_identical is true and all four children are identical,
+        the first child is returned as-is; this is exact for tiles of solid
+        color like oceans, and saves decoding and encoding them.
+    """
+    if resample not in filters:
+        raise KnownUnknown('Resampling filter must be one of %s, not "%s"' % (', '.join(filters), resample))
+
+    from . import getTile
+
+    mimetype, format = layer.getTypeByExtension(extension)
+    child = coord.zoomBy(1)
+    children = child, child.right(), child.down(), child.down().right()
+    bodies = [getTile(layer, other, extension)[1] for other in children]
+
+    if reuse_identical and bodies.count(bodies[0]) == len(bodies):
+        return bodies[0]
+
+    dim = layer.dim
+    mosaic = Image.new('RGBA', (dim * 2, dim * 2))
+
+    for (body, x, y) in zip(bodies, (0, dim, 0, dim), (0, 0, dim, dim)):
+        mosaic.paste(Image.open(StringIO(body)).convert('RGBA'), (x, y))
+
+    tile = mosaic.resize((dim, dim), getattr(Image, resample.upper()))
+
+    if format.lower() == 'jpeg' or tile.getextrema()[3] == (0xFF, 0xFF):
+        tile = tile.convert('RGB')
+
+    if format.lower() == 'png' and layer.bitmap_palette:
+        tile = apply_palette(tile, layer.bitmap_palette, layer.png_options.get('transparency', None))
+    elif format.lower() == 'png' and getattr(layer, 'palette256', None):
+        tile = apply_palette256(tile)
+
+    return layer.encodeTile(tile, format)
+
+def buildMetatile(layer, coord, extension, ignore_cached=False, resample='antialias', reuse_identical=False):
+    """ Build and cache every tile in a metatile, return (mimetype, body) for one.
+
+        Arguments are as for TileStache.getTile() and buildTile().
+    """
+    start_time = time()
+
+    mimetype, format = layer.getTypeByExtension(extension)
+    cache, body = layer.config.cache, None
+
+    lockCoord = layer.metatile.firstCoord(coord)
+    cache.lock(layer, lockCoord, format)
+
+    try:
+        for other in layer.metatile.allCoords(coord):
+            if other.row >= 2**other.zoom or other.column >= 2**other.zoom:
+                # off the edge of the world.
+                continue
+
+            other_body = None
+
+            if not ignore_cached:
+                other_body = cache.read(layer, other, format)
+
+            if other_body is None:
+                other_body = buildTile(layer, other, extension, resample, reuse_identical)
+                cache.save(other_body, layer, other, format)
+
+            if other == coord:
+                body = other_body
+
+    finally:
+        cache.unlock(layer, lockCoord, format)
+
+    logging.info('TileStache.Pyramid.buildMetatile() %s/%d/%d/%d.%s in %.3f', layer.name(), coord.zoom, coord.column, coord.row, extension, time() - start_time)
+
+    return mimetype, body
@@ -102,6 +102,28 @@ class Cache:
         key = tile_key(layer, coord, format, self.key_prefix)
         self.conn.delete(key)
         
+    def remove_many(self, layer, coords, format):
+        """ Remove many cached tiles, with pipelined UNLINK commands.
+        
+            UNLINK frees memory in the background, but needs Redis 4.0+;
+            older servers get DEL commands instead.
+        """
+        keys = [tile_key(layer, coord, format, self.key_prefix) for coord in coords]
+        
+        for command in ('UNLINK', 'DEL'):
+            pipe = self.conn.pipeline(transaction=False)
+            
+            for offset in range(0, len(keys), 1000):
+                pipe.execute_command(command, *keys[offset:offset+1000])
+            
+            try:
+                pipe.execute()
+            except redis.ResponseError:
+                if command == 'DEL':
+                    raise
+            else:
+                return
+        
     def read(self, layer, coord, format):
         """ Read a cached tile.
         """
@@ -44,7 +44,7 @@ AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY will be used
     http://docs.pythonboto.org/en/latest/s3_tut.html#creating-a-connection
 """
 from time import time as _time, sleep as _sleep
-from mimetypes import guess_type
+from mimetypes import guess_type, add_type
 from time import strptime, time
 from calendar import timegm
 
@@ -55,6 +55,9 @@ except ImportError:
     # at least we can build the documentation
     pass
 
+# older mime.types files don't know WebP, which needs a Content-Type to display.
+add_type('image/webp', '.webp')
+
 def tile_key(layer, coord, format, path = ''):
     """ Return a tile key string.
     """
@@ -107,6 +110,14 @@ class Cache:
         key_name = tile_key(layer, coord, format, self.path)
         self.bucket.delete_key(key_name)
         
+    def remove_many(self, layer, coords, format):
+        """ Remove many cached tiles, with one multi-object delete per 1,000.
+        """
+        key_names = [tile_key(layer, coord, format, self.path) for coord in coords]
+        
+        for offset in range(0, len(key_names), 1000):
+            self.bucket.delete_keys(key_names[offset:offset+1000], quiet=True)
+        
     def read(self, layer, coord, format):
         """ Read a cached tile.
         """
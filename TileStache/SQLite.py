@@ -0,0 +1,209 @@
+""" Caches tiles to a handful of SQLite files on local disk.
+
+Millions of tiny files in a Disk cache can exhaust inodes and make directory
+walks and backups crawl. This cache stores tiles in SQLite databases instead,
+sharded into one file per layer and zoom level, e.g. "osm/12.sqlite". Each
+shard is opened in write-ahead log (WAL) mode with a memory-mapped read path,
+so any number of readers can proceed concurrently with a single writer.
+
+Requires Python's standard sqlite3 module, SQLite 3.7.0+ for WAL mode.
+
+Example configuration:
+
+  "cache": {
+    "name": "SQLite",
+    "path": "/tmp/stache",
+    "umask": "0000"
+  }
+
+SQLite cache parameters:
+
+  path
+    Required local directory path where shard files should be stored.
+
+  umask
+    Optional string representation of octal permission mask for stored
+    files. Defaults to 0022.
+
+  mmap size
+    Optional number of bytes of each shard to memory-map for reads.
+    Defaults to 256MB; 0 disables memory-mapping.
+
+  synchronous
+    Optional SQLite synchronous pragma, "off", "normal" or "full".
+    Defaults to "normal", which is durable in WAL mode except for the
+    last few transactions before a power loss.
+
+If your configuration file is loaded from a remote location, e.g.
+"http://example.com/tilestache.cfg", the path *must* be an unambiguous
+filesystem path, e.g. "file:///tmp/cache"
+"""
+import os
+import threading
+
+from os.path import join as pathjoin
+from time import time as _time, sleep as _sleep
+
+# Heroku is missing standard python's sqlite3 package, so this will ImportError.
+from sqlite3 import connect as _connect, IntegrityError
+
+def shard_path(layer, coord, path):
+    """ Return the shard file path for a tile.
+    """
+    return pathjoin(path, layer.name(), '%d.sqlite' % coord.zoom)
+
+def tile_key(coord, format):
+    """ Return a tile key tuple, matching the primary key of a shard table.
+    """
+    return int(coord.column), int(coord.row), format.lower()
+
+class Cache:
+    """
+    """
+    def __init__(self, path, umask=0022, mmap_size=256*1024*1024, synchronous='normal'):
+        self.cachepath = path
+        self.umask = int(umask)
+        self.mmap_size = int(mmap_size)
+        self.synchronous = synchronous.upper()
+
+        if self.synchronous not in ('OFF', 'NORMAL', 'FULL'):
+            raise Exception('Synchronous must be one of "off", "normal" or "full", not "%s"' % synchronous)
+
+        # one connection per shard per thread, sqlite3 requires it.
+        self._local = threading.local()
+
+    def _db(self, layer, coord):
+        """ Return an open connection to the shard for this tile.
+
+            Connections are held open per thread and per process; a forked
+            child process will open its own instead of sharing its parent's.
+        """
+        local = self._local
+
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid, local.connections = os.getpid(), {}
+
+        filename = shard_path(layer, coord, self.cachepath)
+
+        if filename not in local.connections:
+            local.connections[filename] = self._connect(filename)
+
+        return local.connections[filename]
+
+    def _connect(self, filename):
+        """ Open a shard file in WAL mode, creating it if necessary.
+        """
+        try:
+            umask_old = os.umask(self.umask)
+            os.makedirs(os.path.dirname(filename), 0777&~self.umask)
+        except OSError, e:
+            if e.errno != 17:
+                raise
+        finally:
+            os.umask(umask_old)
+
+        # autocommit mode; each statement is its own short write transaction.
+        db = _connect(filename, timeout=30, isolation_level=None)
+        db.text_factory = bytes
+
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=%s' % self.synchronous)
+        db.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+
+        db.execute('''CREATE TABLE IF NOT EXISTS tiles (
+                        tile_column INTEGER, tile_row INTEGER, format TEXT,
+                        modified REAL, body BLOB,
+                        PRIMARY KEY (tile_column, tile_row, format)
+                      ) WITHOUT ROWID''')
+
+        db.execute('''CREATE TABLE IF NOT EXISTS locks (
+                        tile_column INTEGER, tile_row INTEGER, format TEXT,
+                        due REAL,
+                        PRIMARY KEY (tile_column, tile_row, format)
+                      ) WITHOUT ROWID''')
+
+        os.chmod(filename, 0666&~self.umask)
+
+        return db
+
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile.
+
+            Returns nothing, but blocks until the lock has been acquired.
+            Lock is implemented as a row in the shard's locks table, with
+            a due time after which it is considered stale and removed.
+        """
+        db = self._db(layer, coord)
+        key = tile_key(coord, format)
+        due = _time() + layer.stale_lock_timeout
+
+        while True:
+            try:
+                db.execute('INSERT INTO locks VALUES (?, ?, ?, ?)', key + (due, ))
+                return
+            except IntegrityError:
+                # someone might have left the door locked.
+                q = 'DELETE FROM locks WHERE tile_column=? AND tile_row=? AND format=? AND due < ?'
+                db.execute(q, key + (_time(), ))
+                _sleep(.2)
+
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile.
+        """
+        db = self._db(layer, coord)
+        q = 'DELETE FROM locks WHERE tile_column=? AND tile_row=? AND format=?'
+        db.execute(q, tile_key(coord, format))
+
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile.
+        """
+        db = self._db(layer, coord)
+        q = 'DELETE FROM tiles WHERE tile_column=? AND tile_row=? AND format=?'
+        db.execute(q, tile_key(coord, format))
+
+    def remove_many(self, layer, coords, format):
+        """ Remove many cached tiles, in one transaction per shard.
+        """
+        shards = {}
+
+        for coord in coords:
+            shards.setdefault(coord.zoom, []).append(coord)
+
+        q = 'DELETE FROM tiles WHERE tile_column=? AND tile_row=? AND format=?'
+
+        for coords in shards.values():
+            db = self._db(layer, coords[0])
+
+            db.execute('BEGIN')
+
+            try:
+                db.executemany(q, [tile_key(coord, format) for coord in coords])
+            except:
+                db.execute('ROLLBACK')
+                raise
+            else:
+                db.execute('COMMIT')
+
+    def read(self, layer, coord, format):
+        """ Read a cached tile.
+        """
+        db = self._db(layer, coord)
+        q = 'SELECT body, modified FROM tiles WHERE tile_column=? AND tile_row=? AND format=?'
+        row = db.execute(q, tile_key(coord, format)).fetchone()
+
+        if row is None:
+            return None
+
+        body, modified = row
+
+        if layer.cache_lifespan and _time() - modified > layer.cache_lifespan:
+            return None
+
+        return str(body)
+
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+        """
+        db = self._db(layer, coord)
+        q = 'REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)'
+        db.execute(q, tile_key(coord, format) + (_time(), buffer(body)))
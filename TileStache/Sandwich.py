@@ -4,10 +4,8 @@ The Sandwich Provider supplies a Photoshop-like rendering pipeline, making it
 possible to use the output of other configured tile layers as layers or masks
 to create a combined output. Sandwich is modeled on Lars Ahlzen's TopOSM.
 
-The external "Blit" library is required by Sandwich, and can be installed
-via Pip, easy_install, or directly from Github:
-
-    https://github.com/migurski/Blit
+NumPy is required by Sandwich. Layers are composited as contiguous arrays of
+floating point pixels, blended in place one layer after another.
 
 The "stack" configuration parameter describes a layer or stack of layers that
 can be combined to create output. A simple stack that merely outputs a single
@@ -26,6 +24,9 @@ tiled seamlessly, assuming 256x256 parent tiles:
     {"src": "image.png"}
     {"src": "http://example.com/image.png"}
 
+Bitmap images are read once per process and kept, along with a pattern of
+them pre-tiled for each tile size.
+
 Layers can be limited to appear at certain zoom levels, given either as a range
 or as a single number:
 
@@ -57,13 +58,9 @@ to 50% gray while leaving black and white alone:
     {"src": "hillshading", "adjustments": [ ["curves", [0, 181, 255]] ]}
 
 Available adjustments:
-  "threshold" - Blit.adjustments.threshold()
-  "curves" - Blit.adjustments.curves()
-  "curves2" - Blit.adjustments.curves2()
-
-See detailed information about adjustments in Blit documentation:
-
-    https://github.com/migurski/Blit#readme
+  "threshold" - threshold()
+  "curves" - curves()
+  "curves2" - curves2()
 
 Finally, the stacking feature allows layers to combined in more complex ways.
 This example stack combines a background color and foreground layer:
@@ -73,6 +70,9 @@ This example stack combines a background color and foreground layer:
       {"src": "layer-name"}
     ]
 
+Tiles from other layers in a stack are read concurrently, one thread per layer,
+through their caches as usual.
+
 A complete example configuration might look like this:
 
     {
@@ -117,9 +117,11 @@ A complete example configuration might look like this:
       }
     }
 """
+import sys
+
 from re import search
 from StringIO import StringIO
-from itertools import product
+from threading import Thread, Lock
 from urlparse import urljoin
 from urllib import urlopen
 
@@ -134,25 +136,9 @@ except ImportError:
         from PIL import Image
 
 try:
-    import Blit
-
-    blend_modes = {
-        'screen': Blit.blends.screen,
-        'add': Blit.blends.add,
-        'multiply': Blit.blends.multiply,
-        'subtract': Blit.blends.subtract,
-        'linear light': Blit.blends.linear_light,
-        'hard light': Blit.blends.hard_light
-        }
-
-    adjustment_names = {
-        'threshold': Blit.adjustments.threshold,
-        'curves': Blit.adjustments.curves,
-        'curves2': Blit.adjustments.curves2
-        }
-
+    import numpy
 except ImportError:
-    # Well, this will not work.
+    # can still build documentation
     pass
 
 class Provider:
@@ -173,47 +159,49 @@ class Provider:
     
     def renderTile(self, width, height, srs, coord):
         
-        rendered = self.draw_stack(coord, dict())
+        rendered = self.draw_stack(coord, width, height)
         
-        if rendered.size() == (width, height):
-            return rendered.image()
-        else:
-            return rendered.image().resize((width, height))
+        return pixels_image(rendered)
 
-    def draw_stack(self, coord, tiles):
+    def draw_stack(self, coord, width, height):
         """ Render this image stack.
 
-            Given a coordinate, return an output image with the results of all the
-            layers in this stack pasted on in turn.
+            Given a coordinate, return an array of output pixels with the results
+            of all the layers in this stack blended on in turn.
         
-            Final argument is a dictionary used to temporarily cache results
-            of layers retrieved from layer_bitmap(), to speed things up in case
-            of repeatedly-used identical images.
+            Pixels from other layers and bitmaps are prepared first, once each
+            no matter how many times they're used, with all the layer tiles
+            read at the same time.
         """
-        # start with an empty base
-        rendered = Blit.Color(0, 0, 0, 0)
-    
-        for layer in self.stack:
-            if 'zoom' in layer and not in_zoom(coord, layer['zoom']):
-                continue
-
-            #
-            # Prepare pixels from elsewhere.
-            #
+        stack = [layer for layer in self.stack
+                 if 'zoom' not in layer or in_zoom(coord, layer['zoom'])]
+        
+        #
+        # Prepare pixels from elsewhere.
+        #
         
+        names = set()
+        
+        for layer in stack:
             source_name, mask_name, color_name = [layer.get(k, None) for k in ('src', 'mask', 'color')]
     
             if source_name and color_name and mask_name:
                 raise Core.KnownUnknown("You can't specify src, color and mask together in a Sandwich Layer: %s, %s, %s" % (repr(source_name), repr(color_name), repr(mask_name)))
+            
+            names.update([name for name in (source_name, mask_name) if name])
+        
+        layers = dict([(name, self.config.layers[name]) for name in names if name in self.config.layers])
+        tiles = layer_bitmaps(layers, coord, width, height)
         
-            if source_name and source_name not in tiles:
-                if source_name in self.config.layers:
-                    tiles[source_name] = layer_bitmap(self.config.layers[source_name], coord)
-                else:
-                    tiles[source_name] = local_bitmap(source_name, self.config, coord, self.layer.dim)
+        for name in names:
+            if name not in tiles:
+                tiles[name] = local_bitmap(name, self.config, coord, width, height)
         
-            if mask_name and mask_name not in tiles:
-                tiles[mask_name] = layer_bitmap(self.config.layers[mask_name], coord)
+        # start with an empty base
+        rendered = numpy.zeros((height, width, 4), numpy.float32)
+    
+        for layer in stack:
+            source_name, mask_name, color_name = [layer.get(k, None) for k in ('src', 'mask', 'color')]
         
             #
             # Build up the foreground layer.
@@ -221,7 +209,9 @@ class Provider:
         
             if source_name and color_name:
                 # color first, then layer
-                foreground = make_color(color_name).blend(tiles[source_name])
+                foreground = numpy.empty_like(rendered)
+                foreground[:] = make_color(color_name)
+                blend(foreground, tiles[source_name])
         
             elif source_name:
                 foreground = tiles[source_name]
@@ -238,60 +228,288 @@ class Provider:
             #
             # Do the final composition with adjustments and blend modes.
             #
+            
+            adjustments = layer.get('adjustments', [])
+            
+            if adjustments:
+                # adjustments work in place, and tiles may be used again.
+                foreground = foreground.copy()
         
-            for (name, args) in layer.get('adjustments', []):
+            for (name, args) in adjustments:
                 adjustfunc = adjustment_names.get(name)(*args)
-                foreground = foreground.adjust(adjustfunc)
+                foreground = adjustfunc(foreground)
         
             opacity = float(layer.get('opacity', 1.0))
             blendfunc = blend_modes.get(layer.get('mode', None), None)
-        
-            if mask_name:
-                rendered = rendered.blend(foreground, tiles[mask_name], opacity, blendfunc)
-            else:
-                rendered = rendered.blend(foreground, None, opacity, blendfunc)
+            mask = tiles[mask_name] if mask_name else None
+            
+            blend(rendered, foreground, mask, opacity, blendfunc)
     
         return rendered
 
-def local_bitmap(source, config, coord, dim):
-    """ Return Blit.Bitmap representation of a raw image.
+def blend(bottom, top, mask=None, opacity=1, blendfunc=None):
+    """ Blend top pixels onto an array of bottom pixels in place, return bottom.
+    
+        Top is an array of pixels or a single color from make_color(). Mask
+        is an optional array of pixels whose luminance is multiplied with the
+        top alpha channel, and blendfunc is an optional function from
+        blend_modes applied to the color channels.
+        
+        Math for the over operator from Wikipedia:
+          http://en.wikipedia.org/wiki/Alpha_compositing#Analytical_derivation_of_the_over_operator
+    """
+    alpha = numpy.empty(bottom.shape[:2], numpy.float32)
+    alpha[:] = top[..., 3]
+    
+    if mask is not None:
+        # luminance of the mask, as in YUV:
+        # http://en.wikipedia.org/wiki/YUV#Conversion_to.2Ffrom_RGB
+        alpha *= numpy.dot(mask[..., :3], (0.299, 0.587, 0.114))
+    
+    if opacity == 0 or not alpha.any():
+        # no-op for zero opacity or empty mask
+        return bottom
+    
+    if opacity < 1:
+        alpha *= opacity
+    
+    if blendfunc:
+        top_rgb = blendfunc(bottom[..., :3], top[..., :3])
+    else:
+        top_rgb = top[..., :3]
+    
+    # output alpha is the screen of the existing and overlaid alphas,
+    # and each pixel takes its share of top color in proportion to it.
+    combined = screen(bottom[..., 3], alpha)
+    ratio = numpy.zeros_like(alpha)
+    numpy.divide(alpha, combined, out=ratio, where=(combined > 0))
+    
+    bottom[..., :3] *= (1 - ratio)[..., numpy.newaxis]
+    bottom[..., :3] += top_rgb * ratio[..., numpy.newaxis]
+    bottom[..., 3] = combined
+    
+    # let the zeros perish
+    bottom[combined <= 0, :3] = 0
+    
+    return bottom
+
+def screen(bottom, top):
+    """ Screen blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=screen_blending
     """
-    address = urljoin(config.dirpath, source)
-    bytes = urlopen(address).read()
-    image = Image.open(StringIO(bytes)).convert('RGBA')
+    return 1 - (1 - bottom) * (1 - top)
+
+def add(bottom, top):
+    """ Additive blend function.
     
-    coord = coord.zoomBy(8)
-    w, h, col, row = image.size[0], image.size[1], int(coord.column), int(coord.row)
+        Math from http://illusions.hu/effectwiki/doku.php?id=additive_blending
+    """
+    return numpy.clip(bottom + top, 0, 1)
+
+def multiply(bottom, top):
+    """ Multiply blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=multiply_blending
+    """
+    return bottom * top
+
+def subtract(bottom, top):
+    """ Subtractive blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=subtractive_blending
+    """
+    return numpy.clip(bottom - top, 0, 1)
+
+def linear_light(bottom, top):
+    """ Linear light blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=linear_light_blending
+    """
+    return numpy.clip(bottom + 2 * top - 1, 0, 1)
+
+def hard_light(bottom, top):
+    """ Hard light blend function.
+    
+        Math from http://illusions.hu/effectwiki/doku.php?id=hard_light_blending
+    """
+    return numpy.where(top < .5, 2 * bottom * top, 1 - 2 * (1 - bottom) * (1 - top))
+
+blend_modes = {
+    'screen': screen,
+    'add': add,
+    'multiply': multiply,
+    'subtract': subtract,
+    'linear light': linear_light,
+    'hard light': hard_light
+    }
+
+def threshold(red_value, green_value=None, blue_value=None):
+    """ Return a function that applies a threshold operation in place.
+    
+        Values are given in 0-255 range; one value applies to all channels.
+    """
+    if green_value is None or blue_value is None:
+        # if there aren't three provided, use the one
+        green_value, blue_value = red_value, red_value
+    
+    values = numpy.array((red_value, green_value, blue_value)) / 255.
+    
+    def adjustfunc(rgba):
+        rgba[..., :3] = rgba[..., :3] > values
+        return rgba
+    
+    return adjustfunc
+
+def curves(black, grey, white):
+    """ Return a function that applies a curves operation in place.
+    
+        Adjustment inspired by Photoshop "Curves" feature. Arguments are three
+        input values in 0-255 range mapped to black, 50% grey and white.
+    """
+    return curves2([(black, 0), (grey, 127.5), (white, 255)])
+
+def curves2(map_red, map_green=None, map_blue=None):
+    """ Return a function that applies a curves operation in place.
+    
+        Adjustment inspired by Photoshop "Curves" feature. Arguments are lists
+        of three (input, output) values in 0-255 range, typically for black,
+        grey and white. One argument applies to all channels, three arguments
+        apply to each channel separately.
+    """
+    if map_green is None or map_blue is None:
+        # if there aren't three provided, use the one
+        map_green, map_blue = map_red, map_red
+    
+    # coefficients of a quadratic function for each channel
+    a, b, c = numpy.transpose([quadratic(mapping) for mapping in (map_red, map_green, map_blue)])
+    
+    def adjustfunc(rgba):
+        rgb = rgba[..., :3]
+        rgb[:] = numpy.clip((a * rgb + b) * rgb + c, 0, 1)
+        return rgba
+    
+    return adjustfunc
+
+def quadratic(mapping):
+    """ Return coefficients of a quadratic function through three (input, output) points.
+    
+        Points are given in 0-255 range, and the function works in 0-1 range.
+    """
+    inputs, outputs = zip(*[(input / 255., output / 255.) for (input, output) in mapping])
+    
+    return numpy.linalg.solve([(x * x, x, 1) for x in inputs], outputs)
+
+adjustment_names = {
+    'threshold': threshold,
+    'curves': curves,
+    'curves2': curves2
+    }
+
+def image_pixels(image, size=None):
+    """ Convert a PIL image to a new array of RGBA floats, resized if needed.
+    """
+    image = image.convert('RGBA')
     
-    x = w * (col / w) - col
-    y = h * (row / h) - row
+    if size and image.size != size:
+        image = image.resize(size)
     
-    output = Image.new('RGBA', (dim, dim))
+    pixels = numpy.asarray(image, numpy.float32)
+    pixels /= 255
     
-    for (x, y) in product(range(x, dim, w), range(y, dim, h)):
-        # crop the top-left if needed
-        xmin = 0 if x > 0 else -x
-        ymin = 0 if y > 0 else -y
+    return pixels
+
+def pixels_image(pixels):
+    """ Convert an array of RGBA floats to a new PIL image, reusing the array.
+    """
+    pixels *= 255
+    numpy.rint(pixels, out=pixels)
+    numpy.clip(pixels, 0, 255, out=pixels)
+    
+    height, width = pixels.shape[:2]
+    bytes = pixels.astype(numpy.uint8).tostring()
+    
+    return Image.frombuffer('RGBA', (width, height), bytes, 'raw', 'RGBA', 0, 1)
+
+# bitmaps by address and pre-tiled patterns by address and size, for local_bitmap().
+_bitmaps, _patterns, _patterns_lock = {}, {}, Lock()
+
+def get_pattern(address, width, height):
+    """ Get a read-only array of a bitmap image tiled to cover any tile of a size.
+    
+        Bitmaps are downloaded and decoded once per address, and patterns
+        are tiled once per size with a spare bitmap width and height.
+    """
+    with _patterns_lock:
+        if address not in _bitmaps:
+            bytes = urlopen(address).read()
+            _bitmaps[address] = image_pixels(Image.open(StringIO(bytes)))
         
-        # don't paste up and to the left
-        x = x if x >= 0 else 0
-        y = y if y >= 0 else 0
+        key = address, width, height
         
-        output.paste(image.crop((xmin, ymin, w, h)), (x, y))
+        if key not in _patterns:
+            bitmap = _bitmaps[address]
+            h, w = bitmap.shape[:2]
+            
+            pattern = numpy.tile(bitmap, (height / h + 2, width / w + 2, 1))
+            pattern = numpy.ascontiguousarray(pattern[:height + h, :width + w])
+            pattern.flags.writeable = False
+            
+            _patterns[key] = pattern
+        
+        return _patterns[key]
+
+def local_bitmap(source, config, coord, width, height):
+    """ Return a read-only array of pixels for a tile of a seamlessly-tiled image.
+    """
+    address = urljoin(config.dirpath, source)
+    pattern = get_pattern(address, width, height)
+    h, w = pattern.shape[0] - height, pattern.shape[1] - width
+    
+    # pixel offset of the tile within the image, assuming 256x256 parent tiles
+    coord = coord.zoomBy(8)
+    x, y = int(coord.column) % w, int(coord.row) % h
     
-    return Blit.Bitmap(output)
+    return pattern[y:y + height, x:x + width]
 
-def layer_bitmap(layer, coord):
-    """ Return Blit.Bitmap representation of tile from a given layer.
+def layer_bitmap(layer, coord, width, height):
+    """ Return an array of pixels for a tile from a given layer.
     
         Uses TileStache.getTile(), so caches are read and written as normal.
     """
     from . import getTile
 
     mime, body = getTile(layer, coord, 'png')
-    image = Image.open(StringIO(body)).convert('RGBA')
+    
+    return image_pixels(Image.open(StringIO(body)), (width, height))
 
-    return Blit.Bitmap(image)
+def layer_bitmaps(layers, coord, width, height):
+    """ Return a dictionary of pixel arrays for a dictionary of layers.
+    
+        Calls layer_bitmap() for each layer in its own thread. Exceptions
+        from the threads are raised again here.
+    """
+    bitmaps, errors = {}, []
+    
+    def read_bitmap(name, layer):
+        try:
+            bitmaps[name] = layer_bitmap(layer, coord, width, height)
+        except:
+            errors.append(sys.exc_info())
+    
+    threads = [Thread(target=read_bitmap, args=(name, layer)) for (name, layer) in layers.items()]
+    
+    for thread in threads:
+        thread.start()
+    
+    for thread in threads:
+        thread.join()
+    
+    if errors:
+        type, value, traceback = errors[0]
+        raise type, value, traceback
+    
+    return bitmaps
 
 def in_zoom(coord, range):
     """ Return True if the coordinate zoom is within the textual range.
@@ -317,7 +535,7 @@ def in_zoom(coord, range):
     return min_zoom <= coord.zoom and coord.zoom <= max_zoom
 
 def make_color(color):
-    """ Convert colors expressed as HTML-style RGB(A) strings to Blit.Color.
+    """ Convert colors expressed as HTML-style RGB(A) strings to an array of RGBA floats.
         
         Examples:
           white: "#ffffff", "#fff", "#ffff", "#ffffffff"
@@ -350,4 +568,4 @@ def make_color(color):
     except ValueError:
         raise Core.KnownUnknown('Color must be made up of valid hex chars: "%s"' % color)
 
-    return Blit.Color(r, g, b, a)
+    return numpy.array((r, g, b, a), numpy.float32) / 255
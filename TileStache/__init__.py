@@ -67,7 +67,7 @@ def getTile(layer, coord, extension, ignore_cached=False, suppress_cache_write=F
         This is the main entry point, after site configuration has been loaded
         and individual tiles need to be rendered.
     '''
-    status_code, headers, body = layer.getTileResponse(coord, extension, TRUE if query.get("ignore_cached") else False, suppress_cache_write)
+    status_code, headers, body = layer.getTileResponse(coord, extension, ignore_cached, suppress_cache_write)
     mime = headers.get('Content-Type')
 
     return mime, body
@@ -149,6 +149,32 @@ def mergePathInfo(layer, coord, extension):
     
     return '/%(layer)s/%(z)d/%(x)d/%(y)d.%(extension)s' % locals()
 
+def acceptsType(accept, mimetype):
+    """ Return true if an HTTP Accept header names a mime-type.
+    
+        Only the exact type with a non-zero quality counts. Clients send
+        wildcards like "image/*" for types they can't display, so those
+        are not taken as support for a particular format.
+    """
+    for media_range in (accept or '').split(','):
+        parts = [part.strip() for part in media_range.split(';')]
+        
+        if parts[0].lower() != mimetype:
+            continue
+        
+        for param in parts[1:]:
+            name, eq, value = param.partition('=')
+            
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        
+        return True
+    
+    return False
+
 def isValidLayer(layer, config):
     if not layer:
         return False
@@ -233,6 +259,7 @@ def clone_layer(layer, provider_names):
         layer.preview_ext,
         layer.bounds,
         layer.dim,
+        layer.variants,
         )
     copy.provider = layer.provider
     copy.provider(copy, provider_names)
@@ -254,7 +281,7 @@ def requestHandler(config_hint, path_info, query_string=None):
     
     return mimetype, content
 
-def requestHandler2(config_hint, path_info, query_string=None, script_name=''):
+def requestHandler2(config_hint, path_info, query_string=None, script_name='', accept=None):
     """ Generate a set of headers and response body for a given request.
     
         TODO: Replace requestHandler() with this function in TileStache 2.0.0.
@@ -266,6 +293,9 @@ def requestHandler2(config_hint, path_info, query_string=None, script_name=''):
         
         Query string is optional, currently used for JSON callbacks.
         
+        Accept is an optional HTTP Accept request header, used to choose
+        between a requested extension and its variant in layer.variants.
+        
         Calls Layer.getTileResponse() to render actual tiles, and getPreview() to render preview.html.
     """
     headers = Headers([])
@@ -308,7 +338,16 @@ def requestHandler2(config_hint, path_info, query_string=None, script_name=''):
             return 302, headers, 'You are being redirected to %s\n' % redirect_uri
         
         else:
+            variant = layer.variants.get(extension.lower())
+            
+            if variant and acceptsType(accept, layer.getTypeByExtension(variant)[0]):
+                extension = variant
+            
             status_code, headers, content = layer.getTileResponse(coord, extension)
+            
+            if variant:
+                # the same URL can have different content for other clients.
+                headers.setdefault('Vary', 'Accept')
 
         if layer.allowed_origin:
             headers.setdefault('Access-Control-Allow-Origin', layer.allowed_origin)
@@ -354,8 +393,9 @@ def cgiHandler(environ, config='./tilestache.cfg', debug=False):
     path_info = environ.get('PATH_INFO', None)
     query_string = environ.get('QUERY_STRING', None)
     script_name = environ.get('SCRIPT_NAME', None)
+    accept = environ.get('HTTP_ACCEPT', None)
     
-    status_code, headers, content = requestHandler2(config, path_info, query_string, script_name)
+    status_code, headers, content = requestHandler2(config, path_info, query_string, script_name, accept)
     
     headers.setdefault('Content-Length', str(len(content)))
 
@@ -435,8 +475,9 @@ class WSGITileServer:
         path_info = environ.get('PATH_INFO', None)
         query_string = environ.get('QUERY_STRING', None)
         script_name = environ.get('SCRIPT_NAME', None)
+        accept = environ.get('HTTP_ACCEPT', None)
         
-        status_code, headers, content = requestHandler2(self.config, path_info, query_string, script_name)
+        status_code, headers, content = requestHandler2(self.config, path_info, query_string, script_name, accept)
         
         return self._response(start_response, status_code, str(content), headers)
 
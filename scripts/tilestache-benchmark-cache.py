@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""tilestache-benchmark-cache.py compares tile caches on local disk.
+
+This script is intended to be run directly. This example writes and then reads
+10,000 random 2KB tiles with the Disk cache and with the SQLite cache, and
+reports the rate of each and the number of files they left behind:
+
+    tilestache-benchmark-cache.py --tiles 10000 --size 2048 \\
+        '{"name": "Disk"}' '{"name": "SQLite"}'
+
+See `tilestache-benchmark-cache.py --help` for more information.
+"""
+
+from sys import stderr, path, exit
+from optparse import OptionParser
+
+try:
+    from json import loads as json_loads, dumps as json_dumps
+except ImportError:
+    from simplejson import loads as json_loads, dumps as json_dumps
+
+#
+# Most imports can be found below, after the --include-path option is known.
+#
+
+parser = OptionParser(usage="""%prog [options] [caches...]
+
+Writes a set of random tiles to each of a list of caches, flushes them, reads
+the tiles back in a different order, and reports writes and reads per second
+and the number of files each cache made in its directory. Caches are JSON
+objects as in the "cache" section of a configuration, each given a new
+temporary directory as its path unless it has one. Without caches, Disk and
+SQLite are compared.
+
+Tiles are random bytes at a single zoom level, so times are for cache storage
+alone. Temporary directories are removed afterwards.
+
+Example:
+
+    tilestache-benchmark-cache.py --tiles 50000 --zoom 14 '{"name": "Disk", "dirs": "portable"}' '{"name": "SQLite"}'
+""")
+
+defaults = dict(tiles=10000, size=2048, zoom=16, seed=0)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-i', '--include-path', dest='include',
+                  help="Add the following colon-separated list of paths to Python's include path (aka sys.path)")
+
+parser.add_option('--tiles', dest='tiles',
+                  help='Number of tiles to write and read. Default value is %s.' % repr(defaults['tiles']),
+                  type='int')
+
+parser.add_option('--size', dest='size',
+                  help='Size of each tile in bytes. Default value is %s.' % repr(defaults['size']),
+                  type='int')
+
+parser.add_option('--zoom', dest='zoom',
+                  help='Zoom level of the tiles. Default value is %s.' % repr(defaults['zoom']),
+                  type='int')
+
+parser.add_option('--seed', dest='seed',
+                  help='Random seed for tile coordinates and contents, for repeatable runs. Default value is %s.' % repr(defaults['seed']),
+                  type='int')
+
+default_caches = [dict(name='Disk'), dict(name='SQLite')]
+
+def randomTiles(count, size, zoom, seed):
+    """ Return a list of (coordinate, body) tuples for distinct random tiles.
+    """
+    random, keys = Random(seed), set()
+
+    while len(keys) < min(count, 4 ** zoom):
+        keys.add((random.randrange(2 ** zoom), random.randrange(2 ** zoom)))
+
+    # a few distinct bodies, so that making them doesn't dominate.
+    bodies = [''.join([chr(random.randrange(256)) for i in range(size)]) for i in range(16)]
+
+    return [(Coordinate(row, column, zoom), bodies[i % 16]) for (i, (column, row)) in enumerate(sorted(keys))]
+
+def benchmarkCache(cache_dict, tiles, seed):
+    """ Write and read tiles with a cache, return writes/s, reads/s and file count.
+    """
+    tmpdir = mkdtemp(prefix='tilestache-benchmark-')
+
+    try:
+        cache_dict = dict(cache_dict)
+        cache_dict.setdefault('path', tmpdir)
+
+        layer_dict = {'provider': {'name': 'proxy', 'url': 'http://localhost/{Z}/{X}/{Y}.png'}}
+        config = buildConfiguration({'cache': cache_dict, 'layers': {'benchmark': layer_dict}}, tmpdir + '/')
+        cache, layer = config.cache, config.layers['benchmark']
+
+        start = time()
+
+        for (coord, body) in tiles:
+            cache.save(body, layer, coord, 'PNG')
+
+        Caches.flush(cache)
+        writes = len(tiles) / (time() - start)
+
+        shuffled = list(tiles)
+        Random(seed).shuffle(shuffled)
+
+        start = time()
+
+        for (coord, body) in shuffled:
+            if cache.read(layer, coord, 'PNG') != body:
+                raise KnownUnknown('Cache %s failed to read back tile %s.' % (json_dumps(cache_dict), coord))
+
+        reads = len(tiles) / (time() - start)
+        files = sum([len(filenames) for (dirpath, dirnames, filenames) in walk(tmpdir)])
+
+        return writes, reads, files
+
+    finally:
+        rmtree(tmpdir)
+
+if __name__ == '__main__':
+    options, caches = parser.parse_args()
+
+    if options.include:
+        for p in options.include.split(':'):
+            path.insert(0, p)
+
+    from os import walk
+    from time import time
+    from random import Random
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    from TileStache import Caches
+    from TileStache.Config import buildConfiguration
+    from TileStache.Core import KnownUnknown
+
+    from ModestMaps.Core import Coordinate
+
+    try:
+        for (i, cache) in enumerate(caches):
+            try:
+                caches[i] = json_loads(cache)
+            except ValueError:
+                raise KnownUnknown('"%s" is not a valid JSON object of cache configuration.' % cache)
+
+            if type(caches[i]) is not dict:
+                raise KnownUnknown('"%s" is not a valid JSON object of cache configuration.' % cache)
+
+        if options.tiles < 1 or options.size < 1:
+            raise KnownUnknown('At least one tile of at least one byte is needed.')
+
+        caches = caches or default_caches
+
+    except KnownUnknown, e:
+        parser.error(str(e))
+
+    tiles = randomTiles(options.tiles, options.size, options.zoom, options.seed)
+
+    print >> stderr, 'Writing and reading %d tiles of %d bytes with %d caches...' % (len(tiles), options.size, len(caches))
+    print '%-60s %12s %12s %8s' % ('cache', 'writes/s', 'reads/s', 'files')
+
+    for cache_dict in caches:
+        try:
+            writes, reads, files = benchmarkCache(cache_dict, tiles, options.seed)
+        except KnownUnknown, e:
+            print >> stderr, str(e)
+            exit(1)
+
+        print '%-60s %12.0f %12.0f %8d' % (json_dumps(cache_dict, sort_keys=True), writes, reads, files)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""tilestache-benchmark-encode.py compares PNG encoder settings on cached tiles.
+
+This script is intended to be run directly. This example re-encodes a sample
+of 500 tiles from a tile list with each of three sets of PNG options for the
+"osm" layer, and reports the size of the results and the CPU time it took:
+
+    tilestache-benchmark-encode.py -c ./config.json -l osm --tile-list tiles.list --sample 500 \\
+        '{"compress_level": 6}' '{"compress_level": 9, "strategy": "filtered"}' \\
+        '{"compress_level": 9, "optimizer": "optipng -quiet -o2"}'
+
+See `tilestache-benchmark-encode.py --help` for more information.
+"""
+
+from sys import stderr, path, exit
+from optparse import OptionParser
+
+try:
+    from json import loads as json_loads, dumps as json_dumps
+except ImportError:
+    from simplejson import loads as json_loads, dumps as json_dumps
+
+#
+# Most imports can be found below, after the --include-path option is known.
+#
+
+parser = OptionParser(usage="""%prog [options] [png options...]
+
+Re-encodes a sample of cached PNG tiles from a single layer of your TileStache
+configuration with candidate PNG options, and reports total bytes and CPU time
+for each. Candidates are JSON objects of "png options" as in the configuration,
+applied on top of the layer's own. Without candidates, zlib compression levels
+1, 6 and 9 are each tried with the default, filtered and rle strategies.
+
+Tiles are decoded before timing starts, so times are for encoding alone,
+including any optimizer commands. Palettes are not applied again.
+
+Example:
+
+    tilestache-benchmark-encode.py -c tilestache.cfg -l osm --from-mbtiles osm.mbtiles '{"compress_level": 9}'
+
+Configuration, layer, and tile list or MBTiles options are required; see `%prog --help` for info.""")
+
+defaults = dict(sample=100, seed=0)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-c', '--config', dest='config',
+                  help='Path to configuration file.')
+
+parser.add_option('-l', '--layer', dest='layer',
+                  help='Layer name from configuration.')
+
+parser.add_option('-i', '--include-path', dest='include',
+                  help="Add the following colon-separated list of paths to Python's include path (aka sys.path)")
+
+parser.add_option('--tile-list', dest='tile_list',
+                  help='File of tile coordinates to sample, a simple text list of Z/X/Y coordinates. Tiles are read from the layer cache, and tiles missing from it are skipped.')
+
+parser.add_option('--from-mbtiles', dest='mbtiles_input',
+                  help='MBTiles file of PNG tiles to sample, instead of the layer cache.')
+
+parser.add_option('--sample', dest='sample',
+                  help='Number of tiles to sample at random. Default value is %s.' % repr(defaults['sample']),
+                  type='int')
+
+parser.add_option('--seed', dest='seed',
+                  help='Random seed for sampling, for repeatable samples. Default value is %s.' % repr(defaults['seed']),
+                  type='int')
+
+default_candidates = [dict(compress_level=level, strategy=strategy)
+                      for level in (1, 6, 9) for strategy in ('default', 'filtered', 'rle')]
+
+def readCoordinates(filename):
+    """ Generate a stream of coordinates from a file of Z/X/Y coordinates.
+    """
+    for line in open(filename, 'r'):
+        if not line.strip():
+            continue
+
+        zoom, column, row = map(int, line.strip().split('/'))
+        yield Coordinate(row, column, zoom)
+
+def sampleTiles(bodies, size, seed):
+    """ Return a random sample of tile bodies from a stream, without holding them all.
+    """
+    random, sample = Random(seed), []
+
+    for (offset, body) in enumerate(bodies):
+        if offset < size:
+            sample.append(body)
+            continue
+
+        index = random.randint(0, offset)
+
+        if index < size:
+            sample[index] = body
+
+    return sample
+
+def cachedTiles(layer, coordinates):
+    """ Generate a stream of PNG tile bodies from a layer's cache.
+    """
+    for coord in coordinates:
+        body = layer.config.cache.read(layer, coord, 'PNG')
+
+        if body is not None:
+            yield body
+
+def tilesetTiles(filename):
+    """ Generate a stream of tile bodies from an MBTiles file.
+    """
+    for coord in MBTiles.iter_tiles(filename):
+        mime_type, body = MBTiles.get_tile(filename, coord)
+
+        if body is not None:
+            yield body
+
+def candidateLayer(layer, png_options):
+    """ Return a copy of a layer with additional PNG options.
+    """
+    candidate = copy(layer)
+    candidate.png_options = dict(layer.png_options)
+    candidate.setSaveOptionsPNG(**dict([(str(k), v) for (k, v) in png_options.items()]))
+
+    return candidate
+
+def cpuTime():
+    """ Return user and system CPU seconds of this process and its children.
+    """
+    user, system, child_user, child_system, elapsed = times()
+    return user + system + child_user + child_system
+
+if __name__ == '__main__':
+    options, candidates = parser.parse_args()
+
+    if options.include:
+        for p in options.include.split(':'):
+            path.insert(0, p)
+
+    from os import times
+    from copy import copy
+    from random import Random
+    from StringIO import StringIO
+
+    from TileStache import parseConfigfile, MBTiles
+    from TileStache.Core import KnownUnknown
+
+    from ModestMaps.Core import Coordinate
+
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+
+    try:
+        if options.config is None:
+            raise KnownUnknown('Missing required configuration (--config) parameter.')
+
+        if options.layer is None:
+            raise KnownUnknown('Missing required layer (--layer) parameter.')
+
+        if not (options.tile_list or options.mbtiles_input):
+            raise KnownUnknown('Missing required tile list (--tile-list) or MBTiles (--from-mbtiles) parameter.')
+
+        config = parseConfigfile(options.config)
+
+        if options.layer not in config.layers:
+            raise KnownUnknown('"%s" is not a layer I know about. Here are some that I do know about: %s.' % (options.layer, ', '.join(sorted(config.layers.keys()))))
+
+        layer = config.layers[options.layer]
+
+        for (i, candidate) in enumerate(candidates):
+            try:
+                candidates[i] = json_loads(candidate)
+            except ValueError:
+                raise KnownUnknown('"%s" is not a valid JSON object of PNG options.' % candidate)
+
+        candidates = candidates or default_candidates
+        layers = [candidateLayer(layer, candidate) for candidate in candidates]
+
+    except KnownUnknown, e:
+        parser.error(str(e))
+
+    if options.mbtiles_input:
+        bodies = tilesetTiles(options.mbtiles_input)
+    else:
+        bodies = cachedTiles(layer, readCoordinates(options.tile_list))
+
+    bodies = sampleTiles(bodies, options.sample, options.seed)
+    images = []
+
+    for body in bodies:
+        image = Image.open(StringIO(body))
+        image.load()
+        images.append(image)
+
+    if not images:
+        print >> stderr, 'Found no tiles to encode.'
+        exit(1)
+
+    cached_bytes = sum(map(len, bodies))
+
+    print >> stderr, 'Encoding %d tiles with %d candidates...' % (len(images), len(candidates))
+    print '%-60s %12s %7s %12s' % ('PNG options', 'bytes', 'size', 'CPU ms/tile')
+    print '%-60s %12d %6.1f%% %12s' % ('(cached tiles)', cached_bytes, 100., '-')
+
+    for (candidate, candidate_layer) in zip(candidates, layers):
+        start, size = cpuTime(), 0
+
+        for image in images:
+            size += len(candidate_layer.encodeTile(image, 'PNG'))
+
+        msec = (cpuTime() - start) * 1000. / len(images)
+
+        print '%-60s %12d %6.1f%% %12.2f' % (json_dumps(candidate, sort_keys=True), size, 100. * size / cached_bytes, msec)
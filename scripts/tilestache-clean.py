@@ -30,7 +30,7 @@ Output is a list of tile paths as they are created.
 
 Configuration, bbox, and layer options are required; see `%prog --help` for info.""")
 
-defaults = dict(extension='png', padding=0, verbose=True, bbox=(37.777, -122.352, 37.839, -122.226))
+defaults = dict(extension='png', padding=0, verbose=True, workers=1, batch_size=1000, bbox=(37.777, -122.352, 37.839, -122.226))
 
 parser.set_defaults(**defaults)
 
@@ -63,6 +63,14 @@ parser.add_option('-i', '--include-path', dest='include',
 parser.add_option('--tile-list', dest='tile_list',
                   help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox and --padding.')
 
+parser.add_option('--workers', dest='workers',
+                  help='Optional number of worker processes to remove tiles in parallel. Default value is %s.' % repr(defaults['workers']),
+                  type='int')
+
+parser.add_option('--batch-size', dest='batch_size',
+                  help='Number of tiles to remove at once, for caches that can remove many tiles in one request. Default value is %s.' % repr(defaults['batch_size']),
+                  type='int')
+
 def generateCoordinates(ul, lr, zooms, padding):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
@@ -101,15 +109,67 @@ def listCoordinates(filename):
     
         Read coordinates from a file with one Z/X/Y coordinate per line.
     """
+    count = sum(1 for line in open(filename, 'r'))
+    
     coords = (line.strip().split('/') for line in open(filename, 'r'))
     coords = (map(int, (row, column, zoom)) for (zoom, column, row) in coords)
-    coords = [Coordinate(*args) for args in coords]
-    
-    count = len(coords)
+    coords = (Coordinate(*args) for args in coords)
     
     for (offset, coord) in enumerate(coords):
         yield (offset, count, coord)
 
+def batchCoordinates(coordinates, size):
+    """ Generate a stream of (offset, count, coordinates) tuples for cleaning.
+    
+        Group a stream of (offset, count, coordinate) tuples into lists of up
+        to size coordinates, with the offset of the last one in each list.
+    """
+    batch = []
+    
+    for (offset, count, coord) in coordinates:
+        batch.append(coord)
+        
+        if len(batch) == size:
+            yield (offset, count, batch)
+            batch = []
+    
+    if batch:
+        yield (offset, count, batch)
+
+#
+# Each worker process, or this one without workers, has its own configuration.
+#
+
+_worker_config = None
+
+def initWorker(configpath):
+    """ Load a configuration for removeBatch().
+    """
+    global _worker_config
+    
+    _worker_config = parseConfigfile(configpath)
+
+def removeBatch((layername, offset, count, coords, extension)):
+    """ Remove a list of tiles from the cache.
+    
+        Return the offset and count of the batch, and its last coordinate.
+    """
+    layer = _worker_config.layers[layername]
+    
+    try:
+        mimetype, format = layer.getTypeByExtension(extension)
+    except:
+        #
+        # It's not uncommon for layers to lack support for certain
+        # extensions, so just don't attempt to remove a cached tile
+        # for an unsupported format.
+        #
+        pass
+    else:
+        removeMany(_worker_config.cache, layer, coords, format)
+    
+    return offset, count, coords[-1]
+
 if __name__ == '__main__':
     options, zooms = parser.parse_args()
 
@@ -117,9 +177,12 @@ if __name__ == '__main__':
         for p in options.include.split(':'):
             path.insert(0, p)
 
-    from TileStache import parseConfigfile, getTile
+    from itertools import imap
+    from multiprocessing import Pool
+    
+    from TileStache import parseConfigfile
     from TileStache.Core import KnownUnknown
-    from TileStache.Caches import Disk, Multi
+    from TileStache.Caches import removeMany
     
     from ModestMaps.Core import Coordinate
     from ModestMaps.Geo import Location
@@ -164,12 +227,23 @@ if __name__ == '__main__':
         if options.padding < 0:
             raise KnownUnknown('A negative padding will not work.')
 
+        if options.workers < 1:
+            raise KnownUnknown('At least one worker is needed.')
+
+        if options.batch_size < 1:
+            raise KnownUnknown('A batch size of at least one is needed.')
+
         padding = options.padding
         tile_list = options.tile_list
 
     except KnownUnknown, e:
         parser.error(str(e))
 
+    if options.workers > 1:
+        pool = Pool(options.workers, initWorker, (options.config, ))
+    else:
+        _worker_config = config
+
     for layer in layers:
 
         if tile_list:
@@ -180,7 +254,15 @@ if __name__ == '__main__':
     
             coordinates = generateCoordinates(ul, lr, zooms, padding)
         
-        for (offset, count, coord) in coordinates:
+        batches = batchCoordinates(coordinates, options.batch_size)
+        tasks = ((layer.name(), offset, count, coords, extension) for (offset, count, coords) in batches)
+        
+        if options.workers > 1:
+            results = pool.imap(removeBatch, tasks)
+        else:
+            results = imap(removeBatch, tasks)
+        
+        for (offset, count, coord) in results:
             path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
     
             progress = {"tile": path,
@@ -188,24 +270,13 @@ if __name__ == '__main__':
                         "total": count}
     
             if options.verbose:
-                print >> stderr, '%(offset)d of %(total)d...' % progress,
-    
-            try:
-                mimetype, format = layer.getTypeByExtension(extension)
-            except:
-                #
-                # It's not uncommon for layers to lack support for certain
-                # extensions, so just don't attempt to remove a cached tile
-                # for an unsupported format.
-                #
-                pass
-            else:
-                config.cache.remove(layer, coord, format)
-    
-            if options.verbose:
-                print >> stderr, '%(tile)s' % progress
+                print >> stderr, '%(offset)d of %(total)d... %(tile)s' % progress
                     
             if progressfile:
                 fp = open(progressfile, 'w')
                 json_dump(progress, fp)
                 fp.close()
+    
+    if options.workers > 1:
+        pool.close()
+        pool.join()
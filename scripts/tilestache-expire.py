@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""tilestache-expire.py will remove or re-render expired tiles.
+
+This script is intended to be run directly. This example re-renders the tiles
+listed in an osm2pgsql expiry list in the "osm" layer, along with every tile
+above and below them for zoom levels 10-18, with four worker processes:
+
+    tilestache-expire.py -c ./config.json -l osm --expire-list expire.list --rerender --workers 4 10 11 12 13 14 15 16 17 18
+
+See `tilestache-expire.py --help` for more information.
+"""
+
+from sys import stderr, path, exit
+from optparse import OptionParser
+from itertools import imap
+from traceback import format_exc
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+
+try:
+    from json import dump as json_dump
+except ImportError:
+    from simplejson import dump as json_dump
+
+from ModestMaps.Core import Coordinate
+from ModestMaps.Geo import Location
+
+from TileStache import parseConfigfile, getTile, Caches
+from TileStache.Core import KnownUnknown
+
+#
+# Imported at module level so worker processes have them without forking;
+# providers and caches are imported by parseConfigfile(), after the
+# --include-path option is known.
+#
+
+parser = OptionParser(usage="""%prog [options] [zoom...]
+
+Expires tiles in a single layer of your TileStache configuration. Expiry lists
+are simple text lists of Z/X/Y coordinates, such as those written by osm2pgsql
+with its -e option. Tiles are expanded to every given zoom level, above and
+below their own, and then removed from the cache or rendered again, one metatile
+at a time. A bounding box of lat/lon coordinates can be expired instead, or as
+well, at every given zoom level. Output is a list of tile paths as they are
+expired.
+
+Example:
+
+    tilestache-expire.py -c tilestache.cfg -l osm --expire-list expire.list 12 13 14 15
+
+Configuration, layer, and expiry list or bbox options are required; see `%prog --help` for info.""")
+
+defaults = dict(extension='png', verbose=True, rerender=False, workers=1)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-c', '--config', dest='config',
+                  help='Path to configuration file.')
+
+parser.add_option('-l', '--layer', dest='layer',
+                  help='Layer name from configuration.')
+
+parser.add_option('-e', '--extension', dest='extension',
+                  help='Optional file type for rendered tiles. Default value is %s.' % repr(defaults['extension']))
+
+parser.add_option('-f', '--progress-file', dest='progressfile',
+                  help="Optional JSON progress file that gets written on each iteration, so you don't have to pay close attention.")
+
+parser.add_option('-q', action='store_false', dest='verbose',
+                  help='Suppress chatty output, --progress-file works well with this.')
+
+parser.add_option('-i', '--include-path', dest='include',
+                  help="Add the following colon-separated list of paths to Python's include path (aka sys.path)")
+
+parser.add_option('--expire-list', dest='expire_lists', action='append',
+                  help='File of expired tile coordinates, a simple text list of Z/X/Y coordinates. May be given more than once. Without zoom levels, tiles are expired at their own zoom only.')
+
+parser.add_option('-b', '--bbox', dest='bbox',
+                  help='Optional bounding box in floating point geographic coordinates: south west north east. Tiles in it are expired at every given zoom level.',
+                  type='float', nargs=4)
+
+parser.add_option('--recent-list', dest='recent_list',
+                  help='Optional file of recently-requested tile coordinates, a simple text list of Z/X/Y coordinates with the most recent first, e.g. from server logs. Expired tiles in it are handled first, in its order.')
+
+parser.add_option('--rerender', dest='rerender', action='store_true',
+                  help='Render expired tiles again instead of removing them from the cache.')
+
+parser.add_option('--workers', dest='workers',
+                  help='Optional number of worker processes to expire tiles in parallel. Default value is %s.' % repr(defaults['workers']),
+                  type='int')
+
+def readCoordinates(filename):
+    """ Generate a stream of coordinates from a file of Z/X/Y coordinates.
+
+        Blank lines are skipped.
+    """
+    for line in open(filename, 'r'):
+        if not line.strip():
+            continue
+
+        zoom, column, row = map(int, line.strip().split('/'))
+        yield Coordinate(row, column, zoom)
+
+def expandCoordinate(coord, zooms, metatile):
+    """ Generate a stream of (zoom, column, row) metatile keys covering a coordinate.
+
+        Keys are for the upper-left tile of each metatile, at each of a list
+        of zooms: one parent at lower zooms, and every descendant at higher.
+    """
+    rows, columns = metatile.rows, metatile.columns
+
+    for zoom in zooms:
+        if zoom <= coord.zoom:
+            parent = metatile.firstCoord(coord.zoomTo(zoom).container())
+            yield (parent.zoom, int(parent.column), int(parent.row))
+            continue
+
+        scale = 2 ** (zoom - coord.zoom)
+        row1, col1 = int(coord.row) * scale, int(coord.column) * scale
+        row2, col2 = row1 + scale, col1 + scale
+
+        for row in range(row1 - row1 % rows, row2, rows):
+            for column in range(col1 - col1 % columns, col2, columns):
+                yield (zoom, column, row)
+
+def areaKeys(ul, lr, zooms, metatile):
+    """ Generate a stream of (zoom, column, row) metatile keys covering an area.
+
+        Area is given by two corner coordinates, and keys are for the
+        upper-left tile of each metatile at each of a list of zooms.
+    """
+    rows, columns = metatile.rows, metatile.columns
+
+    for zoom in zooms:
+        ul_, lr_ = ul.zoomTo(zoom).container(), lr.zoomTo(zoom).container()
+        row1, col1 = int(ul_.row), int(ul_.column)
+        row2, col2 = int(lr_.row), int(lr_.column)
+
+        for row in range(row1 - row1 % rows, row2 + 1, rows):
+            for column in range(col1 - col1 % columns, col2 + 1, columns):
+                yield (zoom, column, row)
+
+def expiredCoordinates(filenames, zooms, metatile, recent_list=None, area=None):
+    """ Generate a stream of (offset, count, coordinate) tuples for expiry.
+
+        Expired tiles come from files of coordinates, and from an optional
+        area given as a pair of corner coordinates. One coordinate is generated
+        for each metatile, no matter how many expired tiles it holds. Metatiles
+        holding recently-requested tiles come first, and the rest follow in
+        zoom, row, column order.
+    """
+    keys = set()
+
+    for filename in filenames:
+        for coord in readCoordinates(filename):
+            keys.update(expandCoordinate(coord, zooms or [coord.zoom], metatile))
+
+    if area:
+        ul, lr = area
+        keys.update(areaKeys(ul, lr, zooms, metatile))
+
+    # lower is more recent; anything not in the recent list comes last.
+    ranks = {}
+
+    if recent_list:
+        for (rank, coord) in enumerate(readCoordinates(recent_list)):
+            first = metatile.firstCoord(coord)
+            ranks.setdefault((first.zoom, int(first.column), int(first.row)), rank)
+
+    order = lambda (zoom, column, row): (ranks.get((zoom, column, row), len(ranks)), zoom, row, column)
+    keys = sorted(keys, key=order)
+    count = len(keys)
+
+    for (offset, (zoom, column, row)) in enumerate(keys):
+        yield (offset, count, Coordinate(row, column, zoom))
+
+#
+# Each worker process, or this one without workers, has its own layer.
+#
+
+_worker_layer = None
+
+def initWorker(configpath, layername, pooled=False):
+    """ Load a configuration and layer for expireMetatile().
+    """
+    global _worker_layer
+
+    config = parseConfigfile(configpath)
+    _worker_layer = config.layers[layername]
+
+    if pooled:
+        # multiprocessing skips exit handlers, so caches like
+        # MBTiles and Bloom are flushed when the worker exits.
+        Finalize(None, Caches.flush, args=(config.cache, ), exitpriority=0)
+
+def expireMetatile((coord, extension, rerender)):
+    """ Remove or re-render all the tiles in one metatile.
+
+        Return a tuple with the coordinate and an error message, or None.
+    """
+    layer = _worker_layer
+
+    try:
+        if rerender:
+            # rendering any tile writes the whole metatile to the cache.
+            getTile(layer, coord, extension, ignore_cached=True)
+
+        else:
+            mimetype, format = layer.getTypeByExtension(extension)
+
+            for other in layer.metatile.allCoords(coord):
+                layer.config.cache.remove(layer, other, format)
+
+    except:
+        return coord, format_exc()
+
+    return coord, None
+
+if __name__ == '__main__':
+    options, zooms = parser.parse_args()
+
+    if options.include:
+        for p in options.include.split(':'):
+            path.insert(0, p)
+
+    try:
+        if options.config is None:
+            raise KnownUnknown('Missing required configuration (--config) parameter.')
+
+        if options.layer is None:
+            raise KnownUnknown('Missing required layer (--layer) parameter.')
+
+        if not options.expire_lists and not options.bbox:
+            raise KnownUnknown('Missing required expiry list (--expire-list) or bbox (--bbox) parameter.')
+
+        config = parseConfigfile(options.config)
+
+        if options.layer not in config.layers:
+            raise KnownUnknown('"%s" is not a layer I know about. Here are some that I do know about: %s.' % (options.layer, ', '.join(sorted(config.layers.keys()))))
+
+        layer = config.layers[options.layer]
+
+        for (i, zoom) in enumerate(zooms):
+            if not zoom.isdigit():
+                raise KnownUnknown('"%s" is not a valid numeric zoom level.' % zoom)
+
+            zooms[i] = int(zoom)
+
+        if options.workers < 1:
+            raise KnownUnknown('At least one worker is needed.')
+
+        if options.bbox and not zooms:
+            raise KnownUnknown('A bbox (--bbox) needs zoom levels to expire.')
+
+        if options.bbox:
+            lat1, lon1, lat2, lon2 = options.bbox
+            south, west = min(lat1, lat2), min(lon1, lon2)
+            north, east = max(lat1, lat2), max(lon1, lon2)
+
+            ul = layer.projection.locationCoordinate(Location(north, west))
+            lr = layer.projection.locationCoordinate(Location(south, east))
+            area = ul, lr
+        else:
+            area = None
+
+        extension = options.extension
+        layer.getTypeByExtension(extension)
+
+    except KnownUnknown, e:
+        parser.error(str(e))
+
+    coordinates = expiredCoordinates(options.expire_lists or [], zooms, layer.metatile, options.recent_list, area)
+    tasks = [(coord, extension, options.rerender) for (offset, count, coord) in coordinates]
+
+    if options.workers > 1:
+        pool = Pool(options.workers, initWorker, (options.config, options.layer, True))
+        results = pool.imap_unordered(expireMetatile, tasks, 16)
+    else:
+        initWorker(options.config, options.layer)
+        results = imap(expireMetatile, tasks)
+
+    failures = 0
+
+    for (offset, (coord, error)) in enumerate(results):
+        path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+
+        progress = {"tile": path,
+                    "offset": offset + 1,
+                    "total": len(tasks)}
+
+        if error is None:
+            if options.verbose:
+                print >> stderr, '%(offset)d of %(total)d... %(tile)s' % progress
+
+        else:
+            failures += 1
+            print >> stderr, '%(offset)d of %(total)d... Failed %(tile)s:' % progress
+            print >> stderr, error
+
+        if options.progressfile:
+            fp = open(options.progressfile, 'w')
+            json_dump(progress, fp)
+            fp.close()
+
+    if options.workers > 1:
+        # let workers finish writing to the cache.
+        pool.close()
+        pool.join()
+
+    if failures:
+        exit(1)
@@ -9,7 +9,7 @@ around West Oakland (http://sta.mn/ck) in the "osm" layer, for zoom levels 12-15
 See `tilestache-list.py --help` for more information.
 """
 
-from sys import stderr, path
+from sys import stderr, stdout, path
 from optparse import OptionParser
 
 from TileStache.Core import KnownUnknown
@@ -29,14 +29,14 @@ Example:
 
     tilestache-list.py -b 52.55 13.28 52.46 13.51 11 12 13
 
-Protip: seed a cache in parallel on 8 CPUs with split and xargs like this:
+Protip: seed a cache in parallel on 8 CPUs with chunked output and xargs like this:
 
-    tilestache-list.py 12 13 14 15 | split -l 20 - tiles/list-
-    ls -1 tiles/list-* | xargs -n1 -P8 tilestache-seed.py -c tilestache.cfg -l osm --tile-list
+    tilestache-list.py --chunk-size 20 --chunk-prefix tiles/list- 12 13 14 15 \\
+      | xargs -n1 -P8 tilestache-seed.py -c tilestache.cfg -l osm --tile-list
 
 See `%prog --help` for info.""")
 
-defaults = dict(padding=0, bbox=(37.777, -122.352, 37.839, -122.226))
+defaults = dict(padding=0, chunk_prefix='list-', bbox=(37.777, -122.352, 37.839, -122.226))
 
 parser.set_defaults(**defaults)
 
@@ -51,54 +51,61 @@ parser.add_option('-p', '--padding', dest='padding',
 parser.add_option('--from-mbtiles', dest='mbtiles_input',
                   help='Optional input file for tiles, will be read as an MBTiles 1.1 tileset. See http://mbtiles.org for more information. Overrides --bbox and --padding.')
 
+parser.add_option('--chunk-size', dest='chunk_size',
+                  help='Optional number of tile coordinates per output file. Files are named with --chunk-prefix and a number, and their names are output instead of coordinates.',
+                  type='int')
+
+parser.add_option('--chunk-prefix', dest='chunk_prefix',
+                  help='Path prefix for --chunk-size output files. Default value is %s.' % repr(defaults['chunk_prefix']))
+
 def generateCoordinates(ul, lr, zooms, padding):
     """ Generate a stream of coordinates for seeding.
     
         Flood-fill coordinates based on two corners, a list of zooms and padding.
     """
-    # start with a simple total of all the coordinates we will need.
-    count = 0
-    
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
-        
-        rows = lr_.row + 1 - ul_.row
-        cols = lr_.column + 1 - ul_.column
-        
-        count += int(rows * cols)
-
-    # now generate the actual coordinates.
-    # offset starts at zero
-    offset = 0
-    
     for zoom in zooms:
         ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
         lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
 
         for row in range(int(ul_.row), int(lr_.row + 1)):
             for column in range(int(ul_.column), int(lr_.column + 1)):
-                coord = Coordinate(row, column, zoom)
-                
-                yield coord
-                offset += 1
+                yield Coordinate(row, column, zoom)
 
 def tilesetCoordinates(filename):
-    """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+    """ Generate a stream of coordinates for seeding.
     
         Read coordinates from an MBTiles tileset filename.
     """
-    coords = MBTiles.list_tiles(filename)
-    count = len(coords)
+    return MBTiles.iter_tiles(filename)
+
+def writeChunks(coordinates, size, prefix):
+    """ Write a stream of coordinates to numbered files, and generate their names.
+    
+        Each file name is generated once the file is complete, so a worker
+        reading from this stream can start on it right away.
+    """
+    chunk, file = 0, None
     
-    for (offset, coord) in enumerate(coords):
-        yield coord
+    for (offset, coord) in enumerate(coordinates):
+        if offset % size == 0:
+            if file:
+                file.close()
+                yield file.name
+            
+            file = open('%s%06d' % (prefix, chunk), 'w')
+            chunk += 1
+        
+        file.write('%(zoom)d/%(column)d/%(row)d\n' % coord.__dict__)
+    
+    if file:
+        file.close()
+        yield file.name
 
 if __name__ == '__main__':
     options, zooms = parser.parse_args()
 
     if bool(options.mbtiles_input):
-        coordinates = MBTiles.list_tiles(options.mbtiles_input)
+        coordinates = tilesetCoordinates(options.mbtiles_input)
 
     else:
         lat1, lon1, lat2, lon2 = options.bbox
@@ -124,5 +131,11 @@ if __name__ == '__main__':
 
         coordinates = generateCoordinates(ul, lr, zooms, options.padding)
     
-    for coord in coordinates:
-        print '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
+    if options.chunk_size:
+        for filename in writeChunks(coordinates, options.chunk_size, options.chunk_prefix):
+            print filename
+            stdout.flush()
+    
+    else:
+        for coord in coordinates:
+            print '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
@@ -10,20 +10,43 @@ See `tilestache-seed.py --help` for more information.
 """
 
 from sys import stderr, path
-from os.path import realpath, dirname
+from os import close, write, rename
+from os.path import realpath, dirname, exists
+from tempfile import mkstemp
+from time import time
+from math import ceil, floor, log
+from zlib import compress, decompress
 from optparse import OptionParser
 from urlparse import urlparse
 from urllib import urlopen
+from traceback import format_exc
+from multiprocessing import Process, Queue
+from Queue import Empty
+from threading import Thread
 
 try:
     from json import dump as json_dump
     from json import load as json_load
+    from json import dumps as json_dumps
+    from json import loads as json_loads
 except ImportError:
     from simplejson import dump as json_dump
     from simplejson import load as json_load
+    from simplejson import dumps as json_dumps
+    from simplejson import loads as json_loads
+
+from ModestMaps.Core import Coordinate
+from ModestMaps.Geo import Location
+
+import TileStache
+from TileStache import getTile, Config, MBTiles, Pyramid, Caches
+from TileStache.Core import KnownUnknown
+from TileStache.Config import buildConfiguration
 
 #
-# Most imports can be found below, after the --include-path option is known.
+# Imported at module level so worker processes have them without forking;
+# providers and caches are imported by buildConfiguration(), after the
+# --include-path option is known.
 #
 
 parser = OptionParser(usage="""%prog [options] [zoom...]
@@ -43,7 +66,7 @@ Protip: extract tiles from an MBTiles tileset to a directory like this:
 
 Configuration, bbox, and layer options are required; see `%prog --help` for info.""")
 
-defaults = dict(padding=0, verbose=True, enable_retries=False, bbox=(37.777, -122.352, 37.839, -122.226))
+defaults = dict(padding=0, verbose=True, enable_retries=False, workers=1, checkpoint_interval=30, downsample_filter='antialias', report_zoom=8, bbox=(37.777, -122.352, 37.839, -122.226))
 
 parser.set_defaults(**defaults)
 
@@ -79,6 +102,10 @@ parser.add_option('-d', '--output-directory', dest='outputdirectory',
 parser.add_option('--to-mbtiles', dest='mbtiles_output',
                   help='Optional output file for tiles, will be created as an MBTiles 1.1 tileset. See http://mbtiles.org for more information.')
 
+parser.add_option('--deduplicate-mbtiles', dest='mbtiles_deduplicate',
+                  help='Create the --to-mbtiles tileset with separate map and images tables, storing identical tiles just once.',
+                  action='store_true')
+
 parser.add_option('--to-s3', dest='s3_output',
                   help='Optional output bucket for tiles, will be populated with tiles in a standard Z/X/Y layout. Three required arguments: AWS access-key, secret, and bucket name.',
                   nargs=3)
@@ -86,6 +113,9 @@ parser.add_option('--to-s3', dest='s3_output',
 parser.add_option('--from-mbtiles', dest='mbtiles_input',
                   help='Optional input file for tiles, will be read as an MBTiles 1.1 tileset. See http://mbtiles.org for more information. Overrides --extension, --bbox and --padding (this may change).')
 
+parser.add_option('--geometry', dest='geometry',
+                  help='Optional GeoJSON file of polygons, lines or points, to seed only tiles that they touch. Requires shapely. Overrides --bbox.')
+
 parser.add_option('--tile-list', dest='tile_list',
                   help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox and --padding.')
 
@@ -97,54 +127,261 @@ parser.add_option('--enable-retries', dest='enable_retries',
                   action='store_true')
 
 parser.add_option('-x', '--ignore-cached', action='store_true', dest='ignore_cached',
-                  help='Re-render every tile, whether it is in the cache already or not.')
+                  help='Re-render every tile, whether it is in the cache already or not. Without it, a metatile is skipped when its first tile in the seeded area is cached, even if other tiles of it are not; use this to fill in such gaps.')
 
 parser.add_option('--jsonp-callback', dest='callback',
-                  help='Add a JSONP callback for tiles with a json mime-type, causing "*.js" tiles to be written to the cache wrapped in the callback function. Ignored for non-JSON tiles.')
+                  help='Add a JSONP callback for tiles with a json mime-type, causing "*.js" tiles to be written to the cache wrapped in the callback function, for every tile of each metatile. Ignored for non-JSON tiles.')
+
+parser.add_option('--downsample-below', dest='downsample_below',
+                  help='Optional zoom level below which tiles are built by downsampling their four children from the cache instead of rendered. Zoom levels are then seeded from the highest down.',
+                  type='int')
+
+parser.add_option('--downsample-filter', dest='downsample_filter',
+                  help='Resampling filter for --downsample-below, one of nearest, bilinear, bicubic or antialias. Default value is %s.' % repr(defaults['downsample_filter']))
+
+parser.add_option('--downsample-identical', dest='downsample_identical',
+                  help='With --downsample-below, reuse a child tile as its parent when all four children are identical, as they are for tiles of solid color.',
+                  action='store_true')
+
+parser.add_option('--checkpoint-file', dest='checkpoint',
+                  help='Optional checkpoint file that records completed tiles, written every --checkpoint-interval seconds and when seeding stops. See --resume.')
+
+parser.add_option('--checkpoint-interval', dest='checkpoint_interval',
+                  help='Number of seconds between writes of --checkpoint-file, zero for after every tile. Default value is %s.' % repr(defaults['checkpoint_interval']),
+                  type='float')
+
+parser.add_option('--resume', dest='resume',
+                  help='Skip tiles already completed according to --checkpoint-file, which must be from an identical tilestache-seed command. Failed tiles are tried again.',
+                  action='store_true')
+
+parser.add_option('--report', dest='report',
+                  help='Optional JSON report file of seconds and bytes per tile, with histograms for each zoom level and a heatmap of parent tiles, written when seeding stops. Tiles and bytes include every tile of each metatile. Use a sample run to estimate the time and storage of a full seed.')
 
-def generateCoordinates(ul, lr, zooms, padding):
+parser.add_option('--report-zoom', dest='report_zoom',
+                  help='Zoom level of parent tiles for the --report heatmap. Default value is %s.' % repr(defaults['report_zoom']),
+                  type='int')
+
+parser.add_option('--workers', dest='workers',
+                  help='Optional number of worker processes to render tiles in parallel, each with its own copy of the layer. Tiles in a single metatile are always rendered by the same worker. Default value is %s.' % repr(defaults['workers']),
+                  type='int')
+
+def generateCoordinates(ul, lr, zooms, padding, metatile=None):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
         Flood-fill coordinates based on two corners, a list of zooms and padding.
+        
+        Rendering any tile of a metatile also writes the others to the cache,
+        so with a metatile just one coordinate per metatile is generated.
+        Within each zoom, metatiles are visited in Z-order for better locality
+        in the cache and the database.
+        
+        Only the generated tile is checked in the cache, so other tiles of its
+        metatile missing from the cache are not seeded unless cached tiles are
+        ignored and the whole metatile is rendered again.
     """
-    # start with a simple total of all the coordinates we will need.
-    count = 0
+    rows, columns = metatile and (metatile.rows, metatile.columns) or (1, 1)
+    ranges = []
     
     for zoom in zooms:
         ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
         lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
         
-        rows = lr_.row + 1 - ul_.row
-        cols = lr_.column + 1 - ul_.column
+        ranges.append((zoom, int(ul_.row), int(ul_.column), int(lr_.row), int(lr_.column)))
+    
+    # start with a simple total of all the metatiles we will need.
+    count = 0
+    
+    for (zoom, row1, col1, row2, col2) in ranges:
+        meta_rows = row2 / rows - row1 / rows + 1
+        meta_cols = col2 / columns - col1 / columns + 1
         
-        count += int(rows * cols)
+        count += meta_rows * meta_cols
 
     # now generate the actual coordinates.
     # offset starts at zero
     offset = 0
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
+    for (zoom, row1, col1, row2, col2) in ranges:
+        for (meta_col, meta_row) in zOrder(col1 / columns, row1 / rows, col2 / columns, row2 / rows):
+            # upper-left tile of the metatile, or the bbox if it's further in.
+            row = max(meta_row * rows, row1)
+            column = max(meta_col * columns, col1)
+            coord = Coordinate(row, column, zoom)
+            
+            yield (offset, count, coord)
+            
+            offset += 1
+
+# results of a zOrderBlocks() test function.
+OUTSIDE, PARTIAL, INSIDE = 0, 1, 2
 
-        for row in xrange(int(ul_.row), int(lr_.row + 1)):
-            for column in xrange(int(ul_.column), int(lr_.column + 1)):
-                coord = Coordinate(row, column, zoom)
+def zOrderBlocks(xmin, ymin, xmax, ymax, test=None):
+    """ Generate a stream of (x, y, size) square blocks in an inclusive range, in Z-order.
+    
+        Walks a quadtree over the range one quadrant at a time, depth-first,
+        so nothing has to be sorted and memory use stays small. An optional
+        test function takes a quadrant's (x, y, size) and returns OUTSIDE
+        to skip it, INSIDE to generate all of it, or PARTIAL to look closer.
+    """
+    size = 1
+    
+    while size <= max(xmax - xmin, ymax - ymin):
+        size *= 2
+    
+    stack = [(xmin, ymin, size)]
+    
+    while stack:
+        x, y, size = stack.pop()
+        
+        if x > xmax or y > ymax:
+            continue
+        
+        result = INSIDE if test is None else test(x, y, size)
+        
+        if result == OUTSIDE:
+            continue
+        
+        if size == 1 or (result == INSIDE and x + size - 1 <= xmax and y + size - 1 <= ymax):
+            yield x, y, size
+            continue
+        
+        half = size / 2
+        
+        # pushed in reverse, so they come off as upper-left, upper-right, lower-left, lower-right.
+        stack.append((x + half, y + half, half))
+        stack.append((x, y + half, half))
+        stack.append((x + half, y, half))
+        stack.append((x, y, half))
+
+def zOrder(xmin, ymin, xmax, ymax, test=None):
+    """ Generate a stream of (x, y) tuples in an inclusive range, in Z-order.
+    
+        See zOrderBlocks() for the optional test function.
+    """
+    for block in zOrderBlocks(xmin, ymin, xmax, ymax, test):
+        stack = [block]
+        
+        while stack:
+            x, y, size = stack.pop()
+            
+            if size == 1:
+                yield x, y
+                continue
+            
+            half = size / 2
+            
+            stack.append((x + half, y + half, half))
+            stack.append((x, y + half, half))
+            stack.append((x + half, y, half))
+            stack.append((x, y, half))
+
+def loadGeometry(filename, projection):
+    """ Load a GeoJSON file into a single shapely geometry in zoom 0 tile space.
+    
+        Accepts a FeatureCollection, a Feature or a bare geometry.
+        Requires shapely, http://pypi.python.org/pypi/Shapely.
+    """
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+    
+    data = json_load(open(filename, 'r'))
+    
+    if data['type'] == 'FeatureCollection':
+        geometries = [feature['geometry'] for feature in data['features']]
+    elif data['type'] == 'Feature':
+        geometries = [data['geometry']]
+    else:
+        geometries = [data]
+    
+    def project(coords):
+        if type(coords[0]) in (int, float):
+            lon, lat = coords[:2]
+            lat = min(max(lat, -85.0511), 85.0511)
+            coord = projection.locationCoordinate(Location(lat, lon)).zoomTo(0)
+            return coord.column, coord.row
+        
+        return [project(part) for part in coords]
+    
+    shapes = [shape(dict(type=geom['type'], coordinates=project(geom['coordinates'])))
+              for geom in geometries if geom]
+    
+    return unary_union(shapes)
+
+def geometryCoordinates(geometry, zooms, padding, metatile=None):
+    """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+    
+        Cover a geometry from loadGeometry() with tiles, one per metatile as
+        in generateCoordinates(). Quadrants of the tile grid are tested
+        against the geometry from the top down, so quadrants inside it are
+        generated whole and quadrants outside it are skipped whole; only
+        tiles along its edges are tested one at a time.
+    """
+    from shapely.geometry import box
+    from shapely.prepared import prep
+    
+    rows, columns = metatile and (metatile.rows, metatile.columns) or (1, 1)
+    
+    def walks():
+        """ Generate (zoom, zOrderBlocks arguments) for each zoom.
+        """
+        for zoom in zooms:
+            # metatile width and height in zoom 0 tile space.
+            width, height = columns / 2.**zoom, rows / 2.**zoom
+            
+            shape = padding and geometry.buffer(padding / 2.**zoom) or geometry
+            prepared = prep(shape)
+            
+            # polygons that only touch a quadrant's edge don't cover any of it,
+            # but points and lines on an edge are in the tiles on both sides.
+            polygonal = shape.geom_type in ('Polygon', 'MultiPolygon')
+            
+            def test(x, y, size, prepared=prepared, polygonal=polygonal, width=width, height=height):
+                quadrant = box(x * width, y * height, (x + size) * width, (y + size) * height)
                 
-                yield (offset, count, coord)
+                if not prepared.intersects(quadrant):
+                    return OUTSIDE
                 
-                offset += 1
+                if polygonal and prepared.touches(quadrant):
+                    return OUTSIDE
+                
+                return prepared.contains(quadrant) and INSIDE or PARTIAL
+            
+            xmin, ymin, xmax, ymax = shape.bounds
+            last_x, last_y = int(ceil(1 / width)) - 1, int(ceil(1 / height)) - 1
+            
+            # bounds on a tile edge include the tiles on both sides of it.
+            xmin, xmax = max(0, int(ceil(xmin / width)) - 1), min(last_x, int(floor(xmax / width)))
+            ymin, ymax = max(0, int(ceil(ymin / height)) - 1), min(last_y, int(floor(ymax / height)))
+            
+            yield zoom, (xmin, ymin, xmax, ymax, test)
+    
+    # count blocks first, which costs about the same as the real thing.
+    count = 0
+    
+    for (zoom, args) in walks():
+        for (x, y, size) in zOrderBlocks(*args):
+            count += size * size
+    
+    offset = 0
+    
+    for (zoom, args) in walks():
+        for (meta_col, meta_row) in zOrder(*args):
+            coord = Coordinate(meta_row * rows, meta_col * columns, zoom)
+            
+            yield (offset, count, coord)
+            
+            offset += 1
 
 def listCoordinates(filename):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
         Read coordinates from a file with one Z/X/Y coordinate per line.
     """
+    count = sum(1 for line in open(filename, 'r'))
+    
     coords = (line.strip().split('/') for line in open(filename, 'r'))
     coords = (map(int, (row, column, zoom)) for (zoom, column, row) in coords)
-    coords = [Coordinate(*args) for args in coords]
-    
-    count = len(coords)
+    coords = (Coordinate(*args) for args in coords)
     
     for (offset, coord) in enumerate(coords):
         yield (offset, count, coord)
@@ -154,12 +391,352 @@ def tilesetCoordinates(filename):
     
         Read coordinates from an MBTiles tileset filename.
     """
-    coords = MBTiles.list_tiles(filename)
-    count = len(coords)
+    coords = MBTiles.iter_tiles(filename)
+    count = MBTiles.count_tiles(filename)
     
     for (offset, coord) in enumerate(coords):
         yield (offset, count, coord)
 
+class Checkpoint:
+    """ Record of completed offsets in a stream of (offset, count, coordinate) tuples.
+    
+        Coordinates are generated in the same order every time, so one bit
+        per offset is enough to find completed tiles again. The file has
+        a line of JSON describing the seeding job, then the bitmap compressed
+        with zlib; runs of completed tiles compress to almost nothing.
+        
+        An optional flush function is called before each save, so tiles
+        still held in a cache's batch are written before they're recorded.
+    """
+    def __init__(self, filename, job, resume, interval, flush=None):
+        self.filename = filename
+        self.interval = interval
+        self.flush = flush
+        self.saved = time()
+        
+        # normalize tuples to lists, so it compares equal to a loaded job.
+        self.job = json_loads(json_dumps(job))
+        self.bits = bytearray()
+        self.completed = 0
+        
+        if resume and exists(filename):
+            file = open(filename, 'rb')
+            header = json_loads(file.readline())
+            
+            if header['job'] != self.job:
+                raise KnownUnknown('Checkpoint file "%s" was written by a different seeding job: %s' % (filename, json_dumps(header['job'])))
+            
+            self.bits = bytearray(decompress(file.read()))
+            self.completed = header['completed']
+    
+    def __contains__(self, offset):
+        byte = offset >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (offset & 7)))
+    
+    def add(self, offset):
+        """ Note a completed offset, and save the checkpoint if it's time.
+        """
+        byte = offset >> 3
+        
+        if byte >= len(self.bits):
+            self.bits.extend(bytearray(byte + 1 - len(self.bits)))
+        
+        if not self.bits[byte] & (1 << (offset & 7)):
+            self.bits[byte] |= 1 << (offset & 7)
+            self.completed += 1
+        
+        if time() - self.saved >= self.interval:
+            self.save()
+    
+    def save(self):
+        """ Atomically replace the checkpoint file.
+        """
+        if self.flush:
+            self.flush()
+        
+        header = json_dumps(dict(job=self.job, completed=self.completed))
+        
+        handle, tmp_filename = mkstemp(dir=dirname(realpath(self.filename)), suffix='.tmp')
+        write(handle, header + '\n' + compress(str(self.bits)))
+        close(handle)
+        rename(tmp_filename, self.filename)
+        
+        self.saved = time()
+
+class SeedReport:
+    """ Running totals of seconds and bytes per tile, for a JSON report.
+    
+        Totals are kept for the whole run, for each zoom level with
+        power-of-two histograms, and for each parent tile at a coarse
+        zoom level as a heatmap. Seconds cover rendering, encoding and
+        caching together, which getTile() does in one go.
+        
+        With a metatile, each render writes rows x columns tiles but only
+        one of them is seen here, so tiles and bytes are scaled up by the
+        number of tiles in the metatile, and the report says so. Estimates
+        are made per render, since each planned coordinate is one render.
+    """
+    def __init__(self, heatmap_zoom, metatile=None):
+        self.heatmap_zoom = heatmap_zoom
+        self.metatile = metatile
+        self.total = self._totals()
+        self.zooms = {}
+        self.heatmap = {}
+        self.failed = 0
+    
+    def _totals(self):
+        return dict(renders=0, tiles=0, seconds=0., bytes=0)
+    
+    def _add(self, totals, seconds, size, tiles):
+        totals['renders'] += 1
+        totals['tiles'] += tiles
+        totals['seconds'] += seconds
+        totals['bytes'] += size * tiles
+    
+    def _subtiles(self, zoom):
+        """ Return the number of tiles written by one render at a zoom level.
+        """
+        if self.metatile is None:
+            return 1
+        
+        # low zoom levels have fewer tiles than a whole metatile.
+        return min(self.metatile.rows, 2**zoom) * min(self.metatile.columns, 2**zoom)
+    
+    def add(self, coord, seconds, size):
+        """ Note the time of one seeded render, and the size of one of its tiles.
+        """
+        tiles = self._subtiles(coord.zoom)
+        self._add(self.total, seconds, size, tiles)
+        
+        if coord.zoom not in self.zooms:
+            self.zooms[coord.zoom] = dict(self._totals(), seconds_histogram={}, bytes_histogram={})
+        
+        zoom = self.zooms[coord.zoom]
+        self._add(zoom, seconds, size, tiles)
+        
+        # upper bounds of power-of-two buckets, in milliseconds and bytes.
+        ms_bucket = 2 ** max(0, int(ceil(log(max(seconds * 1000, 1), 2))))
+        bytes_bucket = 2 ** max(0, int(ceil(log(max(size, 1), 2))))
+        
+        # seconds are counted per render, bytes per tile.
+        zoom['seconds_histogram'][ms_bucket] = zoom['seconds_histogram'].get(ms_bucket, 0) + 1
+        zoom['bytes_histogram'][bytes_bucket] = zoom['bytes_histogram'].get(bytes_bucket, 0) + tiles
+        
+        parent = coord.zoomTo(min(coord.zoom, self.heatmap_zoom)).container()
+        key = '%(zoom)d/%(column)d/%(row)d' % parent.__dict__
+        
+        if key not in self.heatmap:
+            self.heatmap[key] = self._totals()
+        
+        self._add(self.heatmap[key], seconds, size, tiles)
+    
+    def save(self, filename, count):
+        """ Write the report as JSON, with estimates for a run of count renders.
+        """
+        def means(totals):
+            tiles = float(max(totals['tiles'], 1))
+            return dict(totals, mean_seconds=totals['seconds'] / tiles, mean_bytes=totals['bytes'] / tiles)
+        
+        renders = float(max(self.total['renders'], 1))
+        
+        zooms = dict([(zoom, means(totals)) for (zoom, totals) in self.zooms.items()])
+        
+        for totals in zooms.values():
+            totals['seconds_histogram'] = dict([('<=%dms' % ms, n) for (ms, n) in totals['seconds_histogram'].items()])
+            totals['bytes_histogram'] = dict([('<=%dB' % b, n) for (b, n) in totals['bytes_histogram'].items()])
+        
+        total = means(self.total)
+        total.update(failed=self.failed, planned_renders=count,
+                     estimated_seconds=self.total['seconds'] / renders * count,
+                     estimated_bytes=self.total['bytes'] / renders * count)
+        
+        if self.metatile is None:
+            metatile = dict(rows=1, columns=1)
+        else:
+            metatile = dict(rows=self.metatile.rows, columns=self.metatile.columns)
+        
+        metatile.update(note='Each render writes a metatile of rows x columns tiles, '
+                             'and tiles and bytes count all of them, assuming each is '
+                             'the size of the one tile seen. Means are per tile.')
+        
+        report = dict(total=total, zooms=zooms, metatile=metatile,
+                      heatmap=dict(zoom=self.heatmap_zoom, tiles=self.heatmap))
+        
+        file = open(filename, 'w')
+        json_dump(report, file, indent=2, sort_keys=True)
+        file.close()
+
+def renderTile(layer, coord, extension, ignore_cached, callback):
+    """ Fetch a single tile into the cache, and return its content.
+    
+        If a JSONP callback is given, JSON tiles are also saved wrapped in it,
+        for every tile of the metatile since coordinates are one per metatile.
+    """
+    mimetype, content = getTile(layer, coord, extension, ignore_cached)
+    
+    if mimetype and 'json' in mimetype and callback:
+        js_size = 0
+        
+        for other in layer.metatile.allCoords(coord):
+            if other.row >= 2**other.zoom or other.column >= 2**other.zoom:
+                # off the edge of the world.
+                continue
+            
+            if other == coord:
+                other_content = content
+            else:
+                # just saved to the cache along with the rest of the metatile.
+                other_content = getTile(layer, other, extension)[1]
+            
+            js_body = '%s(%s);' % (callback, other_content)
+            js_size += len(js_body) / 1024
+            
+            layer.config.cache.save(js_body, layer, other, 'JS')
+        
+        js_path = '%s/%d/%d/%d.js' % (layer.name(), coord.zoom, coord.column, coord.row)
+        print >> stderr, '%s (%dKB)' % (js_path, js_size),
+
+    elif callback:
+        print >> stderr, '(callback ignored)',
+    
+    return content
+
+def seedTile(layer, coord, extension, options):
+    """ Render or build a single tile into the cache, and return its content.
+    """
+    if options.downsample_below is not None and coord.zoom < options.downsample_below:
+        mimetype, content = Pyramid.buildMetatile(layer, coord, extension, options.ignore_cached,
+                                                  options.downsample_filter, options.downsample_identical)
+        return content
+    
+    return renderTile(layer, coord, extension, options.ignore_cached, options.callback)
+
+# worker processes flush their caches after this many tiles or seconds.
+worker_flush_tiles, worker_flush_seconds = 32, 1.
+
+def seedWorker(config_dict, config_dirpath, layer_name, extension, options, tasks, results):
+    """ Render tiles from a task queue, and report each one on a results queue.
+    
+        Runs in its own process with its own configuration, so providers
+        are never shared between workers. Tasks are (offset, coord) tuples,
+        results are (offset, coord, size, seconds, error) tuples, with one
+        final None when the task queue runs out.
+    """
+    config = buildConfiguration(config_dict, config_dirpath)
+    layer = config.layers[layer_name]
+    
+    # results held back until the cache has been flushed.
+    pending, flushed = [], time()
+    
+    def flush():
+        Caches.flush(config.cache)
+        
+        for result in pending:
+            results.put(result)
+        
+        del pending[:]
+    
+    while True:
+        task = tasks.get()
+        
+        if task is None:
+            break
+        
+        offset, coord = task
+        attempts = options.enable_retries and 3 or 1
+        
+        while True:
+            start = time()
+            
+            try:
+                content = seedTile(layer, coord, extension, options)
+            except:
+                attempts -= 1
+
+                if attempts == 0:
+                    pending.append((offset, coord, None, None, format_exc()))
+                    break
+            else:
+                pending.append((offset, coord, len(content), time() - start, None))
+                break
+        
+        # flush batched writes before reporting tiles done, so a checkpoint
+        # never lists uncommitted tiles and workers never hold the write lock
+        # of a shared tileset for long. Some caches are slow to flush, like
+        # Bloom and LimitedDisk, so it happens for groups of tiles.
+        if len(pending) >= worker_flush_tiles or time() - flushed > worker_flush_seconds:
+            flush()
+            flushed = time()
+    
+    # multiprocessing skips exit handlers, so caches
+    # like Bloom and LimitedDisk are flushed here too.
+    flush()
+    
+    results.put(None)
+    results.close()
+    results.join_thread()
+
+def seedWorkers(config_dict, config_dirpath, layer, extension, options, coordinates):
+    """ Render a stream of (offset, count, coordinate) tuples with worker processes.
+    
+        Coordinates are partitioned by metatile, so no two workers render
+        the same metatile. Generate a stream of (offset, count, coordinate,
+        size, seconds, error) tuples in order of completion, with offsets from the
+        original stream.
+    """
+    workers, results = [], Queue(options.workers * 64)
+    
+    for i in range(options.workers):
+        tasks = Queue(64)
+        args = config_dict, config_dirpath, layer.name(), extension, options, tasks, results
+        worker = Process(target=seedWorker, args=args)
+        worker.daemon = True
+        worker.start()
+        workers.append((worker, tasks))
+    
+    # the total is only known as the stream is read.
+    totals = [0]
+    
+    def feed():
+        for (offset, count, coord) in coordinates:
+            first = layer.metatile.firstCoord(coord)
+            worker, tasks = workers[hash((first.zoom, first.column, first.row)) % len(workers)]
+            tasks.put((offset, coord))
+            totals[0] = count
+        
+        for (worker, tasks) in workers:
+            tasks.put(None)
+    
+    feeder = Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    
+    running = len(workers)
+    
+    try:
+        while running:
+            try:
+                result = results.get(timeout=1)
+            except Empty:
+                if [worker for (worker, tasks) in workers if worker.exitcode]:
+                    raise Exception('A seeding worker process died unexpectedly.')
+                continue
+            
+            if result is None:
+                running -= 1
+                continue
+            
+            offset, coord, size, seconds, error = result
+            yield (offset, totals[0], coord, size, seconds, error)
+    
+    finally:
+        for (worker, tasks) in workers:
+            if running:
+                worker.terminate()
+            else:
+                # let it finish writing to the cache.
+                worker.join()
+
 def parseConfigfile(configpath):
     """ Parse a configuration file and return a raw dictionary and dirpath.
     
@@ -184,15 +761,6 @@ if __name__ == '__main__':
         for p in options.include_paths.split(':'):
             path.insert(0, p)
 
-    from TileStache import getTile, Config
-    from TileStache.Core import KnownUnknown
-    from TileStache.Config import buildConfiguration
-    from TileStache import MBTiles
-    import TileStache
-    
-    from ModestMaps.Core import Coordinate
-    from ModestMaps.Geo import Location
-
     try:
         # determine if we have enough information to prep a config and layer
         
@@ -250,7 +818,9 @@ if __name__ == '__main__':
             tiers.append({'class': 'TileStache.MBTiles:Cache',
                           'kwargs': dict(filename=options.mbtiles_output,
                                          format=extension,
-                                         name=options.layer)})
+                                         name=options.layer,
+                                         batch_size=256,
+                                         deduplicate=bool(options.mbtiles_deduplicate))})
         
         if options.outputdirectory:
             tiers.append(dict(name='disk', path=options.outputdirectory,
@@ -295,9 +865,30 @@ if __name__ == '__main__':
         if options.padding < 0:
             raise KnownUnknown('A negative padding will not work.')
 
+        if options.workers < 1:
+            raise KnownUnknown('At least one worker is needed.')
+
+        if options.downsample_below is not None:
+            if options.downsample_filter not in Pyramid.filters:
+                raise KnownUnknown('"%s" is not a resampling filter I know about. Here are some that I do know about: %s.' % (options.downsample_filter, ', '.join(Pyramid.filters)))
+            
+            # children must be seeded before their parents.
+            zooms.sort(reverse=True)
+        
+        if options.resume and not options.checkpoint:
+            raise KnownUnknown('--resume needs a --checkpoint-file to resume from.')
+
         padding = options.padding
         tile_list = options.tile_list
         error_list = options.error_list
+        
+        if options.checkpoint:
+            job = dict(layer=layer.name(), extension=extension, metatile=(layer.metatile.rows, layer.metatile.columns),
+                       bbox=options.bbox, zooms=zooms, padding=padding, geometry=options.geometry, tile_list=tile_list, mbtiles_input=options.mbtiles_input)
+            flush = lambda: Caches.flush(config.cache)
+            checkpoint = Checkpoint(options.checkpoint, job, options.resume, options.checkpoint_interval, flush)
+        else:
+            checkpoint = None
 
     except KnownUnknown, e:
         parser.error(str(e))
@@ -306,70 +897,130 @@ if __name__ == '__main__':
         coordinates = listCoordinates(tile_list)
     elif options.mbtiles_input:
         coordinates = tilesetCoordinates(options.mbtiles_input)
+    elif options.geometry:
+        geometry = loadGeometry(options.geometry, layer.projection)
+        coordinates = geometryCoordinates(geometry, zooms, padding, layer.metatile)
     else:
-        coordinates = generateCoordinates(ul, lr, zooms, padding)
+        coordinates = generateCoordinates(ul, lr, zooms, padding, layer.metatile)
     
-    for (offset, count, coord) in coordinates:
-        path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
-
-        progress = {"tile": path,
-                    "offset": offset + 1,
-                    "total": count}
-
-        #
-        # Fetch a tile.
-        #
-        
-        attempts = options.enable_retries and 3 or 1
-        rendered = False
-        
-        while not rendered:
-            if options.verbose:
-                print >> stderr, '%(offset)d of %(total)d...' % progress,
+    if checkpoint:
+        coordinates = ((o, n, c) for (o, n, c) in coordinates if o not in checkpoint)
     
-            try:
-                mimetype, content = getTile(layer, coord, extension, options.ignore_cached)
+    report = options.report and SeedReport(options.report_zoom, layer.metatile) or None
+    count = 0
+    
+    try:
+        if options.workers > 1:
+            done = checkpoint and checkpoint.completed or 0
+        
+            for (offset, count, coord, size, seconds, error) in seedWorkers(config_dict, config_dirpath, layer, extension, options, coordinates):
+                path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+                done += 1
+
+                progress = {"tile": path,
+                            "offset": done,
+                            "total": count}
+            
+                if error is None:
+                    progress['size'] = '%dKB' % (size / 1024)
                 
-                if mimetype and 'json' in mimetype and options.callback:
-                    js_path = '%s/%d/%d/%d.js' % (layer.name(), coord.zoom, coord.column, coord.row)
-                    js_body = '%s(%s);' % (options.callback, content)
-                    js_size = len(js_body) / 1024
+                    if checkpoint:
+                        checkpoint.add(offset)
                     
-                    layer.config.cache.save(js_body, layer, coord, 'JS')
-                    print >> stderr, '%s (%dKB)' % (js_path, js_size),
-            
-                elif options.callback:
-                    print >> stderr, '(callback ignored)',
-            
-            except:
-                #
-                # Something went wrong: try again? Log the error?
-                #
-                attempts -= 1
+                    if report:
+                        report.add(coord, seconds, size)
+        
+                    if options.verbose:
+                        print >> stderr, '%(offset)d of %(total)d... %(tile)s (%(size)s)' % progress
 
-                if options.verbose:
-                    print >> stderr, 'Failed %s, will try %s more.' % (progress['tile'], ['no', 'once', 'twice'][attempts])
+                else:
+                    if options.verbose:
+                        print >> stderr, '%(offset)d of %(total)d... Failed %(tile)s.' % progress
                 
-                if attempts == 0:
-                    if not error_list:
-                        raise
+                    if report:
+                        report.failed += 1
                     
+                    if not error_list:
+                        raise Exception('Failed to render %s:\n%s' % (path, error))
+                
                     fp = open(error_list, 'a')
                     fp.write('%(zoom)d/%(column)d/%(row)d\n' % coord.__dict__)
                     fp.close()
-                    break
             
-            else:
+                if options.progressfile:
+                    fp = open(options.progressfile, 'w')
+                    json_dump(progress, fp)
+                    fp.close()
+    
+        else:
+            for (offset, count, coord) in coordinates:
+                path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+
+                progress = {"tile": path,
+                            "offset": offset + 1,
+                            "total": count}
+
                 #
-                # Successfully got the tile.
+                # Fetch a tile.
                 #
-                rendered = True
-                progress['size'] = '%dKB' % (len(content) / 1024)
+            
+                attempts = options.enable_retries and 3 or 1
+                rendered = False
+            
+                while not rendered:
+                    if options.verbose:
+                        print >> stderr, '%(offset)d of %(total)d...' % progress,
+                    
+                    start = time()
         
-                if options.verbose:
-                    print >> stderr, '%(tile)s (%(size)s)' % progress
+                    try:
+                        content = seedTile(layer, coord, extension, options)
+                
+                    except:
+                        #
+                        # Something went wrong: try again? Log the error?
+                        #
+                        attempts -= 1
+
+                        if options.verbose:
+                            print >> stderr, 'Failed %s, will try %s more.' % (progress['tile'], ['no', 'once', 'twice'][attempts])
+                    
+                        if attempts == 0:
+                            if report:
+                                report.failed += 1
+                            
+                            if not error_list:
+                                raise
+                        
+                            fp = open(error_list, 'a')
+                            fp.write('%(zoom)d/%(column)d/%(row)d\n' % coord.__dict__)
+                            fp.close()
+                            break
                 
-        if options.progressfile:
-            fp = open(options.progressfile, 'w')
-            json_dump(progress, fp)
-            fp.close()
+                    else:
+                        #
+                        # Successfully got the tile.
+                        #
+                        rendered = True
+                        progress['size'] = '%dKB' % (len(content) / 1024)
+                        
+                        if checkpoint:
+                            checkpoint.add(offset)
+                        
+                        if report:
+                            report.add(coord, time() - start, len(content))
+            
+                        if options.verbose:
+                            print >> stderr, '%(tile)s (%(size)s)' % progress
+                    
+                if options.progressfile:
+                    fp = open(options.progressfile, 'w')
+                    json_dump(progress, fp)
+                    fp.close()
+
+    finally:
+        if checkpoint:
+            checkpoint.save()
+        
+        if report:
+            report.save(options.report, count)
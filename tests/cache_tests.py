@@ -1,7 +1,13 @@
 from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import exists, join as pathjoin
 from . import utils
 import memcache
 
+from ModestMaps.Core import Coordinate
+from TileStache.Config import buildConfiguration
+
 class CacheTests(TestCase):
     '''Tests various Cache configurations that reads from cfg file'''
 
@@ -67,7 +73,379 @@ class CacheTests(TestCase):
         self.assertEqual(self.mc.get('/1/memcache_osm/0/0/0.PNG'), None,
             'Memcache returned a value even though it should have been empty')
 
+class SQLiteCacheTests(TestCase):
+    '''Tests the SQLite shard cache directly'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+
+        config_dict = {
+            'cache': {'name': 'SQLite', 'path': self.tmpdir},
+            'layers': {
+                'osm': {'provider': {'name': 'proxy', 'url': 'http://tile.openstreetmap.org/{Z}/{X}/{Y}.png'}}
+            }
+        }
+
+        self.config = buildConfiguration(config_dict)
+        self.layer = self.config.layers['osm']
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_save_read_remove(self):
+        '''Save, read and remove a tile in a shard'''
+
+        cache, layer = self.config.cache, self.layer
+        coord = Coordinate(1582, 656, 12)
+
+        self.assertEqual(cache.read(layer, coord, 'PNG'), None)
+
+        cache.save('\x89PNG fake', layer, coord, 'PNG')
+        self.assertEqual(cache.read(layer, coord, 'PNG'), '\x89PNG fake')
+        self.assertEqual(cache.read(layer, coord, 'JPEG'), None)
+        self.assertEqual(cache.read(layer, coord.zoomBy(1), 'PNG'), None)
+
+        cache.remove(layer, coord, 'PNG')
+        self.assertEqual(cache.read(layer, coord, 'PNG'), None)
+
+    def test_remove_many(self):
+        '''Remove many tiles across shards at once'''
+
+        cache, layer = self.config.cache, self.layer
+        coords = [Coordinate(1582, 656, 12), Coordinate(1583, 656, 12), Coordinate(791, 328, 11)]
+
+        for coord in coords:
+            cache.save('\x89PNG fake', layer, coord, 'PNG')
+
+        cache.remove_many(layer, coords[1:] + [Coordinate(0, 0, 0)], 'PNG')
+
+        self.assertEqual(cache.read(layer, coords[0], 'PNG'), '\x89PNG fake')
+        self.assertEqual(cache.read(layer, coords[1], 'PNG'), None)
+        self.assertEqual(cache.read(layer, coords[2], 'PNG'), None)
+
+    def test_stale_lock(self):
+        '''Stale locks are broken after the layer's stale lock timeout'''
+
+        cache, layer = self.config.cache, self.layer
+        coord = Coordinate(0, 0, 0)
+
+        layer.stale_lock_timeout = 0
+        cache.lock(layer, coord, 'PNG')
+        cache.lock(layer, coord, 'PNG')
+        cache.unlock(layer, coord, 'PNG')
+
+class DiskCacheTests(TestCase):
+    '''Tests removing many tiles from the Disk cache'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+
+        config_dict = {
+            'cache': {'name': 'Disk', 'path': self.tmpdir, 'dirs': 'portable'},
+            'layers': {
+                'osm': {'provider': {'name': 'proxy', 'url': 'http://tile.openstreetmap.org/{Z}/{X}/{Y}.png'}}
+            }
+        }
+
+        self.config = buildConfiguration(config_dict)
+        self.layer = self.config.layers['osm']
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_remove_many(self):
+        '''Remove many tiles, pruning directories left empty'''
+
+        cache, layer = self.config.cache, self.layer
+        coords = [Coordinate(1582, 656, 12), Coordinate(1583, 656, 12), Coordinate(1582, 657, 12)]
+
+        for coord in coords:
+            cache.save('\x89PNG fake', layer, coord, 'PNG')
+
+        cache.save('{}', layer, coords[2], 'JSON')
+
+        # a column of tiles that were never cached costs nothing.
+        cache.remove_many(layer, coords + [Coordinate(1582, 658, 12)], 'PNG')
+
+        for coord in coords:
+            self.assertEqual(cache.read(layer, coord, 'PNG'), None)
+
+        self.assertFalse(exists(pathjoin(self.tmpdir, 'osm', '12', '656')))
+        self.assertEqual(cache.read(layer, coords[2], 'JSON'), '{}')
+
+    def test_save_pruned(self):
+        '''Save a tile whose directory is pruned by remove_many() while it's written'''
+
+        cache, layer, coord = self.config.cache, self.layer, Coordinate(1582, 656, 12)
+        makedirs, made = cache._makedirs, []
+
+        def pruned_makedirs(dirpath):
+            makedirs(dirpath)
+
+            if not made:
+                # another process removes its last tile just now.
+                cache._prune(layer, dirpath)
+
+            made.append(dirpath)
+
+        cache._makedirs = pruned_makedirs
+        cache.save('\x89PNG fake', layer, coord, 'PNG')
+
+        self.assertEqual(len(made), 2)
+        self.assertEqual(cache.read(layer, coord, 'PNG'), '\x89PNG fake')
+
+class MBTilesCacheTests(TestCase):
+    '''Tests the MBTiles cache directly'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+
+        config_dict = {
+            'cache': {'name': 'MBTiles', 'filename': self.tmpdir + '/tiles.mbtiles', 'batch size': 3},
+            'layers': {
+                'osm': {'provider': {'name': 'proxy', 'url': 'http://tile.openstreetmap.org/{Z}/{X}/{Y}.png'}}
+            }
+        }
+
+        self.config = buildConfiguration(config_dict)
+        self.layer = self.config.layers['osm']
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_save_read_remove(self):
+        '''Save, read and remove a tile in the tileset'''
+
+        cache, layer = self.config.cache, self.layer
+        coord = Coordinate(1582, 656, 12)
+
+        cache.save('\x89PNG fake', layer, coord, 'PNG')
+        cache.save('{"type": "fake"}', layer, coord, 'JSON')
+        self.assertEqual(cache.read(layer, coord, 'PNG'), '\x89PNG fake')
+        self.assertEqual(cache.read(layer, coord, 'JSON'), None)
+
+        cache.remove(layer, coord, 'PNG')
+        self.assertEqual(cache.read(layer, coord, 'PNG'), None)
+
+    def test_batched_commit(self):
+        '''Saved tiles are visible to other connections once a batch is full'''
+
+        from sqlite3 import connect
+
+        cache, layer = self.config.cache, self.layer
+        db = connect(cache.filename)
+        count = lambda: db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+
+        cache.save('\x89PNG fake', layer, Coordinate(0, 0, 1), 'PNG')
+        cache.save('\x89PNG fake', layer, Coordinate(0, 1, 1), 'PNG')
+        self.assertEqual(count(), 0)
+
+        cache.save('\x89PNG fake', layer, Coordinate(1, 0, 1), 'PNG')
+        self.assertEqual(count(), 3)
+
+    def test_flush(self):
+        '''Flushed tiles are visible to other connections before a batch is full'''
+
+        from sqlite3 import connect
+        from TileStache import Caches
+
+        cache, layer = self.config.cache, self.layer
+        db = connect(cache.filename)
+        count = lambda: db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+
+        cache.save('\x89PNG fake', layer, Coordinate(0, 0, 1), 'PNG')
+        self.assertEqual(count(), 0)
+
+        Caches.flush(cache)
+        self.assertEqual(count(), 1)
+
+        # the next batch starts over after a flush.
+        cache.save('\x89PNG fake', layer, Coordinate(0, 1, 1), 'PNG')
+        cache.save('\x89PNG fake', layer, Coordinate(1, 0, 1), 'PNG')
+        self.assertEqual(count(), 1)
+
+    def test_iter_tiles(self):
+        '''Tiles are listed in zoom, column, row order whatever order they were saved in'''
+
+        from TileStache import MBTiles
+
+        cache, layer = self.config.cache, self.layer
+        coords = [Coordinate(2, 1, 2), Coordinate(0, 0, 0), Coordinate(0, 1, 2), Coordinate(3, 0, 2), Coordinate(1, 1, 1)]
+
+        for coord in coords:
+            cache.save('\x89PNG fake', layer, coord, 'PNG')
+
+        cache.flush()
+
+        # rows count up from the south in the tileset.
+        listed = [(c.zoom, c.column, c.row) for c in MBTiles.iter_tiles(cache.filename)]
+        self.assertEqual(listed, [(0, 0, 0), (1, 1, 1), (2, 0, 3), (2, 1, 2), (2, 1, 0)])
+
+    def test_thread_connections(self):
+        '''Connections are closed with their threads, after committing their batches'''
+
+        from threading import Thread
+        from TileStache import MBTiles
+
+        cache, layer = self.config.cache, self.layer
+        threads = [Thread(target=cache.save, args=('\x89PNG fake', layer, Coordinate(0, column, 1), 'PNG'))
+                   for column in range(2)]
+
+        for thread in threads:
+            thread.start()
+            thread.join()
+
+        cache.flush()
+        self.assertTrue(all(thread.is_alive() for (pid, thread, db) in MBTiles._connections.values()))
+        self.assertEqual(len(MBTiles.list_tiles(cache.filename)), 2)
+
+    def test_replaced_tileset(self):
+        '''A tileset replaced by a new file is read with its new format'''
+
+        from os import rename
+        from TileStache import MBTiles
+
+        filename, other = self.tmpdir + '/replaced.mbtiles', self.tmpdir + '/other.mbtiles'
+        MBTiles.create_tileset(filename, 'replaced', 'baselayer', '0', '', 'png')
+        MBTiles.put_tile(filename, Coordinate(0, 0, 0), '\x89PNG fake')
+        self.assertEqual(MBTiles.get_tile(filename, Coordinate(0, 0, 0))[0], 'image/png')
+
+        MBTiles.create_tileset(other, 'other', 'baselayer', '0', '', 'jpg', deduplicate=True)
+        MBTiles.put_tile(other, Coordinate(0, 0, 0), '\xff\xd8 fake')
+        rename(other, filename)
+
+        self.assertEqual(MBTiles.get_tile(filename, Coordinate(0, 0, 0)), ('image/jpeg', '\xff\xd8 fake'))
+        self.assertTrue(MBTiles._tileset_deduplicated(filename))
+
+    def test_deduplicated(self):
+        '''Identical tiles are stored once in a deduplicated tileset'''
+
+        from TileStache import MBTiles
+
+        cache = MBTiles.Cache(self.tmpdir + '/dedup.mbtiles', deduplicate=True)
+        layer = self.layer
+
+        for coord in (Coordinate(0, 0, 1), Coordinate(0, 1, 1), Coordinate(1, 0, 1)):
+            cache.save('\x89PNG ocean', layer, coord, 'PNG')
+
+        cache.save('\x89PNG land', layer, Coordinate(1, 1, 1), 'PNG')
+        cache.remove(layer, Coordinate(0, 0, 1), 'PNG')
+
+        db = MBTiles._connection(cache.filename)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM images').fetchone()[0], 2)
+
+        self.assertEqual(cache.read(layer, Coordinate(0, 0, 1), 'PNG'), None)
+        self.assertEqual(cache.read(layer, Coordinate(0, 1, 1), 'PNG'), '\x89PNG ocean')
+        self.assertEqual(cache.read(layer, Coordinate(1, 1, 1), 'PNG'), '\x89PNG land')
+        self.assertEqual(len(MBTiles.list_tiles(cache.filename)), 3)
+
+    def test_deduplicated_orphans(self):
+        '''Images no longer used by any tile are deleted'''
+
+        from TileStache import MBTiles
+
+        cache = MBTiles.Cache(self.tmpdir + '/dedup.mbtiles', deduplicate=True)
+        layer = self.layer
+
+        db = MBTiles._connection(cache.filename)
+        images = lambda: sorted(str(data) for (data, ) in db.execute('SELECT tile_data FROM images'))
+
+        cache.save('\x89PNG ocean', layer, Coordinate(0, 0, 1), 'PNG')
+        cache.save('\x89PNG ocean', layer, Coordinate(0, 1, 1), 'PNG')
+        cache.save('\x89PNG land', layer, Coordinate(1, 1, 1), 'PNG')
+
+        # replaced by the same or other content.
+        cache.save('\x89PNG land', layer, Coordinate(1, 1, 1), 'PNG')
+        self.assertEqual(images(), ['\x89PNG land', '\x89PNG ocean'])
+
+        cache.save('\x89PNG ocean', layer, Coordinate(1, 1, 1), 'PNG')
+        self.assertEqual(images(), ['\x89PNG ocean'])
+
+        # removed one at a time, or many together.
+        cache.remove(layer, Coordinate(0, 0, 1), 'PNG')
+        self.assertEqual(images(), ['\x89PNG ocean'])
+
+        cache.remove_many(layer, [Coordinate(0, 1, 1), Coordinate(1, 1, 1)], 'PNG')
+        self.assertEqual(images(), [])
+
+class BloomCacheTests(TestCase):
+    '''Tests the Bloom cache in front of a logging Test cache'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+        self.log = []
+
+        config_dict = {
+            'cache': {'name': 'Bloom', 'path': self.tmpdir, 'cache': {'name': 'Test'}},
+            'layers': {
+                'osm': {'provider': {'name': 'proxy', 'url': 'http://tile.openstreetmap.org/{Z}/{X}/{Y}.png'}}
+            }
+        }
+
+        self.config = buildConfiguration(config_dict)
+        self.config.cache.cache.logfunc = self.log.append
+        self.layer = self.config.layers['osm']
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_negative_lookup(self):
+        '''Unknown tiles are not read from the wrapped cache'''
+
+        cache, layer = self.config.cache, self.layer
+
+        cache.save('\x89PNG fake', layer, Coordinate(1582, 656, 12), 'PNG')
+        del self.log[:]
+
+        cache.read(layer, Coordinate(1582, 656, 12), 'PNG')
+        self.assertEqual(self.log, ['Test cache read: osm 12/656/1582 PNG'])
+
+        cache.read(layer, Coordinate(1582, 656, 12), 'JPEG')
+        cache.read(layer, Coordinate(1583, 656, 12), 'PNG')
+        self.assertEqual(len(self.log), 1)
+
+    def test_flush(self):
+        '''Flushing writes filters to disk and flushes the wrapped cache'''
+
+        from TileStache import Caches
+
+        cache, layer = self.config.cache, self.layer
+        flushed = []
+        cache.cache.flush = lambda: flushed.append(True)
+
+        cache.save('\x89PNG fake', layer, Coordinate(1582, 656, 12), 'PNG')
+        self.assertFalse(exists(pathjoin(self.tmpdir, 'osm', '12.bloom')))
+
+        Caches.flush(cache)
+        self.assertTrue(exists(pathjoin(self.tmpdir, 'osm', '12.bloom')))
+        self.assertEqual(flushed, [True])
+
+    def test_saved_file(self):
+        '''Filter files get the umask's permissions and a lock file beside them'''
+
+        from os import stat
+
+        cache, layer = self.config.cache, self.layer
+        cache.umask = 0027
+
+        cache.save('\x89PNG fake', layer, Coordinate(1582, 656, 12), 'PNG')
+        cache.saveFilters()
+
+        self.assertEqual(stat(pathjoin(self.tmpdir, 'osm', '12.bloom')).st_mode & 0777, 0640)
+        self.assertTrue(exists(pathjoin(self.tmpdir, 'osm', '12.bloom.lock')))
+
+    def test_persisted(self):
+        '''Filters are written to disk and found by other instances'''
+
+        from TileStache.Bloom import Cache
 
+        cache, layer = self.config.cache, self.layer
 
+        cache.save('\x89PNG fake', layer, Coordinate(1582, 656, 12), 'PNG')
+        cache.saveFilters()
 
+        other = Cache(self.config.cache.cache, self.tmpdir)
+        del self.log[:]
 
+        other.read(layer, Coordinate(1582, 656, 12), 'PNG')
+        self.assertEqual(len(self.log), 1)
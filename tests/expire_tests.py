@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from subprocess import Popen, PIPE
+from os.path import dirname, abspath, join as pathjoin
+from imp import load_source
+
+from ModestMaps.Core import Coordinate
+from TileStache.Config import buildConfiguration
+from TileStache.Caches import Disk
+
+script = pathjoin(dirname(__file__), '../scripts/tilestache-expire.py')
+expire = load_source('tilestache_expire', script)
+
+class Cache (Disk):
+    ''' Disk cache that leaves a file behind in each process that flushes it.
+    '''
+    def flush(self):
+        open(pathjoin(self.cachepath, 'flushed-%d' % os.getpid()), 'w').close()
+
+class ExpireTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+        self.configpath = pathjoin(self.tmpdir, 'tilestache.cfg')
+
+        config_dict = {
+          'cache': {'class': 'tests.expire_tests:Cache', 'kwargs': {'path': self.tmpdir, 'dirs': 'portable', 'gzip': []}},
+          'layers': {
+            'json': {'provider': {'class': 'tests.seed_tests:Provider'}, 'metatile': {'rows': 2, 'columns': 2}}
+          }
+        }
+
+        with open(self.configpath, 'w') as file:
+            json.dump(config_dict, file)
+
+        self.config = buildConfiguration(config_dict, self.tmpdir + '/')
+        self.layer = self.config.layers['json']
+
+        # every tile at zooms 2 and 3 starts out cached.
+        for zoom in (2, 3):
+            for row in range(2 ** zoom):
+                for column in range(2 ** zoom):
+                    self.config.cache.save('{}', self.layer, Coordinate(row, column, zoom), 'JSON')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def cached(self, zoom):
+        ''' Return a set of (column, row) tuples cached at a zoom.
+        '''
+        cache, layer = self.config.cache, self.layer
+        tiles = [Coordinate(row, column, zoom) for row in range(2 ** zoom) for column in range(2 ** zoom)]
+
+        return set((int(c.column), int(c.row)) for c in tiles if cache.read(layer, c, 'JSON'))
+
+    def expire(self, coordinates):
+        expire.initWorker(self.configpath, 'json')
+        results = map(expire.expireMetatile, [(coord, 'json', False) for (offset, count, coord) in coordinates])
+
+        self.assertEqual([error for (coord, error) in results], [None] * len(results))
+
+    def test_expire_list(self):
+        filename = pathjoin(self.tmpdir, 'expire.list')
+
+        with open(filename, 'w') as file:
+            file.write('3/5/2\n\n')
+
+        self.expire(expire.expiredCoordinates([filename], [2, 3], self.layer.metatile))
+
+        # the parent metatile at zoom 2, and just the tile's own metatile at 3.
+        self.assertEqual(len(self.cached(2)), 16 - 4)
+        self.assertEqual(self.cached(3), set((c, r) for c in range(8) for r in range(8)) - set([(4, 2), (5, 2), (4, 3), (5, 3)]))
+
+    def test_expire_bbox(self):
+        ul, lr = Coordinate(0, 0, 1), Coordinate(0.99, 0.99, 1)
+
+        self.expire(expire.expiredCoordinates([], [3], self.layer.metatile, area=(ul, lr)))
+
+        # the upper-left quarter of the world, at zoom 3 only.
+        self.assertEqual(len(self.cached(2)), 16)
+        self.assertEqual(self.cached(3), set((c, r) for c in range(8) for r in range(8) if c >= 4 or r >= 4))
+
+    def test_workers(self):
+        args = sys.executable, script, '-c', self.configpath, '-l', 'json', '-e', 'json', '-q', '--workers', '2', '-b', '85', '-180', '1', '-1', '3'
+        env = dict(os.environ, PYTHONPATH=abspath(pathjoin(dirname(__file__), '..')))
+
+        process = Popen(args, env=env, stderr=PIPE)
+        stdout, stderr = process.communicate()
+
+        self.assertEqual(process.returncode, 0, stderr)
+        self.assertEqual(self.cached(3), set((c, r) for c in range(8) for r in range(8) if c >= 4 or r >= 4))
+
+        # pooled workers flushed their caches on the way out.
+        flushed = [name for name in os.listdir(self.tmpdir) if name.startswith('flushed-')]
+        self.assertTrue(flushed)
+        self.assertTrue('flushed-%d' % process.pid not in flushed)
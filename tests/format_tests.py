@@ -0,0 +1,164 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import exists, join as pathjoin
+from StringIO import StringIO
+
+from TileStache import requestHandler2, acceptsType
+from TileStache.Config import buildConfiguration
+from TileStache.Core import KnownUnknown, png_strategies
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+class Provider:
+    ''' Renders solid-color tiles, for testing output formats.
+    '''
+    def __init__(self, layer):
+        self.layer = layer
+
+    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+        return Image.new('RGBA', (width, height), (0x99, 0x66, 0x33, 0xFF))
+
+class RecordingImage:
+    ''' Wraps an image to record the keyword args it's saved with.
+    '''
+    def __init__(self, image):
+        self.image = image
+        self.saved = []
+
+    def save(self, file, format, **kwargs):
+        self.saved.append((format, kwargs))
+        self.image.save(file, format, **kwargs)
+
+class PlainImage:
+    ''' Wraps an image with a save() that takes no keyword args.
+    '''
+    def __init__(self, image):
+        self.image = image
+
+    def save(self, file, format):
+        self.image.save(file, format)
+
+class FormatTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+
+        config_dict = {
+          'cache': {'name': 'Disk', 'path': self.tmpdir},
+          'layers': {
+            'plain': {'provider': {'class': 'tests.format_tests:Provider'}},
+            'compressed': {
+              'provider': {'class': 'tests.format_tests:Provider'},
+              'png options': {'compress_level': 9, 'strategy': 'filtered'}
+            },
+            'negotiated': {
+              'provider': {'class': 'tests.format_tests:Provider'},
+              'variants': {'PNG': 'webp'},
+              'webp options': {'lossless': True, 'method': 2}
+            }
+          }
+        }
+
+        self.config = buildConfiguration(config_dict, self.tmpdir + '/')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_webp_extension(self):
+        layer = self.config.layers['plain']
+
+        self.assertEqual(layer.getTypeByExtension('webp'), ('image/webp', 'WEBP'))
+
+        status_code, headers, content = requestHandler2(self.config, '/plain/0/0/0.webp')
+
+        self.assertEqual(status_code, 200)
+        self.assertEqual(headers['Content-Type'], 'image/webp')
+        self.assertEqual(content[:4] + content[8:12], 'RIFFWEBP')
+
+    def test_webp_options(self):
+        layer = self.config.layers['negotiated']
+
+        self.assertEqual(layer.webp_options, dict(lossless=True, method=2))
+        self.assertRaises(Exception, layer.setSaveOptionsWEBP, method=9)
+
+    def test_accepts_type(self):
+        self.assertTrue(acceptsType('image/webp,image/*,*/*;q=0.8', 'image/webp'))
+        self.assertTrue(acceptsType('image/png, image/webp; q=0.5', 'image/webp'))
+        self.assertFalse(acceptsType('image/webp;q=0', 'image/webp'))
+        self.assertFalse(acceptsType('image/*,*/*;q=0.8', 'image/webp'))
+        self.assertFalse(acceptsType(None, 'image/webp'))
+
+    def test_variants(self):
+        accept = 'image/webp,*/*;q=0.8'
+
+        status_code, headers, content = requestHandler2(self.config, '/negotiated/0/0/0.png', accept=accept)
+        self.assertEqual(headers['Content-Type'], 'image/webp')
+        self.assertEqual(headers['Vary'], 'Accept')
+
+        status_code, headers, content = requestHandler2(self.config, '/negotiated/0/0/0.png', accept='*/*')
+        self.assertEqual(headers['Content-Type'], 'image/png')
+        self.assertEqual(headers['Vary'], 'Accept')
+
+        status_code, headers, content = requestHandler2(self.config, '/plain/0/0/0.png', accept=accept)
+        self.assertEqual(headers['Content-Type'], 'image/png')
+        self.assertEqual(headers['Vary'], None)
+
+        # each variant is cached under its own extension.
+        self.assertTrue(exists(pathjoin(self.tmpdir, 'negotiated/0/000/000/000/000.webp')))
+        self.assertTrue(exists(pathjoin(self.tmpdir, 'negotiated/0/000/000/000/000.png')))
+
+    def test_png_options(self):
+        layer = self.config.layers['compressed']
+
+        self.assertEqual(layer.png_options['compress_level'], 9)
+        self.assertEqual(layer.png_options['compress_type'], png_strategies['filtered'])
+
+        self.assertRaises(KnownUnknown, layer.setSaveOptionsPNG, compress_level=10)
+        self.assertRaises(KnownUnknown, layer.setSaveOptionsPNG, compress_level='best')
+        self.assertRaises(KnownUnknown, layer.setSaveOptionsPNG, compress_level=-1)
+        self.assertRaises(KnownUnknown, layer.setSaveOptionsPNG, compress_level=[9])
+
+        # numbers of any type are fine, as in JSON or from the command line.
+        for level in (9.0, '9', u'9'):
+            layer.setSaveOptionsPNG(compress_level=level)
+            self.assertEqual(layer.png_options['compress_level'], 9)
+        self.assertRaises(KnownUnknown, layer.setSaveOptionsPNG, strategy='fastest')
+
+    def test_png_encode(self):
+        layer = self.config.layers['compressed']
+        pixels = Image.frombuffer('RGBA', (64, 64), ''.join(chr(i % 251) for i in range(64 * 64 * 4)), 'raw', 'RGBA', 0, 1)
+
+        # options reach PIL as they are.
+        tile = RecordingImage(pixels)
+        body = layer.encodeTile(tile, 'PNG')
+
+        self.assertEqual(tile.saved, [('PNG', layer.png_options)])
+        self.assertEqual(Image.open(StringIO(body)).tobytes(), pixels.tobytes())
+
+        # and make a difference to the result.
+        layer.setSaveOptionsPNG(compress_level=0)
+        self.assertTrue(len(layer.encodeTile(pixels, 'PNG')) > len(body))
+
+    def test_plain_save(self):
+        layer = self.config.layers['compressed']
+        pixels = Image.new('RGBA', (8, 8), (0x99, 0x66, 0x33, 0xFF))
+
+        # images without keyword args are saved without the layer's options.
+        body = layer.encodeTile(PlainImage(pixels), 'PNG')
+        self.assertEqual(Image.open(StringIO(body)).getpixel((0, 0)), (0x99, 0x66, 0x33, 0xFF))
+
+    def test_png_optimizer(self):
+        layer = self.config.layers['compressed']
+        pixels = Image.new('RGBA', (8, 8))
+
+        # the command gets the file name as its last argument, as $0 here.
+        layer.setSaveOptionsPNG(optimizer='sh -c \'printf optimized > "$0"\'')
+        self.assertEqual(layer.encodeTile(pixels, 'PNG'), 'optimized')
+
+        # the original is kept if the command fails.
+        layer.setSaveOptionsPNG(optimizer='false')
+        self.assertEqual(layer.encodeTile(pixels, 'PNG')[:4], '\x89PNG')
@@ -0,0 +1,107 @@
+from os import getpid
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from sqlite3 import connect
+from os.path import exists, join as pathjoin
+
+from ModestMaps.Core import Coordinate
+from TileStache.Goodies.Caches.LimitedDisk import Cache
+
+class Layer:
+    ''' Just enough of a layer for cache paths.
+    '''
+    def name(self):
+        return 'test'
+
+class LimitedDiskTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+        self.cache = Cache(self.tmpdir, limit=1, flush_interval=.01)
+        self.layer = Layer()
+
+        # no background thread, janitor work is called directly.
+        self.cache._janitor_pid = getpid()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def fullpath(self, coord):
+        return pathjoin(self.tmpdir, self.cache._filepath(self.layer, coord, 'PNG'))
+
+    def test_evict(self):
+        coords = [Coordinate(row, 0, 10) for row in range(250)]
+
+        for coord in coords:
+            self.cache.save('x' * 10, self.layer, coord, 'PNG')
+
+        db = connect(self.cache.dbpath)
+        db.execute('UPDATE tiles SET used=0 WHERE path=?', (self.cache._filepath(self.layer, coords[-1], 'PNG'), ))
+        (size, ), = db.execute('SELECT size FROM tiles LIMIT 1').fetchall()
+
+        # keep room for two tiles, more than one page of evictions.
+        self.cache.limit = size * 2
+        self.cache._evict(db)
+
+        remaining = db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+        self.assertEqual(remaining, 2)
+
+        # the least-recently-used tile goes first, though it was saved last.
+        self.assertFalse(exists(self.fullpath(coords[-1])))
+        self.assertTrue(exists(self.fullpath(coords[-2])))
+
+    def test_remove_missing(self):
+        coord = Coordinate(0, 0, 0)
+
+        self.cache.save('x', self.layer, coord, 'PNG')
+        self.cache._remove(self.cache._filepath(self.layer, coord, 'PNG'))
+
+        # no file behind the row, and then no row either.
+        self.cache.remove(self.layer, coord, 'PNG')
+        self.cache.remove(self.layer, coord, 'PNG')
+
+        self.assertFalse(exists(self.fullpath(coord)))
+
+    def test_janitor_errors(self):
+        calls = []
+
+        def flush(db):
+            calls.append(db)
+
+            if len(calls) == 1:
+                raise ValueError('Not a database problem')
+
+            self.cache._stopping = True
+
+        self.cache._flush = flush
+        self.cache._janitor()
+
+        self.assertEqual(len(calls), 2)
+
+    def test_flush(self):
+        coords = [Coordinate(row, 0, 10) for row in range(3)]
+
+        for coord in coords:
+            self.cache.save('x' * 10, self.layer, coord, 'PNG')
+
+        db = connect(self.cache.dbpath)
+        (size, ), = db.execute('SELECT size FROM tiles LIMIT 1').fetchall()
+        db.execute('UPDATE tiles SET used=0')
+        db.commit()
+
+        # the first tile is read last, so it's kept.
+        self.cache.read(self.layer, coords[0], 'PNG')
+        self.cache.limit = size
+
+        self.cache.flush()
+
+        self.assertTrue(exists(self.fullpath(coords[0])))
+        self.assertFalse(exists(self.fullpath(coords[1])))
+        self.assertFalse(exists(self.fullpath(coords[2])))
+
+        # again with nothing to do, on the same connection as before.
+        db = self.cache._db()
+        self.cache.flush()
+        self.cache.flush()
+        self.assertTrue(self.cache._db() is db)
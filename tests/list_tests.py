@@ -0,0 +1,33 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import dirname, exists, join as pathjoin
+from imp import load_source
+
+from ModestMaps.Core import Coordinate
+
+tilelist = load_source('tilestache_list', pathjoin(dirname(__file__), '../scripts/tilestache-list.py'))
+
+class WriteChunksTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_chunks(self):
+        prefix = pathjoin(self.tmpdir, 'list-')
+        coords = [Coordinate(row, column, 2) for row in range(2) for column in range(3)]
+        written = []
+
+        for filename in tilelist.writeChunks(iter(coords), 4, prefix):
+            # each file is complete by the time its name comes out.
+            written.append(open(filename).read().splitlines())
+
+        self.assertEqual(written, [['2/0/0', '2/1/0', '2/2/0', '2/0/1'], ['2/1/1', '2/2/1']])
+        self.assertTrue(exists(prefix + '000001'))
+        self.assertFalse(exists(prefix + '000002'))
+
+    def test_no_coordinates(self):
+        self.assertEqual(list(tilelist.writeChunks(iter([]), 4, pathjoin(self.tmpdir, 'list-'))), [])
@@ -0,0 +1,289 @@
+import os
+import json
+
+from unittest import TestCase
+from StringIO import StringIO
+from threading import Thread
+from types import ModuleType
+
+from ModestMaps.Core import Coordinate
+from TileStache import Mapnik, getTile
+from TileStache.Config import buildConfiguration
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    import Image as PILImage
+
+class Box2d:
+    def __init__(self, *bbox):
+        self.bbox = bbox
+
+class Map:
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+
+    def zoom_to_box(self, box):
+        self.box = box
+
+class Image:
+    ''' Solid red image, encoded as a description of itself.
+    '''
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+
+    def tostring(self, format=None):
+        if format is None:
+            return '\xff\x00\x00\xff' * self.width * self.height
+
+        return 'mapnik %s %dx%d' % (format, self.width, self.height)
+
+    def view(self, x, y, width, height):
+        return Image(width, height)
+
+def render(mmap, img):
+    pass
+
+def render_grid(mmap, index, resolution, fields):
+    ''' Grid of one feature per map layer, the top layer covering just its right half.
+    '''
+    size = mmap.width / resolution
+    name = mmap.layers[index].name
+    rows = [index and (' ' * (size / 2) + '!' * (size / 2)) or ('!' * size)] * size
+
+    return dict(keys=['', name], data={name: dict(fields=fields)}, grid=rows)
+
+class Layer:
+    def __init__(self, name):
+        self.name = name
+        self.datasource = self
+
+    def fields(self):
+        return ['NAME']
+
+class FontEngine:
+    @staticmethod
+    def instance():
+        return FontEngine()
+
+fake_mapnik = ModuleType('mapnik')
+fake_mapnik.Box2d, fake_mapnik.Map, fake_mapnik.Image, fake_mapnik.render = Box2d, Map, Image, render
+fake_mapnik.FontEngine, fake_mapnik.render_grid = FontEngine, render_grid
+
+def load_map(mapfile):
+    ''' Map loader for pools, with no mapfile to read.
+    '''
+    return Map(0, 0)
+
+class FakeMapnikTests(TestCase):
+    ''' Base class for tests with a fake mapnik module in place of any real one.
+    '''
+    names = 'mapnik', 'Box2d', '_version'
+
+    def setUp(self):
+        self.saved = dict([(name, getattr(Mapnik, name)) for name in self.names if hasattr(Mapnik, name)])
+        Mapnik.mapnik, Mapnik.Box2d, Mapnik._version = fake_mapnik, Box2d, 20000
+
+    def tearDown(self):
+        for name in self.names:
+            if name in self.saved:
+                setattr(Mapnik, name, self.saved[name])
+            else:
+                delattr(Mapnik, name)
+
+class CascadenikTests(FakeMapnikTests):
+
+    def test_shared_pool(self):
+        '''Reloaded Cascadenik layers share one map pool per working directory'''
+
+        from TileStache.Goodies.Providers.Cascadenik import MMLLoader
+
+        pool = Mapnik.get_mapPool('/tmp/style.mml', 2, MMLLoader('/tmp/work'))
+
+        self.assertTrue(Mapnik.get_mapPool('/tmp/style.mml', 2, MMLLoader('/tmp/work')) is pool)
+        self.assertFalse(Mapnik.get_mapPool('/tmp/style.mml', 2, MMLLoader('/tmp/other')) is pool)
+
+class MapPoolTests(TestCase):
+
+    def setUp(self):
+        self.loaded = []
+
+    def loader(self, mapfile):
+        self.loaded.append(mapfile)
+        return Map(0, 0)
+
+    def test_size_limit(self):
+        '''Checkouts wait for a map once the pool is full'''
+
+        pool = Mapnik.MapPool('style.xml', 2, self.loader)
+        map1, map2 = pool.checkout(), pool.checkout()
+        got = []
+
+        waiting = Thread(target=lambda: got.append(pool.checkout()))
+        waiting.start()
+        waiting.join(.2)
+
+        self.assertTrue(waiting.is_alive())
+        self.assertEqual(got, [])
+
+        pool.checkin(map1)
+        waiting.join()
+
+        self.assertEqual(got, [map1])
+        self.assertEqual(len(self.loaded), 2)
+
+    def test_thread_reuse(self):
+        '''Maps are loaded once and reused by renders in other threads'''
+
+        pool = Mapnik.MapPool('style.xml', 4, self.loader)
+        used = []
+
+        def render():
+            with pool.render_map() as mmap:
+                used.append(mmap)
+
+        for i in range(3):
+            thread = Thread(target=render)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(len(self.loaded), 1)
+        self.assertEqual(len(set(map(id, used))), 1)
+
+    def test_discard_on_error(self):
+        '''Maps from a failed render are discarded and loaded again'''
+
+        pool = Mapnik.MapPool('style.xml', 1, self.loader)
+
+        try:
+            with pool.render_map() as mmap:
+                raise ValueError()
+        except ValueError:
+            pass
+
+        with pool.render_map() as other:
+            self.assertFalse(other is mmap)
+
+        self.assertEqual(len(self.loaded), 2)
+
+    def test_shared_pools(self):
+        '''Pools are shared in a process, and started again after a fork'''
+
+        pool = Mapnik.get_mapPool('style.xml', 2, self.loader)
+
+        self.assertTrue(Mapnik.get_mapPool('style.xml', 2, self.loader) is pool)
+        self.assertFalse(Mapnik.get_mapPool('style.xml', 3, self.loader) is pool)
+
+        pid = os.fork()
+
+        if pid == 0:
+            os._exit(int(Mapnik.get_mapPool('style.xml', 2, self.loader) is pool))
+
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertTrue(Mapnik.get_mapPool('style.xml', 2, self.loader) is pool)
+
+class WorkerPoolTests(FakeMapnikTests):
+
+    def setUp(self):
+        FakeMapnikTests.setUp(self)
+        self.pool = Mapnik.WorkerPool('style.xml', 1, load_map, 16 * 16 * 4, lifetime=3)
+
+    def tearDown(self):
+        for worker in self.pool.maps:
+            worker.stop()
+
+        FakeMapnikTests.tearDown(self)
+
+    def render(self, size):
+        with self.pool.render_map() as worker:
+            return worker, worker.render(size, size, (0, 0, 1, 1), 10)
+
+    def test_render(self):
+        '''Pixels come back through shared memory, or the pipe for big renders'''
+
+        worker, small = self.render(16)
+        worker, large = self.render(32)
+
+        self.assertEqual((small.size, small.getpixel((15, 15))), ((16, 16), (0xFF, 0, 0, 0xFF)))
+        self.assertEqual((large.size, large.getpixel((31, 31))), ((32, 32), (0xFF, 0, 0, 0xFF)))
+
+    def test_replace_workers(self):
+        '''Dead workers and workers past their lifetime are replaced'''
+
+        worker1, image = self.render(16)
+
+        worker1.process.terminate()
+        worker1.process.join()
+
+        worker2, image = self.render(16)
+        self.assertNotEqual(worker1.process.pid, worker2.process.pid)
+
+        self.render(16)
+        self.render(16)
+
+        worker3, image = self.render(16)
+        self.assertNotEqual(worker2.process.pid, worker3.process.pid)
+        self.assertFalse(worker2.is_alive())
+        self.assertEqual(self.pool.loaded, 1)
+
+class MapnikImageTests(FakeMapnikTests):
+
+    def test_save(self):
+        '''Tiles are encoded by Mapnik in its own format, and by PIL in others'''
+
+        image = Mapnik.MapnikImage(Image(4, 4), (4, 4), 'png256')
+
+        out = StringIO()
+        image.save(out, 'PNG', optimize=True)
+        self.assertEqual(out.getvalue(), 'mapnik png256 4x4')
+
+        out = StringIO()
+        image.save(out, 'GIF')
+        self.assertEqual(PILImage.open(StringIO(out.getvalue())).format, 'GIF')
+
+        out = StringIO()
+        image.crop((2, 0, 4, 2)).save(out, 'PNG')
+        self.assertEqual(out.getvalue(), 'mapnik png256 2x2')
+
+    def test_provider(self):
+        '''Metatiles are sliced into views and encoded by Mapnik, or by PIL without a Mapnik format'''
+
+        provider = {'name': 'mapnik', 'mapfile': 'style.xml', 'mapnik format': 'png256'}
+        layers = {'mapnik': {'provider': provider, 'metatile': {'rows': 2, 'columns': 2}},
+                  'pil': {'provider': {'name': 'mapnik', 'mapfile': 'style.xml'}}}
+
+        config = buildConfiguration({'cache': {'name': 'Test'}, 'layers': layers})
+
+        for layer in config.layers.values():
+            layer.provider.map_loader = load_map
+
+        mime, body = getTile(config.layers['mapnik'], Coordinate(1, 1, 2), 'png')
+        self.assertEqual(body, 'mapnik png256 256x256')
+
+        mime, body = getTile(config.layers['pil'], Coordinate(1, 1, 2), 'png')
+        self.assertEqual(PILImage.open(StringIO(body)).getpixel((0, 0)), (0xFF, 0, 0, 0xFF))
+
+class GridProviderTests(FakeMapnikTests):
+
+    def test_layers(self):
+        '''Layer grids are merged one on top of the other, with the name of each feature's layer'''
+
+        provider = {'name': 'mapnik grid', 'mapfile': 'grid.xml', 'layer_id_key': 'layer', 'layers': [[0, None], [1, ['NAME']]]}
+        config = buildConfiguration({'cache': {'name': 'Test'}, 'layers': {'grid': {'provider': provider}}})
+
+        def load_layers(mapfile):
+            mmap = Map(0, 0)
+            mmap.layers = [Layer('bottom'), Layer('top')]
+            return mmap
+
+        Mapnik.get_mapPool(config.layers['grid'].provider.mapfile, 4).loader = load_layers
+
+        mime, body = getTile(config.layers['grid'], Coordinate(1, 1, 2), 'json')
+        grid = json.loads(body)
+
+        ids = Mapnik.decode_grid(grid['grid'])
+        layers = [grid['data'][grid['keys'][id]]['layer'] for id in ids[0]]
+
+        self.assertEqual(ids.shape, (64, 64))
+        self.assertEqual(layers, ['bottom'] * 32 + ['top'] * 32)
+        self.assertEqual(grid['data'][grid['keys'][ids[0][0]]]['fields'], ['NAME'])
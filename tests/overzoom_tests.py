@@ -0,0 +1,139 @@
+from unittest import TestCase
+from StringIO import StringIO
+
+from ModestMaps.Core import Coordinate
+from TileStache.Config import buildConfiguration
+from TileStache.Core import KnownUnknown
+from TileStache import getTile
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+def cell_color(coord, x, y):
+    ''' Color of one cell in a 4x4 grid, unique across tiles at a zoom.
+    '''
+    return (int(coord.column) * 4 + x, int(coord.row) * 4 + y, coord.zoom, 0xFF)
+
+class Provider:
+    ''' Renders tiles as 4x4 grids of unique colors, and counts them.
+    '''
+    def __init__(self, layer):
+        self.layer = layer
+        self.rendered = []
+
+    def renderTile(self, width, height, srs, coord):
+        self.rendered.append(coord)
+        image = Image.new('RGBA', (width, height))
+
+        for y in range(4):
+            for x in range(4):
+                box = (x * width / 4, y * height / 4, (x + 1) * width / 4, (y + 1) * height / 4)
+                image.paste(cell_color(coord, x, y), box)
+
+        return image
+
+class OverzoomTests(TestCase):
+
+    def setUp(self):
+        config_dict = {
+          'cache': {'name': 'Test'},
+          'layers': {
+            'source': {'provider': {'class': 'tests.overzoom_tests:Provider'}},
+            'overzoom': {'provider': {'name': 'Overzoom', 'layer': 'source', 'source zoom': 3,
+                                      'resample': 'nearest', 'memo size': 2},
+                         'png options': {'compress_level': 0}}
+          }
+        }
+
+        self.config = buildConfiguration(config_dict)
+        self.source = self.config.layers['source'].provider
+        self.provider = self.config.layers['overzoom'].provider
+
+    def render(self, row, column, zoom):
+        return self.provider.renderTile(256, 256, None, Coordinate(row, column, zoom))
+
+    def test_source_zoom(self):
+        coord = Coordinate(5, 6, 3)
+        mime, body = getTile(self.config.layers['overzoom'], coord, 'png')
+
+        # passed through as-is, without this layer's compression level.
+        self.assertEqual(body, getTile(self.config.layers['source'], coord, 'png')[1])
+
+        tile = Image.open(StringIO(body))
+        self.assertEqual(tile.getpixel((0, 0)), cell_color(coord, 0, 0))
+        self.assertEqual(tile.getpixel((255, 255)), cell_color(coord, 3, 3))
+
+        # decoded if it's wanted in another format.
+        buff = StringIO()
+        self.render(5, 6, 3).save(buff, 'GIF')
+        self.assertEqual(Image.open(StringIO(buff.getvalue())).format, 'GIF')
+
+    def test_ancestor_crop(self):
+        ancestor = Coordinate(5, 6, 3)
+
+        # two zooms up, each tile is one grid cell of its ancestor scaled up.
+        for (x, y) in ((0, 0), (3, 0), (1, 2), (3, 3)):
+            tile = self.render(ancestor.row * 4 + y, ancestor.column * 4 + x, 5)
+
+            self.assertEqual(tile.size, (256, 256))
+            self.assertEqual(tile.getextrema(), tuple((c, c) for c in cell_color(ancestor, x, y)))
+
+        # one zoom up, each tile is four cells of its ancestor.
+        tile = self.render(ancestor.row * 2 + 1, ancestor.column * 2, 4)
+
+        self.assertEqual(tile.getpixel((0, 0)), cell_color(ancestor, 0, 2))
+        self.assertEqual(tile.getpixel((255, 0)), cell_color(ancestor, 1, 2))
+        self.assertEqual(tile.getpixel((0, 255)), cell_color(ancestor, 0, 3))
+
+        # all from one ancestor tile, rendered once.
+        self.assertEqual(self.source.rendered, [ancestor])
+
+    def test_memo_eviction(self):
+        a, b, c = Coordinate(0, 0, 3), Coordinate(0, 1, 3), Coordinate(0, 2, 3)
+
+        for ancestor in (a, b, a, c):
+            self.render(ancestor.row * 2, ancestor.column * 2, 4)
+
+        # a was used more recently than b, so b made room for c.
+        self.assertEqual(self.source.rendered, [a, b, c])
+        self.assertEqual(self.provider.memo.keys(), [(3, 0, 0), (3, 2, 0)])
+
+        self.render(b.row * 2, b.column * 2, 4)
+        self.render(c.row * 2, c.column * 2, 4)
+
+        self.assertEqual(self.source.rendered, [a, b, c, b])
+        self.assertEqual(self.provider.memo.keys(), [(3, 1, 0), (3, 2, 0)])
+
+    def test_memo_ttl(self):
+        a = Coordinate(0, 0, 3)
+
+        self.render(a.row * 2, a.column * 2, 4)
+        self.render(a.row * 2, a.column * 2 + 1, 4)
+        self.assertEqual(self.source.rendered, [a])
+
+        # expired ancestors are fetched again.
+        self.provider.memo.clear()
+        self.provider.memo_ttl = 0
+
+        self.render(a.row * 2, a.column * 2, 4)
+        self.render(a.row * 2, a.column * 2 + 1, 4)
+        self.assertEqual(self.source.rendered, [a, a, a])
+
+    def test_no_memo(self):
+        provider = {'name': 'Overzoom', 'layer': 'source', 'source zoom': 3}
+        layers = {'source': {'provider': {'class': 'tests.overzoom_tests:Provider'}}, 'overzoom': {'provider': provider}}
+        config = buildConfiguration({'cache': {'name': 'Test'}, 'layers': layers})
+
+        for column in (0, 1):
+            config.layers['overzoom'].provider.renderTile(256, 256, None, Coordinate(0, column, 4))
+
+        self.assertEqual(len(config.layers['source'].provider.rendered), 2)
+        self.assertEqual(len(config.layers['overzoom'].provider.memo), 0)
+
+    def test_bad_filter(self):
+        provider = {'name': 'Overzoom', 'layer': 'source', 'source zoom': 3, 'resample': 'antialias'}
+        config = {'cache': {'name': 'Test'}, 'layers': {'overzoom': {'provider': provider}}}
+
+        self.assertRaises(KnownUnknown, buildConfiguration, config)
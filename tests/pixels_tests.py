@@ -0,0 +1,149 @@
+from unittest import TestCase
+from random import Random
+from tempfile import mkdtemp
+from shutil import rmtree
+from struct import pack
+from StringIO import StringIO
+from os.path import join as pathjoin
+
+from ModestMaps.Core import Coordinate
+from TileStache.Config import buildConfiguration
+from TileStache.Pixels import apply_palette, palette_color, get_palette_lookup, SharedPalettes
+from TileStache import Pixels, getTile
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+class Provider:
+    ''' Renders tiles with a few stripes of color.
+    '''
+    def __init__(self, layer):
+        self.layer = layer
+
+    def renderTile(self, width, height, srs, coord):
+        image = Image.new('RGBA', (width, height))
+
+        for (x, color) in enumerate([(255, 0, 0, 255), (0, 255, 0, 255), (250, 250, 250, 255), (0, 0, 0, 0)]):
+            image.paste(color, (x * width / 4, 0, (x + 1) * width / 4, height))
+
+        return image
+
+class PixelsTests(TestCase):
+
+    def setUp(self):
+        self.random = Random(0)
+
+    def random_image(self, size):
+        values = [self.random.choice((0, 127, 128, 255, self.random.randrange(256))) for i in range(size * size * 4)]
+        image = Image.new('RGBA', (size, size))
+        image.putdata(zip(values[0::4], values[1::4], values[2::4], values[3::4]))
+
+        return image
+
+    def random_palette(self, count):
+        return [(self.random.randrange(256), self.random.randrange(256), self.random.randrange(256)) for i in range(count)]
+
+    def test_apply_palette(self):
+        image, palette = self.random_image(32), self.random_palette(16)
+        output = apply_palette(image, palette, None)
+
+        expected = [palette_color(r, g, b, palette, None) for (r, g, b, a) in image.getdata()]
+
+        self.assertEqual(output.mode, 'P')
+        self.assertEqual(list(output.getdata()), expected)
+        self.assertEqual(len(palette), 16)
+
+    def test_apply_palette_transparency(self):
+        image, palette = self.random_image(32), self.random_palette(16)
+        output = apply_palette(image, palette, 5)
+
+        expected = [(a < 0x80) and 5 or palette_color(r, g, b, palette, 5) for (r, g, b, a) in image.getdata()]
+
+        self.assertEqual(list(output.getdata()), expected)
+
+    def test_shared_lookup(self):
+        tmpdir = mkdtemp(prefix='tilestache-test-')
+
+        try:
+            palette = [(255, 0, 0), (0, 255, 0), (255, 255, 255), (0, 0, 0)]
+            act = ''.join([pack('BBB', *color) for color in palette]) + '\x00' * (768 - 12) + pack('!HH', 4, 3)
+            open(pathjoin(tmpdir, 'palette.act'), 'wb').write(act)
+
+            layer_dict = {'provider': {'class': 'tests.pixels_tests:Provider'}, 'png options': {'palette': 'palette.act'}}
+            config = buildConfiguration({'cache': {'name': 'Test'}, 'layers': {'one': layer_dict, 'two': dict(layer_dict)}}, tmpdir + '/')
+
+            body1 = getTile(config.layers['one'], Coordinate(0, 0, 1), 'png')[1]
+            lookups = len(Pixels._lookups)
+            body2 = getTile(config.layers['two'], Coordinate(0, 0, 1), 'png')[1]
+
+            # the second layer reused the first one's lookup table.
+            self.assertEqual(len(Pixels._lookups), lookups)
+            self.assertEqual(body1, body2)
+
+            one, two = config.layers['one'], config.layers['two']
+            self.assertTrue(get_palette_lookup(one.bitmap_palette, 3) is get_palette_lookup(two.bitmap_palette, 3))
+
+            tile = Image.open(StringIO(body1))
+            self.assertEqual([tile.getpixel((x, 0)) for x in (0, 64, 128, 192)], [0, 1, 2, 3])
+
+        finally:
+            rmtree(tmpdir)
+
+    def test_lookup_limit(self):
+        lookups = [get_palette_lookup(self.random_palette(4), None) for i in range(Pixels._lookups_size + 1)]
+
+        self.assertEqual(len(Pixels._lookups), Pixels._lookups_size)
+        self.assertFalse(lookups[0] in Pixels._lookups.values())
+        self.assertTrue(lookups[-1] in Pixels._lookups.values())
+
+class SharedPalettesTests(TestCase):
+
+    def stripes(self, shift):
+        ''' Return an image of four stripes, with colors shifted by some amount.
+        '''
+        image = Image.new('RGBA', (64, 64))
+
+        for (x, (r, g, b)) in enumerate([(200, 0, 0), (0, 200, 0), (0, 0, 200), (100, 100, 100)]):
+            image.paste((r + shift, g + shift, b + shift, 255), (x * 16, 0, (x + 1) * 16, 64))
+
+        return image
+
+    def color(self, image):
+        return image.convert('RGB').getpixel((0, 0))
+
+    def test_reuse(self):
+        '''Palettes are reused for images that fit within max_error'''
+
+        palettes = SharedPalettes(8)
+        first = palettes.apply(self.stripes(0), 10)
+
+        self.assertEqual(first.mode, 'P')
+        self.assertEqual(self.color(first), (200, 0, 0))
+        self.assertEqual(len(palettes.palettes[10]), 4)
+
+        # a shift of 4 is an error of sqrt(3 * 4**2), or about 6.9.
+        self.assertEqual(self.color(palettes.apply(self.stripes(4), 10)), (200, 0, 0))
+
+        # a shift of 8 is too far, so the image gets a new palette.
+        self.assertEqual(self.color(palettes.apply(self.stripes(8), 10)), (208, 8, 8))
+        self.assertEqual(self.color(palettes.apply(self.stripes(4), 10)), (208, 8, 8))
+
+    def test_zooms(self):
+        '''Each zoom level has its own palette'''
+
+        palettes = SharedPalettes(8)
+        palettes.apply(self.stripes(0), 10)
+
+        self.assertEqual(self.color(palettes.apply(self.stripes(4), 11)), (204, 4, 4))
+        self.assertEqual(self.color(palettes.apply(self.stripes(4), 10)), (200, 0, 0))
+        self.assertEqual(sorted(palettes.palettes.keys()), [10, 11])
+
+    def test_no_max_error(self):
+        '''Without max_error, every image gets a new palette'''
+
+        palettes = SharedPalettes()
+        palettes.apply(self.stripes(0), 10)
+
+        self.assertEqual(self.color(palettes.apply(self.stripes(1), 10)), (201, 1, 1))
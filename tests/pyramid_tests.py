@@ -0,0 +1,86 @@
+from unittest import TestCase
+from StringIO import StringIO
+
+from ModestMaps.Core import Coordinate
+from TileStache.Config import buildConfiguration
+from TileStache.Core import KnownUnknown
+from TileStache import Pyramid, getTile
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+# tile colors, by position among their siblings.
+colors = {(0, 0): (0xFF, 0x00, 0x00), (0, 1): (0x00, 0xFF, 0x00),
+          (1, 0): (0x00, 0x00, 0xFF), (1, 1): (0xFF, 0xFF, 0x00)}
+
+class Provider:
+    ''' Renders tiles of one color each, a different one for each sibling, and counts them.
+    '''
+    def __init__(self, layer, color=None):
+        self.layer = layer
+        self.color = color
+        self.rendered = []
+
+    def renderTile(self, width, height, srs, coord):
+        self.rendered.append(coord)
+        color = self.color or colors[(int(coord.row) % 2, int(coord.column) % 2)]
+
+        return Image.new('RGB', (width, height), tuple(color))
+
+class PyramidTests(TestCase):
+
+    def setUp(self):
+        layer = lambda **kwargs: dict(provider={'class': 'tests.pyramid_tests:Provider', 'kwargs': kwargs})
+
+        config_dict = {
+          'cache': {'name': 'Test'},
+          'layers': {
+            'colors': layer(),
+            'ocean': layer(color=[0x00, 0x66, 0xCC]),
+            'palette': dict(layer(), **{'png options': {'palette256': True}})
+          }
+        }
+
+        self.config = buildConfiguration(config_dict)
+
+    def build(self, name, coord, extension='png', **kwargs):
+        layer = self.config.layers[name]
+        body = Pyramid.buildTile(layer, coord, extension, **kwargs)
+
+        return layer, body, Image.open(StringIO(body))
+
+    def test_build_from_children(self):
+        layer, body, tile = self.build('colors', Coordinate(0, 0, 0))
+
+        self.assertEqual(tile.size, (256, 256))
+        self.assertEqual(layer.provider.rendered, [Coordinate(0, 0, 1), Coordinate(0, 1, 1),
+                                                   Coordinate(1, 0, 1), Coordinate(1, 1, 1)])
+
+        # each child lands in its own quarter of the parent, shrunk by half.
+        for ((row, column), color) in colors.items():
+            self.assertEqual(tile.convert('RGB').getpixel((column * 128 + 64, row * 128 + 64)), color)
+
+    def test_build_jpeg(self):
+        layer, body, tile = self.build('colors', Coordinate(0, 0, 0), 'jpg', resample='nearest')
+
+        self.assertEqual(tile.format, 'JPEG')
+        self.assertEqual(tile.mode, 'RGB')
+
+        # palette256 is for PNG tiles only.
+        layer, body, tile = self.build('palette', Coordinate(0, 0, 0), 'jpg')
+        self.assertEqual(tile.format, 'JPEG')
+
+        layer, body, tile = self.build('palette', Coordinate(0, 0, 0), 'png')
+        self.assertEqual(tile.mode, 'P')
+
+    def test_reuse_identical(self):
+        layer, body, tile = self.build('ocean', Coordinate(0, 0, 0), reuse_identical=True)
+
+        # four identical children, so the first is returned as-is.
+        self.assertEqual(body, getTile(layer, Coordinate(0, 0, 1), 'png')[1])
+
+    def test_bad_filter(self):
+        layer = self.config.layers['colors']
+        self.assertRaises(KnownUnknown, Pyramid.buildTile, layer, Coordinate(0, 0, 0), 'png', 'sharpest')
@@ -0,0 +1,138 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from itertools import product
+from os.path import join as pathjoin
+
+import numpy
+
+from ModestMaps.Core import Coordinate
+from TileStache.Config import buildConfiguration
+from TileStache.Core import KnownUnknown
+from TileStache import Sandwich
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+class Provider:
+    ''' Renders tiles of one color, or raises an error, for testing stacks.
+    '''
+    def __init__(self, layer, color=None):
+        self.layer = layer
+        self.color = color
+
+    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+        if self.color is None:
+            raise Exception('No color')
+
+        return Image.new('RGBA', (width, height), tuple(self.color))
+
+def reference_local_bitmap(image, coord, dim):
+    ''' Tile an image by pasting it as many times as needed, as Sandwich used to.
+    '''
+    coord = coord.zoomBy(8)
+    w, h, col, row = image.size[0], image.size[1], int(coord.column), int(coord.row)
+
+    x = w * (col / w) - col
+    y = h * (row / h) - row
+
+    output = Image.new('RGBA', (dim, dim))
+
+    for (x, y) in product(range(x, dim, w), range(y, dim, h)):
+        xmin = 0 if x > 0 else -x
+        ymin = 0 if y > 0 else -y
+
+        x = x if x >= 0 else 0
+        y = y if y >= 0 else 0
+
+        output.paste(image.crop((xmin, ymin, w, h)), (x, y))
+
+    return output
+
+class SandwichTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+
+        pixels = numpy.random.RandomState(0).randint(0, 256, (70, 90, 4)).astype(numpy.uint8)
+        self.pattern = Image.fromarray(pixels, 'RGBA')
+        self.pattern.save(pathjoin(self.tmpdir, 'pattern.png'))
+
+        layer = lambda color: {'provider': {'class': 'tests.sandwich_tests:Provider', 'kwargs': {'color': color}}}
+
+        config_dict = {
+          'cache': {'name': 'Test'},
+          'layers': {
+            'red': layer([0xFF, 0x00, 0x00, 0xFF]),
+            'gray': layer([0x80, 0x80, 0x80, 0xFF]),
+            'broken': layer(None),
+            'sandwich': {
+              'provider': {
+                'name': 'Sandwich',
+                'stack': [
+                  {'color': '#00f'},
+                  {'src': 'red', 'mask': 'gray'},
+                  {'src': 'red', 'mode': 'multiply', 'zoom': '5-6'}
+                ]
+              }
+            },
+            'broken sandwich': {'provider': {'name': 'Sandwich', 'stack': [{'src': 'red'}, {'src': 'broken'}]}}
+          }
+        }
+
+        self.config = buildConfiguration(config_dict, self.tmpdir + '/')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def render(self, name, coord):
+        layer = self.config.layers[name]
+        return layer.provider.renderTile(256, 256, None, coord)
+
+    def test_make_color(self):
+        self.assertEqual(list(Sandwich.make_color('#f908') * 255), [0xFF, 0x99, 0x00, 0x88])
+        self.assertEqual(list(Sandwich.make_color('#ff990088') * 255), [0xFF, 0x99, 0x00, 0x88])
+        self.assertRaises(KnownUnknown, Sandwich.make_color, '#bear')
+
+    def test_blend(self):
+        bottom = numpy.zeros((2, 2, 4), numpy.float32)
+        bottom[:] = Sandwich.make_color('#0000ff')
+
+        Sandwich.blend(bottom, Sandwich.make_color('#ff0000'), None, 0.5)
+        self.assertTrue(numpy.allclose(bottom, (.5, 0, .5, 1)))
+
+        Sandwich.blend(bottom, Sandwich.make_color('#ffffff'), None, 1, Sandwich.multiply)
+        self.assertTrue(numpy.allclose(bottom, (.5, 0, .5, 1)))
+
+    def test_adjustments(self):
+        pixels = numpy.array([[[0, .25, .5, 1], [.75, 1, .5, .5]]], numpy.float32)
+
+        inverted = Sandwich.curves2([(0, 255), (128, 127), (255, 0)])(pixels.copy())
+        self.assertTrue(numpy.allclose(inverted[..., :3], 1 - pixels[..., :3], atol=.01))
+        self.assertTrue(numpy.allclose(inverted[..., 3], pixels[..., 3]))
+
+        thresholded = Sandwich.threshold(128)(pixels.copy())
+        self.assertEqual(thresholded[..., :3].tolist(), [[[0, 0, 0], [1, 1, 0]]])
+
+    def test_stack(self):
+        tile = self.render('sandwich', Coordinate(0, 0, 4))
+
+        # red through a 50% gray mask onto blue
+        self.assertEqual(tile.getpixel((0, 0)), (0x80, 0x00, 0x7F, 0xFF))
+
+        tile = self.render('sandwich', Coordinate(0, 0, 5))
+
+        # then multiplied with red
+        self.assertEqual(tile.getpixel((0, 0)), (0x80, 0x00, 0x00, 0xFF))
+
+    def test_local_bitmap(self):
+        for coord in (Coordinate(0, 0, 0), Coordinate(3, 5, 4), Coordinate(1234, 567, 12)):
+            pixels = Sandwich.local_bitmap('pattern.png', self.config, coord, 256, 256)
+            expected = reference_local_bitmap(self.pattern, coord, 256)
+
+            self.assertTrue(Sandwich.pixels_image(pixels.copy()).tobytes() == expected.tobytes())
+
+    def test_layer_errors(self):
+        self.assertRaises(Exception, self.render, 'broken sandwich', Coordinate(0, 0, 0))
@@ -0,0 +1,313 @@
+import os
+import sys
+import json
+
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from subprocess import Popen, PIPE
+from os.path import exists, dirname, abspath, join as pathjoin
+from imp import load_source
+
+from shapely.geometry import Point, LineString, Polygon, box
+
+from ModestMaps.Core import Coordinate
+from TileStache.Config import buildConfiguration
+
+seed = load_source('tilestache_seed', pathjoin(dirname(__file__), '../scripts/tilestache-seed.py'))
+
+class JSONArea:
+    ''' Rendered JSON that can be cut up like a metatile image.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def crop(self, bbox):
+        return JSONArea('%s %d,%d' % ((self.name, ) + bbox[:2]))
+
+    def save(self, out, format):
+        out.write(json.dumps(dict(tile=self.name)))
+
+class Provider:
+    ''' Renders JSON areas named for their zoom level.
+    '''
+    def __init__(self, layer):
+        self.layer = layer
+
+    def getTypeByExtension(self, extension):
+        return 'application/json', 'JSON'
+
+    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+        return JSONArea('zoom %d' % zoom)
+
+class DyingProvider (Provider):
+    ''' Logs each render to a file, and exits without warning after a number of them.
+    '''
+    def __init__(self, layer, logfile, renders=None):
+        Provider.__init__(self, layer)
+        self.logfile, self.renders = logfile, renders
+
+    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+        if self.renders is not None and exists(self.logfile):
+            if len(open(self.logfile).readlines()) >= self.renders:
+                os._exit(1)
+
+        with open(self.logfile, 'a') as file:
+            file.write('%d %d %d\n' % (zoom, xmin, ymin))
+
+        return Provider.renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom)
+
+class Metatile:
+    def __init__(self, rows, columns):
+        self.rows, self.columns = rows, columns
+
+def brute_force(geometry, zoom, rows=1, columns=1):
+    ''' Test every tile at a zoom, the slow way.
+    '''
+    width, height = columns / 2.**zoom, rows / 2.**zoom
+    polygonal = geometry.geom_type in ('Polygon', 'MultiPolygon')
+    found = set()
+
+    for column in range(int(2**zoom / columns)):
+        for row in range(int(2**zoom / rows)):
+            tile = box(column * width, row * height, (column + 1) * width, (row + 1) * height)
+
+            if not geometry.intersects(tile) or (polygonal and geometry.touches(tile)):
+                continue
+
+            found.add((row * rows, column * columns, zoom))
+
+    return found
+
+class SeedGeometryTests(TestCase):
+
+    def coordinates(self, geometry, zoom, metatile=None):
+        coords = [coord for (offset, count, coord) in seed.geometryCoordinates(geometry, [zoom], 0, metatile)]
+        found = set([(int(c.row), int(c.column), c.zoom) for c in coords])
+
+        self.assertEqual(len(found), len(coords), 'No tile should come up twice')
+        return found
+
+    def test_polygon(self):
+        polygon = Polygon([(.1, .2), (.45, .15), (.6, .5), (.3, .65), (.12, .4)])
+
+        for zoom in range(1, 7):
+            self.assertEqual(self.coordinates(polygon, zoom), brute_force(polygon, zoom))
+            self.assertEqual(self.coordinates(polygon, zoom, Metatile(2, 2)), brute_force(polygon, zoom, 2, 2))
+
+        # a square exactly covering one tile doesn't spill into its neighbors.
+        square = box(.25, .25, .5, .5)
+        self.assertEqual(self.coordinates(square, 2), set([(1, 1, 2)]))
+
+    def test_line(self):
+        line = LineString([(.1, .1), (.7, .35), (.5, .9)])
+
+        for zoom in range(1, 7):
+            self.assertEqual(self.coordinates(line, zoom), brute_force(line, zoom))
+
+        # a line along a tile edge is in the tiles on both sides.
+        edge = LineString([(.5, .1), (.5, .2)])
+        self.assertEqual(self.coordinates(edge, 1), set([(0, 0, 1), (0, 1, 1)]))
+
+    def test_point(self):
+        for (x, y) in ((.3, .7), (.25, .6), (.25, .75)):
+            point = Point(x, y)
+
+            for zoom in range(1, 7):
+                self.assertEqual(self.coordinates(point, zoom), brute_force(point, zoom))
+
+        # a point on a tile corner is in all four tiles.
+        corner = Point(.5, .5)
+        self.assertEqual(self.coordinates(corner, 1), set([(0, 0, 1), (0, 1, 1), (1, 0, 1), (1, 1, 1)]))
+
+class SeedReportTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_metatile_report(self):
+        report = seed.SeedReport(8, Metatile(2, 2))
+
+        report.add(Coordinate(0, 0, 0), 1., 100)
+        report.add(Coordinate(0, 0, 3), 2., 100)
+        report.add(Coordinate(2, 0, 3), 3., 200)
+
+        filename = pathjoin(self.tmpdir, 'report.json')
+        report.save(filename, 10)
+        saved = json.load(open(filename))
+
+        # one tile at zoom 0, and four tiles from each zoom 3 metatile.
+        self.assertEqual(saved['total']['renders'], 3)
+        self.assertEqual(saved['total']['tiles'], 9)
+        self.assertEqual(saved['total']['bytes'], 100 + 400 + 800)
+        self.assertEqual(saved['zooms']['3']['bytes_histogram'], {'<=128B': 4, '<=256B': 4})
+        self.assertEqual((saved['metatile']['rows'], saved['metatile']['columns']), (2, 2))
+
+        # estimates are per render.
+        self.assertEqual(saved['total']['planned_renders'], 10)
+        self.assertAlmostEqual(saved['total']['estimated_seconds'], 20.)
+        self.assertAlmostEqual(saved['total']['estimated_bytes'], 1300 * 10 / 3.)
+
+class GenerateCoordinatesTests(TestCase):
+
+    def coordinates(self, ul, lr, zooms, metatile=None):
+        return [(offset, count, c.zoom, int(c.column), int(c.row)) for (offset, count, c)
+                in seed.generateCoordinates(ul, lr, zooms, 0, metatile)]
+
+    def test_z_order(self):
+        found = self.coordinates(Coordinate(0, 0, 2), Coordinate(3, 3, 2), [1, 2])
+
+        self.assertEqual(found[:4], [(0, 20, 1, 0, 0), (1, 20, 1, 1, 0), (2, 20, 1, 0, 1), (3, 20, 1, 1, 1)])
+        self.assertEqual([(column, row) for (o, n, zoom, column, row) in found[4:12]],
+                         [(0, 0), (1, 0), (0, 1), (1, 1), (2, 0), (3, 0), (2, 1), (3, 1)])
+        self.assertEqual([offset for (offset, n, z, c, r) in found], range(20))
+
+    def test_metatile(self):
+        found = self.coordinates(Coordinate(1, 1, 3), Coordinate(4, 6, 3), [3], Metatile(2, 2))
+
+        # one tile per metatile, the upper-left one unless the area starts further in.
+        self.assertEqual([(column, row) for (o, n, z, column, row) in found],
+                         [(1, 1), (2, 1), (1, 2), (2, 2), (4, 1), (6, 1), (4, 2), (6, 2), (1, 4), (2, 4), (4, 4), (6, 4)])
+        self.assertEqual(set(count for (o, count, z, c, r) in found), set([12]))
+
+class CheckpointTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_flush_before_save(self):
+        filename = pathjoin(self.tmpdir, 'checkpoint')
+        flushed = []
+
+        # the cache is flushed before any offsets are recorded.
+        flush = lambda: flushed.append(exists(filename))
+        checkpoint = seed.Checkpoint(filename, dict(layer='test'), False, -1, flush)
+
+        checkpoint.add(3)
+        checkpoint.add(5)
+
+        self.assertEqual(flushed[0], False)
+        self.assertEqual(len(flushed), 2)
+
+        resumed = seed.Checkpoint(filename, dict(layer='test'), True, 30)
+        self.assertEqual([offset in resumed for offset in range(7)], [False] * 3 + [True, False, True, False])
+        self.assertEqual(resumed.completed, 2)
+
+    def seed(self, renders):
+        ''' Run tilestache-seed.py over the world at zoom 2, rendering every tile.
+
+            The killed run leaves a lock behind, so it goes stale quickly.
+        '''
+        configpath, logfile = pathjoin(self.tmpdir, 'tilestache.cfg'), pathjoin(self.tmpdir, 'renders.log')
+
+        config_dict = {
+          'cache': {'name': 'Disk', 'path': self.tmpdir, 'dirs': 'portable', 'gzip': []},
+          'layers': {
+            'json': {'provider': {'class': 'tests.seed_tests:DyingProvider', 'kwargs': dict(logfile=logfile, renders=renders)},
+                     'stale lock timeout': 1}
+          }
+        }
+
+        with open(configpath, 'w') as file:
+            json.dump(config_dict, file)
+
+        args = (sys.executable, pathjoin(dirname(__file__), '../scripts/tilestache-seed.py'),
+                '-c', configpath, '-l', 'json', '-e', 'json', '-q', '-x', '-b', '80', '-179', '-80', '179',
+                '--checkpoint-file', pathjoin(self.tmpdir, 'checkpoint'), '--checkpoint-interval', '0')
+
+        env = dict(os.environ, PYTHONPATH=abspath(pathjoin(dirname(__file__), '..')))
+        process = Popen(args + (renders is None and ('--resume', '2') or ('2', )), env=env, stderr=PIPE)
+        process.communicate()
+
+        return process.returncode, [line.split() for line in open(logfile)]
+
+    def test_resume(self):
+        returncode, renders = self.seed(5)
+        self.assertEqual((returncode, len(renders)), (1, 5))
+
+        returncode, renders = self.seed(None)
+        self.assertEqual(returncode, 0)
+
+        # every tile rendered exactly once, across both runs.
+        self.assertEqual(len(renders), 16)
+        self.assertEqual(len(set(map(tuple, renders))), 16)
+
+        for row in range(4):
+            for column in range(4):
+                self.assertTrue(exists(pathjoin(self.tmpdir, 'json/2/%d/%d.json' % (column, row))))
+
+class JSONPTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+
+        config_dict = {
+          'cache': {'name': 'Disk', 'path': self.tmpdir, 'gzip': []},
+          'layers': {
+            'json': {'provider': {'class': 'tests.seed_tests:Provider'}, 'metatile': {'rows': 2, 'columns': 2}}
+          }
+        }
+
+        self.config = buildConfiguration(config_dict, self.tmpdir + '/')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_metatile_callback(self):
+        layer, cache = self.config.layers['json'], self.config.cache
+        seed.renderTile(layer, Coordinate(4, 6, 3), 'json', False, 'cb')
+
+        # every tile of the metatile is wrapped in the callback.
+        bodies = set()
+
+        for other in layer.metatile.allCoords(Coordinate(4, 6, 3)):
+            bodies.add(cache.read(layer, other, 'JSON'))
+            self.assertEqual(cache.read(layer, other, 'JS'), 'cb(%s);' % cache.read(layer, other, 'JSON'))
+
+        self.assertEqual(len(bodies), 4)
+
+        # but not past the edge of the world at low zooms.
+        seed.renderTile(layer, Coordinate(0, 0, 0), 'json', False, 'cb')
+
+        self.assertTrue(cache.read(layer, Coordinate(0, 0, 0), 'JS'))
+        self.assertEqual(cache.read(layer, Coordinate(0, 1, 0), 'JS'), None)
+
+class SeedWorkersTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-test-')
+
+        self.config_dict = {
+          'cache': {'name': 'Disk', 'path': self.tmpdir, 'gzip': []},
+          'layers': {
+            'json': {'provider': {'class': 'tests.seed_tests:Provider'}, 'metatile': {'rows': 2, 'columns': 2}}
+          }
+        }
+
+        self.config = buildConfiguration(self.config_dict, self.tmpdir + '/')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_two_workers(self):
+        layer, cache = self.config.layers['json'], self.config.cache
+        options, zooms = seed.parser.parse_args(['--workers', '2', '-q'])
+        coordinates = seed.generateCoordinates(Coordinate(0, 0, 3), Coordinate(7, 7, 3), [3], 0, layer.metatile)
+
+        results = list(seed.seedWorkers(self.config_dict, self.tmpdir + '/', layer, 'json', options, coordinates))
+
+        # one result for each metatile, none of them failed.
+        self.assertEqual(sorted(offset for (offset, count, coord, size, seconds, error) in results), range(16))
+        self.assertEqual([error for (offset, count, coord, size, seconds, error) in results], [None] * 16)
+        self.assertEqual(set(count for (offset, count, coord, size, seconds, error) in results), set([16]))
+
+        for row in range(8):
+            for column in range(8):
+                body = cache.read(layer, Coordinate(row, column, 3), 'JSON')
+                self.assertEqual(json.loads(body)['tile'].split()[:2], ['zoom', '3'])
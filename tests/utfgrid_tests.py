@@ -0,0 +1,170 @@
+''' Tests and benchmarks for UTF Grid merging and compositing.
+
+Compares NumPy grid code with the pure Python implementations it replaced,
+kept below for reference. Run this file directly for a benchmark of both
+on three-layer composites:
+
+    python -m tests.utfgrid_tests
+'''
+from unittest import TestCase
+from random import Random
+from itertools import count
+from timeit import timeit
+from copy import deepcopy
+from json import dumps
+
+from TileStache.Mapnik import merge_grids, decode_grid, encode_grid, encode_id, decode_char
+from TileStache.Goodies.Providers import UtfGridComposite
+
+def random_grid(random, key_count, size=64, prefix='k'):
+    ''' Make a random UTF Grid with a blank first key.
+    '''
+    keys = [''] + ['%s%d' % (prefix, i) for i in range(1, key_count)]
+    data = dict([(key, {'name': key}) for key in keys[1:]])
+    rows = [u''.join([encode_id(random.choice([0, 0] + range(key_count))) for x in range(size)]) for y in range(size)]
+
+    return dict(keys=keys, data=data, grid=rows)
+
+def reference_merge_grids(grid1, grid2):
+    ''' Merge two UTF Grids one character at a time, as Mapnik.merge_grids() used to.
+    '''
+    keygen, outkeys, outdata = count(1), [], dict()
+
+    for ingrid in [grid1, grid2]:
+        for key in ingrid['keys']:
+            if key not in ingrid['data']:
+                outkeys.append('')
+                continue
+
+            outkey = '%d' % keygen.next()
+            outkeys.append(outkey)
+            outdata[outkey] = ingrid['data'][key]
+
+    offset, outgrid = len(grid1['keys']), []
+
+    def newchar(char1, char2):
+        id1, id2 = decode_char(char1), decode_char(char2)
+
+        if grid2['keys'][id2] == '':
+            return encode_id(id1)
+        else:
+            return encode_id(id2 + offset)
+
+    for (row1, row2) in zip(grid1['grid'], grid2['grid']):
+        outgrid.append(''.join([newchar(c1, c2) for (c1, c2) in zip(row1, row2)]))
+
+    return dict(keys=outkeys, data=outdata, grid=outgrid)
+
+def reference_composite(layers, layer_key=None):
+    ''' Composite decoded UTF Grid layers one pixel at a time, as UtfGridComposite used to.
+
+        Layers is a list of (layer name, grid) tuples. Returns keys, data and grid rows.
+    '''
+    resultGrid, gridKeys, gridData = [], [], {}
+
+    for (layerName, layer) in layers:
+        gridSize = len(layer['grid'])
+
+        if len(resultGrid) == 0:
+            resultGrid = [[-1] * gridSize for i in xrange(gridSize)]
+
+        keys, keyRemap = layer['keys'], {}
+
+        for k in keys:
+            if k in gridKeys:
+                for ext in xrange(ord('a'), ord('z')+1):
+                    if not k+chr(ext) in gridKeys:
+                        keyRemap[k] = (k+chr(ext))
+                        break
+
+        addedKeys = []
+
+        for y in xrange(gridSize):
+            for x in xrange(gridSize):
+                idNo = decode_char(layer['grid'][y][x])
+
+                if keys[idNo] == "":
+                    continue
+
+                key = keyRemap.get(keys[idNo], keys[idNo])
+
+                if not key in addedKeys:
+                    gridKeys.append(key)
+                    addedKeys.append(key)
+                    if layer_key != None:
+                        layer['data'][keys[idNo]][layer_key] = layerName
+                    gridData[key] = layer['data'][keys[idNo]]
+
+                resultGrid[x][y] = gridKeys.index(key)
+
+    finalKeys, finalGrid, idToFinalId = [], [], {}
+
+    for y in xrange(len(resultGrid)):
+        line = ''
+        for x in xrange(len(resultGrid)):
+            id = resultGrid[x][y]
+
+            if not id in idToFinalId:
+                idToFinalId[id] = len(idToFinalId)
+                finalKeys.append("" if id == -1 else gridKeys[id])
+
+            line += encode_id(idToFinalId[id])
+        finalGrid.append(line)
+
+    return finalKeys, gridData, finalGrid
+
+def composite(layers, layer_key=None):
+    ''' Composite decoded UTF Grid layers with UtfGridComposite.Result.
+    '''
+    result = UtfGridComposite.Result()
+
+    for (layerName, layer) in layers:
+        result.addLayer(layer, layerName, layer_key)
+
+    finalKeys, finalGrid = result.finalGrid()
+    return finalKeys, result.gridData, finalGrid
+
+class UtfGridTests(TestCase):
+
+    def setUp(self):
+        self.random = Random(0)
+
+    def test_encode_decode(self):
+        ids = range(0, 70000, 7)
+        rows = encode_grid(decode_grid([u''.join(map(encode_id, ids))]))
+
+        self.assertEqual(map(decode_char, rows[0]), ids)
+
+    def test_merge_grids(self):
+        for key_count in (2, 30, 300):
+            grids = [random_grid(self.random, key_count) for i in range(3)]
+
+            expected = reduce(reference_merge_grids, grids)
+            merged = merge_grids(*grids)
+
+            self.assertEqual(dumps(merged, sort_keys=True), dumps(expected, sort_keys=True))
+
+    def test_composite(self):
+        for key_count in (2, 30, 300):
+            # layers with the same keys exercise key renaming.
+            grids = [random_grid(self.random, key_count, prefix=p) for p in 'aab']
+            layers = zip(('one', 'two', 'three'), grids)
+
+            expected = reference_composite(deepcopy(layers), 'layer')
+            composited = composite(deepcopy(layers), 'layer')
+
+            self.assertEqual(dumps(composited), dumps(expected))
+
+if __name__ == '__main__':
+    random = Random(0)
+
+    for key_count in (10, 100, 1000):
+        grids = [random_grid(random, key_count) for i in range(3)]
+        layers = zip(('one', 'two', 'three'), grids)
+
+        times = (timeit(lambda: reduce(reference_merge_grids, grids), number=10) / 10,
+                 timeit(lambda: merge_grids(*grids), number=10) / 10,
+                 timeit(lambda: reference_composite(deepcopy(layers), 'layer'), number=10) / 10,
+                 timeit(lambda: composite(deepcopy(layers), 'layer'), number=10) / 10)
+
+        print '%4d keys, 3 layers: merge_grids %.4fs before, %.4fs after; UtfGridComposite %.4fs before, %.4fs after' % ((key_count, ) + times)